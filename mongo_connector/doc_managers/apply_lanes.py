@@ -0,0 +1,95 @@
+# coding: utf8
+
+import threading
+import traceback
+
+from future.moves.queue import Queue
+
+from mongo_connector.doc_managers.utils import LOG
+
+
+DEFAULT_MAX_PENDING = 1000
+
+# Stops a lane thread
+_STOP = object()
+
+
+class ApplyLanes(object):
+    """Applies operations in several threads. The operations of a document
+    always go to the same lane, which applies them in order, while the
+    operations of different documents are applied in parallel.
+    """
+
+    def __init__(self, count, apply, initializer=None, finalizer=None, max_pending=DEFAULT_MAX_PENDING):
+        self.apply = apply
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.queues = [Queue(maxsize=max_pending) for _ in range(count)]
+        self.threads = []
+
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(queue,),
+                name='apply-lane-{0}'.format(i)
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __len__(self):
+        return len(self.queues)
+
+    def lane(self, namespace, document_id):
+        """Returns the index of the lane applying the operations of a document."""
+        try:
+            key = hash((namespace, document_id))
+
+        except TypeError:
+            # Unhashable _id, such as a document
+            key = hash((namespace, repr(document_id)))
+
+        return key % len(self.queues)
+
+    def submit(self, namespace, document_id, *args):
+        self.submit_to(self.lane(namespace, document_id), namespace, document_id, *args)
+
+    def submit_to(self, lane, *operation):
+        self.queues[lane].put(operation)
+
+    def join(self):
+        """Waits for the submitted operations to be applied."""
+        for queue in self.queues:
+            queue.join()
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self, queue):
+        if self.initializer is not None:
+            self.initializer()
+
+        try:
+            while True:
+                operation = queue.get()
+
+                try:
+                    if operation is _STOP:
+                        return
+
+                    self.apply(*operation)
+
+                except Exception:
+                    LOG.error(u"Impossible to apply %s to %s", operation[2:], operation[0])
+                    LOG.error(u"Traceback:\n%s", traceback.format_exc())
+
+                finally:
+                    queue.task_done()
+
+        finally:
+            if self.finalizer is not None:
+                self.finalizer()
@@ -0,0 +1,38 @@
+# coding: utf8
+
+import io
+import threading
+
+from bson import json_util
+
+
+class DeadLetterFile(object):
+    """Appends the documents that could not be written to PostgreSQL to a local
+    file, one JSON object per line, along with the error and the generated SQL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, namespace, document, error, sql):
+        line = json_util.dumps({
+            'ns': namespace,
+            'document': document,
+            'error': u'{0}'.format(error).strip(),
+            'sql': sql
+        })
+
+        with self._lock:
+            if self._file is None:
+                self._file = io.open(self.path, 'a', encoding='utf8')
+
+            self._file.write(u'{0}\n'.format(line))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,267 @@
+# coding: utf8
+
+import copy
+import shelve
+import threading
+
+from bson import json_util
+from future.utils import iteritems
+
+from mongo_connector.doc_managers.mappings import get_mapped_paths
+from mongo_connector.doc_managers.utils import LRUCache
+
+
+class UnsupportedUpdate(Exception):
+    """Raised when an update cannot be applied to a cached document."""
+
+
+class DocumentCache(object):
+    """Local copy of the mapped part of the last written documents, which
+    saves reading them back from MongoDB on update.
+    The most recently used documents are kept in memory, the other ones are
+    spilled to a shelve file when a spill path is given.
+    """
+
+    def __init__(self, mappings, maxsize, spill_path=None):
+        self.mappings = mappings
+        self.documents = LRUCache(maxsize)
+        self.spill = shelve.open(spill_path, flag='n') if spill_path else None
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return {
+            'size': len(self.documents),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def get(self, namespace, document_id):
+        """Returns a copy of the cached document, or None."""
+        key = (namespace, document_id)
+
+        with self.lock:
+            document = self.documents.get(key)
+
+            if document is None and self.spill is not None:
+                document = self.spill.pop(_spill_key(key), None)
+
+                if document is not None:
+                    self._store(key, document)
+
+            if document is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            # The insertion adds the foreign keys to the linked documents
+            return copy.deepcopy(document)
+
+    def put(self, namespace, document):
+        key = (namespace, document['_id'])
+        document = self._project(namespace, document)
+
+        with self.lock:
+            self._discard_spilled(key)
+            self._store(key, document)
+
+    def update(self, namespace, document_id, update_spec):
+        """Applies an update to the cached document, which is dropped when the
+        update is not supported.
+        """
+        key = (namespace, document_id)
+
+        with self.lock:
+            if is_oplog_diff(update_spec):
+                self.invalidations += 1
+                self.documents.pop(key)
+                self._discard_spilled(key)
+                return
+
+            if update_spec and not any(field.startswith('$') for field in update_spec):
+                # Replacement document
+                document = dict(update_spec, _id=document_id)
+                self._discard_spilled(key)
+                self._store(key, self._project(namespace, document))
+                return
+
+            document = self.documents.get(key)
+
+            if document is None and self.spill is not None:
+                document = self.spill.pop(_spill_key(key), None)
+
+                if document is not None:
+                    self._store(key, document)
+
+            if document is None:
+                return
+
+            try:
+                apply_update_spec(document, update_spec)
+
+            except UnsupportedUpdate:
+                self.invalidations += 1
+                self.documents.pop(key)
+
+    def remove(self, namespace, document_id):
+        key = (namespace, document_id)
+
+        with self.lock:
+            self.documents.pop(key)
+            self._discard_spilled(key)
+
+    def clear(self, namespace):
+        with self.lock:
+            self.documents.clear(lambda key: key[0] == namespace)
+
+            if self.spill is not None:
+                for spill_key in list(self.spill.keys()):
+                    if json_util.loads(spill_key)[0] == namespace:
+                        del self.spill[spill_key]
+
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    def _store(self, key, document):
+        evicted = self.documents.put(key, document)
+
+        if evicted is not None:
+            self.evictions += 1
+
+            if self.spill is not None:
+                self.spill[_spill_key(evicted[0])] = evicted[1]
+
+    def _discard_spilled(self, key):
+        if self.spill is not None:
+            self.spill.pop(_spill_key(key), None)
+
+    def _project(self, namespace, document):
+        """Returns a copy of the top level fields of the document which hold
+        mapped fields.
+        """
+        paths = get_mapped_paths(self.mappings, namespace)
+
+        if paths is None:
+            return copy.deepcopy(document)
+
+        mapped, ancestors = paths
+        fields = set(path[0] for path in mapped if path)
+
+        return dict(
+            (field, copy.deepcopy(value))
+            for field, value in iteritems(document)
+            if field == '_id' or field in fields
+        )
+
+
+def _spill_key(key):
+    return json_util.dumps(list(key))
+
+
+def is_oplog_diff(update_spec):
+    """Tells whether an update is an oplog diff of MongoDB 5.0+, whose $v
+    field is removed before it reaches the doc manager.
+    """
+    return bool(update_spec) and 'diff' in update_spec and not any(field.startswith('$') for field in update_spec)
+
+
+def apply_update_spec(document, update_spec):
+    """Applies the field update operators found in the oplog to a document.
+    Raises UnsupportedUpdate for the operators and paths which cannot be
+    applied without the server, such as the positional ones.
+    """
+    for operator, fields in iteritems(update_spec):
+        if operator == '$v':
+            continue
+
+        if operator not in _OPERATORS or not isinstance(fields, dict):
+            raise UnsupportedUpdate(operator)
+
+        for path, value in iteritems(fields):
+            _OPERATORS[operator](document, path, value)
+
+
+def _resolve(document, path, create):
+    """Returns the container of the last component of the path and its key."""
+    parts = path.split('.')
+    container = document
+
+    for i, part in enumerate(parts):
+        if part.startswith('$'):
+            raise UnsupportedUpdate(path)
+
+        if isinstance(container, list):
+            if not part.isdigit():
+                raise UnsupportedUpdate(path)
+
+            part = int(part)
+
+            if part >= len(container):
+                raise UnsupportedUpdate(path)
+
+        elif not isinstance(container, dict):
+            raise UnsupportedUpdate(path)
+
+        if i == len(parts) - 1:
+            return container, part
+
+        if isinstance(container, dict) and part not in container:
+            if not create:
+                return None, None
+
+            container[part] = {}
+
+        container = container[part]
+
+
+def _set(document, path, value):
+    container, key = _resolve(document, path, True)
+    container[key] = copy.deepcopy(value)
+
+
+def _unset(document, path, value):
+    container, key = _resolve(document, path, False)
+
+    if isinstance(container, dict):
+        container.pop(key, None)
+
+    elif isinstance(container, list):
+        container[key] = None
+
+
+def _combine(function):
+    def operator(document, path, value):
+        container, key = _resolve(document, path, True)
+
+        if isinstance(container, dict) and key not in container:
+            container[key] = function(None, value)
+
+        else:
+            try:
+                container[key] = function(container[key], value)
+
+            except TypeError:
+                raise UnsupportedUpdate(path)
+
+    return operator
+
+
+_OPERATORS = {
+    '$set': _set,
+    '$unset': _unset,
+    '$inc': _combine(lambda current, value: value if current is None else current + value),
+    '$mul': _combine(lambda current, value: 0 * value if current is None else current * value),
+    '$min': _combine(lambda current, value: value if current is None else min(current, value)),
+    '$max': _combine(lambda current, value: value if current is None else max(current, value)),
+    # Only applied when the update inserts the document, which is logged as an insertion
+    '$setOnInsert': lambda document, path, value: None
+}
@@ -0,0 +1,145 @@
+# coding: utf8
+
+import re
+
+from mongo_connector.doc_managers.sql import TIMESTAMP_COLUMN
+from mongo_connector.doc_managers.utils import (
+    get_column_type,
+    is_linked_table_field,
+    is_native_array_field,
+    COLLECTION_OPTIONS
+)
+
+
+# Reasons of the planned indexes
+CREATION_DATE = u'creation date'
+MAPPING = u'mapping'
+TIMESTAMP = u'oplog timestamp'
+PRIMARY_KEY = u'primary key'
+FOREIGN_KEY = u'foreign key'
+
+_index_name = re.compile(r'\bINDEX\s+(?:IF NOT EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+
+def _index(name, sql, reason, required):
+    return {'name': name, 'sql': sql, 'reason': reason, 'required': required}
+
+
+def _scoped(column, discriminator):
+    if discriminator is None:
+        return column
+
+    return u'{0}, {1}'.format(discriminator, column)
+
+
+def get_foreign_key_columns(mappings, database):
+    """Returns the columns of each linked table referencing the rows of its
+    parent tables, by which its rows are deleted.
+    """
+    columns = {}
+
+    for collection_mapping in mappings[database].values():
+        for field, field_mapping in collection_mapping.items():
+            if field in COLLECTION_OPTIONS or 'fk' not in field_mapping:
+                continue
+
+            table_columns = columns.setdefault(field_mapping['dest'], [])
+
+            if field_mapping['fk'] not in table_columns:
+                table_columns.append(field_mapping['fk'])
+
+    return columns
+
+
+def plan_indexes(mappings, database, collection, timestamped, foreign_keys=None):
+    """Returns the indexes of the table of a collection, as dicts holding
+    their name, their definition to append to CREATE, the reason of the index
+    and whether the connector relies on it to write or search rows:
+      - the foreign key columns, by which linked rows are deleted on update
+        and remove
+      - the oplog timestamp of replicated collections, used on rollback
+      - the primary key of range partitioned tables, which is not a
+        constraint
+    The _creationdate index is only bookkeeping and can be left out with the
+    bookkeepingIndexes option, the other indexes are declared by the mapping.
+    foreign_keys are the columns returned by get_foreign_key_columns.
+    """
+    collection_mapping = mappings[database][collection]
+    pk_name = collection_mapping['pk']
+    discriminator = collection_mapping.get('discriminator')
+    partition = collection_mapping.get('partition')
+    range_partitioned = partition is not None and partition['type'] == 'RANGE'
+    indexes = []
+
+    if collection_mapping.get('bookkeepingIndexes', True):
+        indexes.append(_index(
+            u'idx_{0}__creation_date'.format(collection),
+            u"INDEX idx_{0}__creation_date ON {0} (_creationdate DESC)".format(collection),
+            CREATION_DATE,
+            False
+        ))
+
+    for index in collection_mapping.get('indices', []):
+        name = _index_name.search(index)
+        indexes.append(_index(name.group(1) if name else None, index, MAPPING, False))
+
+    if timestamped:
+        indexes.append(_index(
+            u'idx_{0}__ts'.format(collection),
+            u"INDEX idx_{0}__ts ON {0} ({1} DESC)".format(collection, TIMESTAMP_COLUMN),
+            TIMESTAMP,
+            True
+        ))
+
+    if range_partitioned:
+        # A unique constraint must include the partition key, the primary key
+        # is only indexed
+        indexes.append(_index(
+            u'idx_{0}__pk'.format(collection),
+            u"INDEX idx_{0}__pk ON {0} ({1})".format(collection, _scoped(pk_name, discriminator)),
+            PRIMARY_KEY,
+            True
+        ))
+
+    if foreign_keys is None:
+        foreign_keys = get_foreign_key_columns(mappings, database)
+
+    foreign_keys = foreign_keys.get(collection, [])
+    # Rows of shared tables are deleted by foreign key within their database,
+    # which only the indexes leading with the discriminator serve
+    indexed_columns = set() if range_partitioned or discriminator is not None else set([pk_name])
+
+    for field, column_mapping in collection_mapping.items():
+        if field in COLLECTION_OPTIONS or 'dest' not in column_mapping or 'index' not in column_mapping:
+            continue
+
+        if is_linked_table_field(column_mapping):
+            continue
+
+        name = column_mapping['dest']
+
+        if discriminator is None:
+            indexed_columns.add(name)
+
+        # Native arrays and JSONB are searched by containment
+        gin = is_native_array_field(column_mapping) or get_column_type(column_mapping) == 'JSONB'
+        using = 'USING GIN ' if gin else ''
+        indexes.append(_index(
+            u'idx_{0}_{1}'.format(collection.replace('.', '_'), name),
+            u"INDEX idx_{2}_{0} ON {1} {3}({0})".format(name, collection, collection.replace('.', '_'), using),
+            FOREIGN_KEY if name in foreign_keys else MAPPING,
+            name in foreign_keys
+        ))
+
+    for column in foreign_keys:
+        if column in indexed_columns:
+            continue
+
+        indexes.append(_index(
+            u'idx_{0}__fk_{1}'.format(collection, column),
+            u"INDEX idx_{0}__fk_{1} ON {0} ({2})".format(collection, column, _scoped(column, discriminator)),
+            FOREIGN_KEY,
+            True
+        ))
+
+    return indexes
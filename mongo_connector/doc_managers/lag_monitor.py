@@ -0,0 +1,73 @@
+# coding: utf8
+
+import threading
+from time import time
+
+from bson.timestamp import Timestamp
+
+from mongo_connector.doc_managers.utils import LOG
+
+
+DEFAULT_REPORT_INTERVAL = 60
+
+
+def get_timestamp_time(timestamp):
+    """Returns the seconds since the epoch of an oplog timestamp, given as a
+    bson Timestamp or as the long used by mongo-connector.
+    """
+    if isinstance(timestamp, Timestamp):
+        return timestamp.time
+
+    return timestamp >> 32
+
+
+class LagMonitor(object):
+    """Follows the lag between the oplog timestamps of the replicated
+    operations and the wall clock.
+    The catch-up mode starts when the lag reaches catch_up_lag seconds and
+    stops once it is back under resume_lag seconds, so that a lag around a
+    single threshold does not switch modes on every operation.
+    """
+
+    def __init__(self, catch_up_lag, resume_lag=None, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.catch_up_lag = catch_up_lag
+        self.resume_lag = catch_up_lag / 4.0 if resume_lag is None else resume_lag
+        self.report_interval = report_interval
+        self.catching_up = False
+        self.lag = None
+        self.switches = 0
+        self._reported = None
+        self._lock = threading.Lock()
+
+    def observe(self, timestamp, now=None):
+        """Records the lag of an operation, returns True when the mode changes."""
+        if timestamp is None:
+            return False
+
+        now = now or time()
+
+        with self._lock:
+            self.lag = max(0, now - get_timestamp_time(timestamp))
+
+            if self._reported is None or now - self._reported >= self.report_interval:
+                LOG.info(u"Oplog lag: %ss", int(self.lag))
+                self._reported = now
+
+            if self.catching_up:
+                switch = self.lag <= self.resume_lag
+
+            else:
+                switch = self.lag >= self.catch_up_lag
+
+            if switch:
+                self.catching_up = not self.catching_up
+                self.switches += 1
+
+            return switch
+
+    def stats(self):
+        return {
+            'lag': self.lag,
+            'catching_up': self.catching_up,
+            'switches': self.switches
+        }
@@ -0,0 +1,98 @@
+# coding: utf8
+
+import multiprocessing
+from collections import deque
+
+from bson import BSON
+
+from mongo_connector.doc_managers.sql import (
+    sql_insert_statements,
+    DEFAULT_MAX_STATEMENT_ROWS
+)
+
+
+# Mappings of the worker process, set once by the pool initializer
+_mappings = None
+_max_rows = DEFAULT_MAX_STATEMENT_ROWS
+
+
+def _init_worker(mappings, max_rows=DEFAULT_MAX_STATEMENT_ROWS):
+    global _mappings, _max_rows
+    _mappings = mappings
+    _max_rows = max_rows
+
+
+def _render_chunk(namespace, raw_documents, timestamp):
+    documents = [BSON(raw_document).decode() for raw_document in raw_documents]
+    # A document may be inserted by several statements
+    indexes = dict((id(document), i) for i, document in enumerate(documents))
+
+    return [
+        (
+            indexes[id(querytree['document']['raw'])],
+            querytree['collection'],
+            querytree['pk'],
+            querytree['document']['mapped'].get(querytree['pk']),
+            sql
+        )
+        for querytree, sql in sql_insert_statements(_mappings, namespace, documents, timestamp, _max_rows)
+    ]
+
+
+class MappingPool(object):
+    """Maps documents and renders their SQL statements in worker processes.
+    Chunks are sent to the workers as raw BSON and their statements are given
+    back in the order of the chunks, the statements are executed by the caller.
+    """
+
+    def __init__(self, mappings, processes, max_pending=None, max_rows=DEFAULT_MAX_STATEMENT_ROWS):
+        self.max_pending = max_pending or 2 * processes
+        self.pool = multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_worker,
+            initargs=(mappings, max_rows)
+        )
+
+    def render(self, namespace, chunks, timestamp=None):
+        """Yields each chunk of documents along with its statements, as
+        returned by sql_insert_statements.
+        """
+        pending = deque()
+
+        for chunk in chunks:
+            raw_documents = [BSON.encode(document) for document in chunk]
+            pending.append((
+                chunk,
+                self.pool.apply_async(_render_chunk, (namespace, raw_documents, timestamp))
+            ))
+
+            # Bounds the number of chunks waiting in memory
+            if len(pending) >= self.max_pending:
+                yield self._get_statements(namespace, *pending.popleft())
+
+        while pending:
+            yield self._get_statements(namespace, *pending.popleft())
+
+    @staticmethod
+    def _get_statements(namespace, chunk, result):
+        statements = [
+            (
+                {
+                    'namespace': namespace,
+                    'collection': collection,
+                    'pk': primary_key,
+                    'document': {
+                        'raw': chunk[index],
+                        'mapped': {primary_key: document_id}
+                    }
+                },
+                sql
+            )
+            for index, collection, primary_key, document_id, sql in result.get()
+        ]
+
+        return chunk, statements
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
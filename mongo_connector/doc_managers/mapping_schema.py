@@ -14,116 +14,156 @@ MAPPING_SCHEMA = {
         "collection": {
             "type": "object",
             "properties": {
-                "pk": {"type": "string"}
+                "pk": {"type": "string"},
+                "indices": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "partition": {"$ref": "#/definitions/partition"},
+                "bookkeepingIndexes": {"type": "boolean"},
+                "storage": {"$ref": "#/definitions/storage"},
+                "discriminator": {"type": "string", "pattern": "^[A-Za-z_][A-Za-z0-9_]*$"}
             },
             "patternProperties": {
-                "^(?!pk$)(.*)$": {
+                "^(?!(pk|indices|partition|bookkeepingIndexes|storage|discriminator)$)(.*)$": {
                     "type": "object",
                     "oneOf": [
                         {"$ref": "#/definitions/basic-field"},
                         {"$ref": "#/definitions/array-field"},
-                        {"$ref": "#/definitions/scalar-array-field"}
+                        {"$ref": "#/definitions/scalar-array-field"},
+                        {"$ref": "#/definitions/native-scalar-array-field"}
                     ]
                 }
             },
             "required": ["pk"]
         },
+        "storage": {
+            "type": "object",
+            "properties": {
+                "fillfactor": {"type": "integer", "minimum": 10, "maximum": 100},
+                "toast_tuple_target": {"type": "integer", "minimum": 128},
+                "parallel_workers": {"type": "integer", "minimum": 0}
+            },
+            "patternProperties": {
+                "^(toast\\.)?(autovacuum_[a-z_]+|log_autovacuum_min_duration|vacuum_truncate|vacuum_index_cleanup)$": {
+                    "type": ["number", "boolean", "string"]
+                }
+            },
+            "additionalProperties": False
+        },
+        "partition": {
+            "type": "object",
+            "properties": {
+                "type": {"enum": ["RANGE", "HASH"]},
+                "column": {"type": "string"},
+                "interval": {"enum": ["day", "week", "month", "year"]},
+                "premake": {"type": "integer", "minimum": 0},
+                "retention": {"type": "integer", "minimum": 1},
+                "modulus": {"type": "integer", "minimum": 1}
+            },
+            "required": ["type"]
+        },
+        "sql-type": {
+            "enum": [
+                # Numeric types
+                "SMALLINT",
+                "INTEGER",
+                "INT",
+                "BIGINT",
+                "DECIMAL",
+                "NUMERIC",
+                "REAL",
+                "DOUBLE PRECISION",
+                "SERIAL",
+                "BIGSERIAL",
+                # Monetary types
+                "MONEY",
+                # Character types
+                "CHARACTER VARYING",
+                "VARCHAR",
+                "CHARACTER",
+                "CHAR",
+                "TEXT",
+                # Binary types
+                "BYTEA",
+                # Date/Time types
+                "TIMESTAMP",
+                "DATE",
+                "TIME",
+                "INTERVAL",
+                # Boolean types
+                "BOOLEAN",
+                # Enum types (not implemented)
+                # Geometric types
+                "POINT",
+                "LINE",
+                "LSEG",
+                "BOX",
+                "PATH",
+                "POLYGON",
+                "CIRCLE",
+                # Network address types
+                "CIDR",
+                "INET",
+                "MACADDR",
+                # Bit string types
+                "BIT",
+                "BIT VARYING",
+                # Text search types
+                "TSVECTOR",
+                "TSQUERY",
+                # UUID types
+                "UUID",
+                # XML types
+                "XML",
+                # JSON types
+                "JSON",
+                "JSONB",
+                # Range types
+                "INT4RANGE",
+                "INT8RANGE",
+                "NUMRANGE",
+                "TSRANGE",
+                "TSTZRANGE",
+                "DATERANGE",
+                # Object identifier types
+                "OID",
+                "REGPROC",
+                "REGPROCEDURE",
+                "REGOPER",
+                "REGCLASS",
+                "REGTYPE",
+                "REGCONFIG",
+                "REGDICTIONARY",
+                # pg_lsn types
+                "PG_LSN",
+                # Pseudo types
+                "ANY",
+                "ANYELEMENT",
+                "ANYARRAY",
+                "ANYNONARRAY",
+                "ANYENUM",
+                "ANYRANGE",
+                "CSTRING",
+                "INTERNAL",
+                "LANGUAGE_HANDLER",
+                "FDW_HANDLER",
+                "RECORD",
+                "TRIGGER",
+                "EVENT_TRIGGER",
+                "VOID",
+                "OPAQUE"
+            ]
+        },
         "basic-field": {
             "properties": {
-                "type": {
-                    "enum": [
-                        # Numeric types
-                        "SMALLINT",
-                        "INTEGER",
-                        "INT",
-                        "BIGINT",
-                        "DECIMAL",
-                        "NUMERIC",
-                        "REAL",
-                        "DOUBLE PRECISION",
-                        "SERIAL",
-                        "BIGSERIAL",
-                        # Monetary types
-                        "MONEY",
-                        # Character types
-                        "CHARACTER VARYING",
-                        "VARCHAR",
-                        "CHARACTER",
-                        "CHAR",
-                        "TEXT",
-                        # Binary types
-                        "BYTEA",
-                        # Date/Time types
-                        "TIMESTAMP",
-                        "DATE",
-                        "TIME",
-                        "INTERVAL",
-                        # Boolean types
-                        "BOOLEAN",
-                        # Enum types (not implemented)
-                        # Geometric types
-                        "POINT",
-                        "LINE",
-                        "LSEG",
-                        "BOX",
-                        "PATH",
-                        "POLYGON",
-                        "CIRCLE",
-                        # Network address types
-                        "CIDR",
-                        "INET",
-                        "MACADDR",
-                        # Bit string types
-                        "BIT",
-                        "BIT VARYING",
-                        # Text search types
-                        "TSVECTOR",
-                        "TSQUERY",
-                        # UUID types
-                        "UUID",
-                        # XML types
-                        "XML",
-                        # JSON types
-                        "JSON",
-                        # Range types
-                        "INT4RANGE",
-                        "INT8RANGE",
-                        "NUMRANGE",
-                        "TSRANGE",
-                        "TSTZRANGE",
-                        "DATERANGE",
-                        # Object identifier types
-                        "OID",
-                        "REGPROC",
-                        "REGPROCEDURE",
-                        "REGOPER",
-                        "REGCLASS",
-                        "REGTYPE",
-                        "REGCONFIG",
-                        "REGDICTIONARY",
-                        # pg_lsn types
-                        "PG_LSN",
-                        # Pseudo types
-                        "ANY",
-                        "ANYELEMENT",
-                        "ANYARRAY",
-                        "ANYNONARRAY",
-                        "ANYENUM",
-                        "ANYRANGE",
-                        "CSTRING",
-                        "INTERNAL",
-                        "LANGUAGE_HANDLER",
-                        "FDW_HANDLER",
-                        "RECORD",
-                        "TRIGGER",
-                        "EVENT_TRIGGER",
-                        "VOID",
-                        "OPAQUE"
-                    ]
-                },
+                "type": {"$ref": "#/definitions/sql-type"},
                 "dest": {
                     "type": "string"
                 },
+                "transform": {"type": "string"},
+                "batchTransform": {"type": "boolean"},
+                "memoize": {"type": "integer", "minimum": 1},
                 "nullable": {
                     "type": "boolean"
                 }
@@ -151,7 +191,19 @@ MAPPING_SCHEMA = {
                     "type": "boolean"
                 }
             },
-            "required": ["type", "dest", "fk", "valueField"]
+            "required": ["type", "dest", "fk", "valueField"],
+            "not": {"required": ["valueType"]}
+        },
+        "native-scalar-array-field": {
+            "properties": {
+                "type": {"enum": ["_ARRAY_OF_SCALARS"]},
+                "dest": {"type": "string"},
+                "valueType": {"$ref": "#/definitions/sql-type"},
+                "nullable": {
+                    "type": "boolean"
+                }
+            },
+            "required": ["type", "valueType"]
         }
     },
     "type": "object",
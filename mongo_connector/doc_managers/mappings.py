@@ -1,20 +1,28 @@
 # coding: utf8
 
 from future.utils import iteritems, PY2, PY3
-from RestrictedPython.Guards import safe_builtins
-from RestrictedPython import compile_restricted
 
 from mongo_connector.doc_managers.formatters import DocumentFlattener
 from mongo_connector.doc_managers.utils import (
     db_and_collection,
+    get_nested_field_from_document,
+    is_linked_table_field,
+    is_native_array_field,
+    COLLECTION_OPTIONS,
+    JSON_TYPES,
+    UNMAPPED_FIELD,
     ARRAY_TYPE,
     ARRAY_OF_SCALARS_TYPE
 )
 from mongo_connector.doc_managers.mapping_schema import MAPPING_SCHEMA
+from mongo_connector.doc_managers.namespace_index import is_pattern
+from mongo_connector.doc_managers.tracing import span
+from mongo_connector.doc_managers.transform_cache import MemoizedTransform
 from mongo_connector.errors import InvalidConfiguration
 
+from bson import json_util
 from importlib import import_module
-import jsonschema
+import hashlib
 import logging
 
 logging.basicConfig()
@@ -58,26 +66,113 @@ def _clean_and_flatten_doc(mappings, doc, namespace):
 
             # Only include fields that are explicitly provided in the schema
             def include_field(field):
-                return field in mappings_coll
+                return field in mappings_coll and field not in COLLECTION_OPTIONS
 
-            return dict((k, v) for k, v in flat_doc.items() if include_field(k))
+            cleaned_doc = dict((k, v) for k, v in flat_doc.items() if include_field(k))
+
+            # Native arrays and JSON subdocuments are stored as a whole in a
+            # single column
+            for field, field_mapping in iteritems(mappings_coll):
+                if field in COLLECTION_OPTIONS:
+                    continue
+
+                if field == UNMAPPED_FIELD:
+                    cleaned_doc[field] = get_unmapped_fields(mappings_coll, doc)
+
+                elif is_native_array_field(field_mapping):
+                    value = get_nested_field_from_document(doc, field)
+
+                    if isinstance(value, list):
+                        cleaned_doc[field] = value
+
+                elif field_mapping.get('type') in JSON_TYPES:
+                    value = get_nested_field_from_document(doc, field)
+
+                    if value is not None:
+                        cleaned_doc[field] = value
+
+            return cleaned_doc
     return {}
 
 
+def get_unmapped_fields(collection_mapping, document):
+    """Returns the part of the document which is not covered by any field of
+    the collection mapping.
+    """
+    mapped_paths = set()
+    mapped_parents = set()
+
+    for field in collection_mapping:
+        if field in COLLECTION_OPTIONS or field == UNMAPPED_FIELD:
+            continue
+
+        mapped_paths.add(field)
+        parts = field.split('.')
+
+        for i in range(1, len(parts)):
+            mapped_parents.add('.'.join(parts[:i]))
+
+    def _unmapped(subdocument, prefix):
+        result = {}
+
+        for key, value in iteritems(subdocument):
+            path = prefix + key
+
+            if path in mapped_paths:
+                continue
+
+            if path in mapped_parents and isinstance(value, dict):
+                value = _unmapped(value, path + '.')
+
+                if not value:
+                    continue
+
+            result[key] = value
+
+        return result
+
+    return _unmapped(document, '')
+
+
 def get_mapped_document(mappings, document, namespace):
-    cleaned_and_flatten_document = _clean_and_flatten_doc(mappings, document, namespace)
+    with span(u'map', ns=namespace):
+        cleaned_and_flatten_document = _clean_and_flatten_doc(mappings, document, namespace)
 
-    db, collection = db_and_collection(namespace)
-    keys = list(cleaned_and_flatten_document)
+        db, collection = db_and_collection(namespace)
+        keys = list(cleaned_and_flatten_document)
+
+        for key in keys:
+            field_mapping = mappings[db][collection][key]
 
-    for key in keys:
-        field_mapping = mappings[db][collection][key]
+            if 'dest' in field_mapping:
+                mappedKey = field_mapping['dest']
+                cleaned_and_flatten_document[mappedKey] = cleaned_and_flatten_document.pop(key)
 
-        if 'dest' in field_mapping:
-            mappedKey = field_mapping['dest']
-            cleaned_and_flatten_document[mappedKey] = cleaned_and_flatten_document.pop(key)
+        return cleaned_and_flatten_document
 
-    return cleaned_and_flatten_document
+
+def get_row_digest(mappings, document, namespace, mapped_document=None):
+    """Returns a digest of the content of the rows mapped from a document: its
+    mapped fields and the arrays stored in linked tables. The mapped document
+    is computed when not given.
+    """
+    db, collection = db_and_collection(namespace)
+    collection_mapping = mappings[db][collection]
+    linked_arrays = [
+        (field, get_nested_field_from_document(document, field))
+        for field in sorted(collection_mapping)
+        if field not in COLLECTION_OPTIONS
+        and is_linked_table_field(collection_mapping[field])
+    ]
+    if mapped_document is None:
+        mapped_document = get_mapped_document(mappings, document, namespace)
+
+    content = json_util.dumps(
+        [mapped_document, linked_arrays],
+        sort_keys=True
+    )
+
+    return hashlib.sha1(content.encode('utf8')).digest()
 
 
 def get_mapped_field(mappings, namespace, field_name):
@@ -90,91 +185,207 @@ def get_primary_key(mappings, namespace):
     return mappings[db][collection]['pk']
 
 
-def get_transformed_value(mapped_field, mapped_document, key):
-    val = mapped_document[key]
+def get_transform(mapped_field):
+    """Returns the transform function of a field, or None when it has none or
+    when it cannot be loaded. Each transform definition is resolved once.
+    """
+    transform = mapped_field.get('transform')
 
-    if 'transform' in mapped_field:
-        transform = mapped_field['transform']
+    if transform is None:
+        return None
 
-        if transform[0] == '@':
-            transform_path = transform[1:].rsplit('.', 1)
-            module_path = 'mongo_connector.doc_managers.transforms'
+    try:
+        return _transforms[transform]
 
-            if len(transform_path) == 2:
-                module_path, transform_path = transform_path
+    except KeyError:
+        pass
 
-            else:
-                transform_path = transform_path[0]
+    function = None
 
-            try:
-                module = import_module(module_path)
-                transform = getattr(module, transform_path)
+    if transform[0] == '@':
+        transform_path = transform[1:].rsplit('.', 1)
+        module_path = 'mongo_connector.doc_managers.transforms'
 
-            except (ImportError, ValueError) as err:
-                LOG.error(
-                    'Impossible to use transform function: {0}'.format(err)
-                )
-                transform = None
+        if len(transform_path) == 2:
+            module_path, transform_path = transform_path
 
         else:
-            try:
-                src = 'transform = lambda val: {0}'.format(transform)
-                restricted_globals = {
-                    '__builtin__': safe_builtins
-                }
-                restricted_locals = {}
-                code = compile_restricted(src, '<string>', 'exec')
+            transform_path = transform_path[0]
 
-                if PY2:
-                    exec(code) in restricted_globals, restricted_locals
+        try:
+            module = import_module(module_path)
+            function = getattr(module, transform_path)
 
-                elif PY3:
-                    exec(code, restricted_globals, restricted_locals)
+        except (ImportError, ValueError, AttributeError) as err:
+            LOG.error(
+                'Impossible to use transform function: {0}'.format(err)
+            )
 
-                transform = restricted_locals['transform']
+    else:
+        try:
+            # Imported on first use, few mappings define transform code
+            from RestrictedPython.Guards import safe_builtins
+            from RestrictedPython import compile_restricted
 
-            except Exception as err:
-                LOG.error(
-                    'Impossible to use transform code: {0}'.format(err)
-                )
-                transform = None
+            src = 'transform = lambda val: {0}'.format(transform)
+            restricted_globals = {
+                '__builtin__': safe_builtins
+            }
+            restricted_locals = {}
+            code = compile_restricted(src, '<string>', 'exec')
 
-        if transform is not None:
-            try:
-                new_val = transform(val)
+            if PY2:
+                exec(code) in restricted_globals, restricted_locals
 
-            except Exception as err:
-                LOG.error(
-                    'An error occured during field transformation: {0}'.format(
-                        err
-                    )
-                )
+            elif PY3:
+                exec(code, restricted_globals, restricted_locals)
 
-            else:
-                val = new_val
+            function = restricted_locals['transform']
+
+        except Exception as err:
+            LOG.error(
+                'Impossible to use transform code: {0}'.format(err)
+            )
+
+    _transforms[transform] = function
+
+    return function
+
+
+def _transform_value(transform, val):
+    try:
+        return transform(val)
+
+    except Exception as err:
+        LOG.error(
+            'An error occured during field transformation: {0}'.format(
+                err
+            )
+        )
 
     return val
 
 
-def get_transformed_document(mappings, db, collection, mapped_document):
-    mapped_fields = {
-        mapping['dest']: mapping
-        for _, mapping in iteritems(mappings[db][collection])
-        if 'dest' in mapping and mapping['type'] not in (
+def _transform_column(transform, values):
+    """Applies a batch transform, which receives the list of the values of a
+    column and returns the list of their transformed values. The values are
+    left untransformed when it fails.
+    """
+    try:
+        transformed = list(transform(values))
+
+    except Exception as err:
+        LOG.error(
+            'An error occured during batch field transformation: {0}'.format(
+                err
+            )
+        )
+        return values
+
+    if len(transformed) != len(values):
+        LOG.error(
+            'Batch field transformation returned {0} values instead of {1}'.format(
+                len(transformed),
+                len(values)
+            )
+        )
+        return values
+
+    return transformed
+
+
+def get_transformed_value(mapped_field, mapped_document, key):
+    val = mapped_document[key]
+    transform = get_transform(mapped_field)
+
+    if transform is None:
+        return val
+
+    if mapped_field.get('batchTransform', False):
+        return _transform_column(transform, [val])[0]
+
+    return _transform_value(transform, val)
+
+
+def get_transformed_documents(mappings, db, collection, mapped_documents, batch_only=False):
+    """Returns the mapped documents of a collection with their fields
+    transformed. Batch transforms are called once per column with the values
+    of all the documents, the other transforms once per value unless
+    batch_only is set.
+    """
+    transforms = []
+
+    for field, mapped_field in iteritems(mappings[db][collection]):
+        if field in COLLECTION_OPTIONS or 'dest' not in mapped_field or mapped_field['type'] in (
             ARRAY_TYPE,
             ARRAY_OF_SCALARS_TYPE
-        )
-    }
-    keys = list(mapped_fields.keys())
-    keys.sort()
+        ):
+            continue
+
+        if batch_only and not mapped_field.get('batchTransform', False):
+            continue
+
+        transform = get_transform(mapped_field)
+
+        if transform is None:
+            continue
+
+        if 'memoize' in mapped_field:
+            transform = _get_memoized_transform(db, collection, mapped_field, transform)
 
-    return {
-        key: get_transformed_value(
-            mapped_fields[key],
-            mapped_document, key
-        ) if key in mapped_fields else mapped_document[key]
-        for key in mapped_document
-    }
+        transforms.append((mapped_field['dest'], transform, mapped_field.get('batchTransform', False)))
+
+    if not transforms:
+        return list(mapped_documents)
+
+    documents = [dict(mapped_document) for mapped_document in mapped_documents]
+
+    with span(u'transform', ns=u'{0}.{1}'.format(db, collection), documents=len(documents)):
+        for key, transform, batch in transforms:
+            rows = [document for document in documents if key in document]
+
+            if not rows:
+                continue
+
+            if batch:
+                values = _transform_column(transform, [document[key] for document in rows])
+
+                for document, val in zip(rows, values):
+                    document[key] = val
+
+            else:
+                for document in rows:
+                    document[key] = _transform_value(transform, document[key])
+
+    return documents
+
+
+def _get_memoized_transform(db, collection, mapped_field, transform):
+    """Returns the memoized transform of a field."""
+    key = (db, collection, mapped_field['dest'])
+    batch = mapped_field.get('batchTransform', False)
+    memoized = _memoized_transforms.get(key)
+
+    if memoized is None or memoized.transform is not transform or memoized.batch != batch \
+            or memoized.cache.maxsize != mapped_field['memoize']:
+        memoized = MemoizedTransform(transform, mapped_field['memoize'], batch)
+        _memoized_transforms[key] = memoized
+
+    return memoized
+
+
+def get_transform_stats():
+    """Returns the cache statistics of the memoized transforms of this
+    process, by database, table and column.
+    """
+    return dict(
+        (u'{0}.{1}.{2}'.format(db, collection, column), memoized.stats())
+        for (db, collection, column), memoized in _memoized_transforms.items()
+    )
+
+
+def get_transformed_document(mappings, db, collection, mapped_document):
+    return get_transformed_documents(mappings, db, collection, [mapped_document])[0]
 
 
 def is_mapped(mappings, namespace, field_name=None):
@@ -183,6 +394,141 @@ def is_mapped(mappings, namespace, field_name=None):
            (field_name is None or field_name in mappings[db][collection])
 
 
+# Update operators whose arguments are documents keyed by field paths
+FIELD_UPDATE_OPERATORS = frozenset([
+    u'$set', u'$unset', u'$inc', u'$mul', u'$rename', u'$min', u'$max',
+    u'$currentDate', u'$setOnInsert', u'$push', u'$pull', u'$pullAll',
+    u'$addToSet', u'$pop', u'$bit'
+])
+
+_mapped_paths = {}
+_projections = {}
+# Transform functions by definition, see get_transform
+_transforms = {}
+# Memoized transforms by database and table column, see _get_memoized_transform
+_memoized_transforms = {}
+
+
+def _normalize_path(path):
+    """Splits a dotted field path, ignoring the array indexes and the
+    positional operators ($, $[] and $[identifier]).
+    """
+    return tuple(
+        part for part in path.split('.')
+        if not part.isdigit() and not part.startswith('$')
+    )
+
+
+def get_mapped_paths(mappings, namespace):
+    """Returns the normalized paths of the fields mapped by a collection and
+    the set of their ancestors, or None when all fields are mapped.
+    Mappings are not expected to change once loaded, the paths are computed
+    once for each collection mapping.
+    """
+    db, collection = db_and_collection(namespace)
+    collection_mapping = mappings[db][collection]
+    cached = _mapped_paths.get(namespace)
+
+    if cached is not None and cached[0] is collection_mapping:
+        return cached[1]
+
+    paths = None
+
+    if UNMAPPED_FIELD not in collection_mapping:
+        mapped = set()
+        ancestors = set()
+
+        for field in collection_mapping:
+            if field in COLLECTION_OPTIONS:
+                continue
+
+            # Linked tables, native arrays and JSON columns map whole subtrees
+            path = _normalize_path(field)
+            mapped.add(path)
+
+            for i in range(len(path)):
+                ancestors.add(path[:i])
+
+        paths = (mapped, ancestors)
+
+    _mapped_paths[namespace] = (collection_mapping, paths)
+
+    return paths
+
+
+def get_projection(mappings, namespace):
+    """Returns the projection reading only the mapped fields of a collection
+    from MongoDB, or None when all fields are mapped.
+    Fields are projected as a whole when one of their ancestors is mapped,
+    array elements being projected along with their array.
+    """
+    db, collection = db_and_collection(namespace)
+    collection_mapping = mappings[db][collection]
+    cached = _projections.get(namespace)
+
+    if cached is not None and cached[0] is collection_mapping:
+        return cached[1]
+
+    paths = get_mapped_paths(mappings, namespace)
+    projection = None
+
+    if paths is not None:
+        mapped, _ = paths
+        projection = dict(
+            (u'.'.join(path), True)
+            for path in mapped
+            if path and not any(path[:i] in mapped for i in range(1, len(path)))
+        )
+
+    _projections[namespace] = (collection_mapping, projection)
+
+    return projection
+
+
+def _path_is_mapped(paths, path):
+    mapped, ancestors = paths
+    parts = _normalize_path(path)
+
+    if parts in ancestors:
+        return True
+
+    return any(parts[:i] in mapped for i in range(1, len(parts) + 1))
+
+
+def is_update_mapped(mappings, namespace, update_spec):
+    """Tells whether an update can change any column or linked table of the
+    namespace mapping. Replacement documents and unknown operators are
+    considered as changing the mapped fields.
+    """
+    paths = get_mapped_paths(mappings, namespace)
+
+    if paths is None:
+        return True
+
+    # Replacement documents and oplog diffs ($v 2) are not parsed
+    if not update_spec or any(not key.startswith('$') for key in update_spec):
+        return True
+
+    for operator in update_spec:
+        # Version of the oplog entry format
+        if operator == u'$v':
+            continue
+
+        fields = update_spec[operator]
+
+        if operator not in FIELD_UPDATE_OPERATORS or not isinstance(fields, dict):
+            return True
+
+        for field in fields:
+            if _path_is_mapped(paths, field):
+                return True
+
+            if operator == u'$rename' and _path_is_mapped(paths, fields[field]):
+                return True
+
+    return False
+
+
 def is_id_autogenerated(mappings, namespace):
     primary_key = get_primary_key(mappings, namespace)
 
@@ -199,59 +545,176 @@ def get_scalar_array_fields(mappings, db, collection):
     return [
         k for k, v in iteritems(mappings[db][collection])
         if 'type' in v and v['type'] == ARRAY_OF_SCALARS_TYPE
+        and not is_native_array_field(v)
         ]
 
 
+def validate_partition(database, collection, mapping):
+    partition = mapping['partition']
+
+    if partition['type'] == 'HASH':
+        if 'modulus' not in partition:
+            raise InvalidConfiguration(
+                "Hash partitioning of {0}.{1} requires a modulus".format(
+                    database,
+                    collection
+                )
+            )
+
+        return
+
+    column = partition.get('column', '_creationdate')
+    columns = [
+        field_mapping.get('dest', field)
+        for field, field_mapping in iteritems(mapping)
+        if field not in COLLECTION_OPTIONS
+    ]
+
+    if column != '_creationdate' and column not in columns:
+        raise InvalidConfiguration(
+            "Partition column {0} not mapped in {1}.{2}".format(
+                column,
+                database,
+                collection
+            )
+        )
+
+    # Range partitioned tables cannot hold the unique primary key referenced
+    # by the linked tables
+    for field in mapping:
+        if field not in COLLECTION_OPTIONS and is_linked_table_field(mapping[field]):
+            raise InvalidConfiguration(
+                "Range partitioned collection {0}.{1} cannot have linked tables".format(
+                    database,
+                    collection
+                )
+            )
+
+
+_mapping_validator = None
+
+
+def _inline_schema_refs(node, definitions):
+    """Returns the given schema with its references to the definitions
+    replaced by their content, the mapping schema not being recursive.
+    """
+    if isinstance(node, dict):
+        if '$ref' in node:
+            return _inline_schema_refs(definitions[node['$ref'].split('/')[-1]], definitions)
+
+        return dict(
+            (key, _inline_schema_refs(value, definitions))
+            for key, value in iteritems(node)
+            if key != 'definitions'
+        )
+
+    elif isinstance(node, list):
+        return [_inline_schema_refs(item, definitions) for item in node]
+
+    return node
+
+
+def _get_mapping_validator():
+    global _mapping_validator
+
+    if _mapping_validator is None:
+        # Imported on first use, the mapping is only validated once at startup
+        import jsonschema
+
+        # Resolving references dominates the validation of large mappings
+        _mapping_validator = jsonschema.Draft4Validator(
+            _inline_schema_refs(MAPPING_SCHEMA, MAPPING_SCHEMA['definitions'])
+        )
+
+    return _mapping_validator
+
+
 def validate_mapping(mappings):
-    try:
-        jsonschema.validate(mappings, MAPPING_SCHEMA)
+    from jsonschema.exceptions import best_match
+
+    err = best_match(_get_mapping_validator().iter_errors(mappings))
 
-    except jsonschema.ValidationError as err:
+    if err is not None:
         raise InvalidConfiguration(
             "Supplied mapping file is invalid: {0}".format(err)
         )
 
     # Integrity check
-    ARRAYS_TYPE = [ARRAY_TYPE, ARRAY_OF_SCALARS_TYPE]
-
     for database in mappings:
         dbmapping = mappings[database]
+        linked_collections = set(
+            linked_mapping[field]['dest']
+            for linked_mapping in dbmapping.values()
+            for field in linked_mapping
+            if field not in COLLECTION_OPTIONS
+            and is_linked_table_field(linked_mapping[field])
+        )
 
         for collection in dbmapping:
             mapping = dbmapping[collection]
 
-            if mapping['pk'] not in mapping:
-                # look for a linked table
-                for linked_collection in dbmapping:
-                    if linked_collection != collection:
-                        linked_mapping = dbmapping[linked_collection]
-                        links = [
-                            True
-                            for field in linked_mapping
-                            if field != 'pk'
-                            and linked_mapping[field]['type'] in ARRAYS_TYPE
-                            and linked_mapping[field]['dest'] == collection
-                        ]
-
-                        if len(links) > 0:
-                            break
-
-                else:
-                    # No linked table found, cannot generate primary key
+            if is_pattern(collection):
+                # Unlike databases, collections name their table
+                raise InvalidConfiguration(
+                    "Collection {0}.{1} cannot be a pattern".format(database, collection)
+                )
+
+            if is_pattern(database) and mapping.get('discriminator') is None:
+                # The matching databases share the table, their rows would
+                # overwrite and delete each other
+                raise InvalidConfiguration(
+                    "Collection {0}.{1} of a database pattern must have a discriminator".format(database, collection)
+                )
+
+            if mapping['pk'] not in mapping and collection not in linked_collections:
+                # No linked table found, cannot generate primary key
+                raise InvalidConfiguration(
+                    "Primary key {0} mapping not found in {1}.{2}".format(
+                        mapping['pk'],
+                        database,
+                        collection
+                    )
+                )
+
+            if UNMAPPED_FIELD in mapping:
+                field = mapping[UNMAPPED_FIELD]
+
+                if field['type'] not in JSON_TYPES or 'dest' not in field:
                     raise InvalidConfiguration(
-                        "Primary key {0} mapping not found in {1}.{2}".format(
-                            mapping['pk'],
+                        "Unmapped fields of {0}.{1} must be stored in a JSON or JSONB column with an explicit dest".format(
                             database,
                             collection
                         )
                     )
 
+            if 'partition' in mapping:
+                validate_partition(database, collection, mapping)
+
             for fieldname in mapping:
-                if fieldname != 'pk':
+                if fieldname not in COLLECTION_OPTIONS:
                     field = mapping[fieldname]
                     ftype = field['type']
 
-                    if ftype in ARRAYS_TYPE:
+                    # Only batch transforms are applied to the written rows
+                    if 'memoize' in field and not field.get('batchTransform', False):
+                        raise InvalidConfiguration(
+                            "Field {0}.{1}.{2} cannot be memoized without batchTransform".format(
+                                database,
+                                collection,
+                                fieldname
+                            )
+                        )
+
+                    if 'transform' in field and not field.get('batchTransform', False):
+                        LOG.warning(
+                            u"Transform of field %s.%s.%s is not applied to the written rows, set batchTransform "
+                            u"and make it take and return lists of values to apply it",
+                            database,
+                            collection,
+                            fieldname
+                        )
+
+                    if is_linked_table_field(field):
                         dest = field['dest']
 
                         # Check for linked table presence
@@ -291,6 +754,16 @@ def validate_mapping(mappings):
                                     )
                                 )
 
+                            # Linked rows are keyed by database like their parent rows
+                            if dbmapping[dest].get('discriminator') != mapping.get('discriminator'):
+                                raise InvalidConfiguration(
+                                    "Linked table {0}.{1} must share the discriminator of {0}.{2}".format(
+                                        database,
+                                        dest,
+                                        collection
+                                    )
+                                )
+
                         # Check for value field presence in linked table
                         if ftype == ARRAY_OF_SCALARS_TYPE:
                             valuefield = field['valueField']
@@ -0,0 +1,137 @@
+# coding: utf8
+
+import fnmatch
+import re
+
+from mongo_connector.doc_managers.utils import db_and_collection
+
+
+# Key of the patterns in the nodes of the trie, which are keyed by characters
+_PATTERNS = None
+_WILDCARDS = re.compile(r'[*?\[]')
+
+
+def is_pattern(name):
+    """Tells whether a mapping key holds fnmatch wildcards (*, ? or [...])."""
+    return _WILDCARDS.search(name) is not None
+
+
+def _literal_prefix(pattern):
+    return pattern[:_WILDCARDS.search(pattern).start()]
+
+
+class NamespaceIndex(object):
+    """Finds the wildcard pattern matching a name.
+    The patterns are stored in a trie of their literal prefix, so that a name
+    is only matched against the patterns whose prefix it starts with, the
+    longest prefixes first.
+    """
+
+    def __init__(self, patterns=()):
+        self.root = {}
+
+        for pattern in sorted(patterns):
+            self.add(pattern)
+
+    def add(self, pattern):
+        node = self.root
+
+        for char in _literal_prefix(pattern):
+            node = node.setdefault(char, {})
+
+        patterns = node.setdefault(_PATTERNS, [])
+        patterns.append((pattern, re.compile(fnmatch.translate(pattern))))
+        # Among the patterns of a prefix, the ones with fewer * come first
+        patterns.sort(key=lambda entry: (entry[0].count('*'), -len(entry[0]), entry[0]))
+
+    def match(self, name):
+        """Returns the most specific pattern matching the name, or None."""
+        node = self.root
+        candidates = [node.get(_PATTERNS, ())]
+
+        for char in name:
+            node = node.get(char)
+
+            if node is None:
+                break
+
+            candidates.append(node.get(_PATTERNS, ()))
+
+        for patterns in reversed(candidates):
+            for pattern, regex in patterns:
+                if regex.match(name):
+                    return pattern
+
+        return None
+
+
+class NamespaceMappings(dict):
+    """Mappings whose database keys may be wildcard patterns, e.g. tenant_*
+    for databases of identical collections, which then share their tables.
+    A database is looked up by its own key first, then by pattern. Resolved
+    names are cached, so that a lookup costs the same whatever the number of
+    databases matching a pattern.
+    """
+
+    def __init__(self, mappings=()):
+        super(NamespaceMappings, self).__init__(mappings)
+        self._reindex()
+
+    def _reindex(self):
+        self._index = NamespaceIndex(key for key in self.keys() if is_pattern(key))
+        self._resolved = {}
+
+    def resolve(self, db):
+        """Returns the key of the mapping of a database, or None."""
+        try:
+            return self._resolved[db]
+
+        except KeyError:
+            pass
+
+        if dict.__contains__(self, db):
+            key = db
+
+        else:
+            key = self._index.match(db)
+
+        self._resolved[db] = key
+
+        return key
+
+    def resolve_namespace(self, namespace):
+        """Returns the namespace of the mapping keys of a namespace, or None
+        when its database is not mapped.
+        """
+        db, collection = db_and_collection(namespace)
+        key = self.resolve(db)
+
+        return None if key is None else u'{0}.{1}'.format(key, collection)
+
+    def __getitem__(self, db):
+        key = self.resolve(db)
+
+        if key is None:
+            raise KeyError(db)
+
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, db):
+        return self.resolve(db) is not None
+
+    def get(self, db, default=None):
+        key = self.resolve(db)
+
+        return default if key is None else dict.__getitem__(self, key)
+
+    def __setitem__(self, db, mapping):
+        dict.__setitem__(self, db, mapping)
+        self._reindex()
+
+    def __delitem__(self, db):
+        dict.__delitem__(self, db)
+        self._reindex()
+
+    def __reduce__(self):
+        # Sent to the mapping workers, which rebuild the index
+        return NamespaceMappings, (dict(self),)
@@ -0,0 +1,67 @@
+# coding: utf8
+
+from collections import OrderedDict
+from time import time
+
+
+UPSERT = u'upsert'
+UPDATE = u'update'
+REMOVE = u'remove'
+
+
+class OperationBuffer(object):
+    """Holds the operations on documents during a flush window, keeping only
+    the last one for each document:
+      - an upsert or a remove replaces any previous operation
+      - an update, which re-reads the document from MongoDB, replaces an
+        upsert or an update
+    A merged operation moves after the other buffered ones, so that the
+    operations are applied in the order of their last occurrence.
+    """
+
+    def __init__(self, window, max_operations):
+        self.window = window
+        self.max_operations = max_operations
+        self._operations = OrderedDict()
+        self._started = None
+
+    def __len__(self):
+        return len(self._operations)
+
+    def add(self, namespace, document_id, operation, argument, timestamp):
+        """Buffers an operation, returns False when it cannot be merged with the
+        buffered operation of the document.
+        """
+        key = (namespace, document_id)
+
+        try:
+            previous = self._operations.pop(key, None)
+
+        except TypeError:
+            # Unhashable _id, such as a document
+            return False
+
+        if previous is not None and operation == UPDATE and previous[2] == REMOVE:
+            self._operations[key] = previous
+            return False
+
+        if self._started is None:
+            self._started = time()
+
+        self._operations[key] = (namespace, document_id, operation, argument, timestamp)
+        return True
+
+    def is_due(self, now=None):
+        if not self._operations:
+            return False
+
+        now = now or time()
+        return len(self._operations) >= self.max_operations or now - self._started >= self.window
+
+    def drain(self):
+        """Returns the buffered operations in their order and empties the buffer."""
+        operations = list(self._operations.values())
+        self._operations.clear()
+        self._started = None
+
+        return operations
@@ -2,47 +2,100 @@
 
 import json
 import os.path
+import threading
 import traceback
+from datetime import datetime
+from time import time
 
 import psycopg2
 from bson.objectid import ObjectId
 from mongo_connector.doc_managers.doc_manager_base import DocManagerBase
 from mongo_connector.doc_managers.formatters import DocumentFlattener
 from mongo_connector.errors import InvalidConfiguration
-from psycopg2.extensions import register_adapter
+from psycopg2.extensions import register_adapter, TRANSACTION_STATUS_INERROR
 from pymongo import MongoClient
 
+from mongo_connector.doc_managers.apply_lanes import ApplyLanes
+from mongo_connector.doc_managers.dead_letters import DeadLetterFile
+from mongo_connector.doc_managers.document_cache import DocumentCache
+from mongo_connector.doc_managers.index_plan import get_foreign_key_columns, plan_indexes
+from mongo_connector.doc_managers.lag_monitor import LagMonitor
+from mongo_connector.doc_managers.mapping_pool import MappingPool
+from mongo_connector.doc_managers.replay import OplogRecorder
+from mongo_connector.doc_managers.namespace_index import is_pattern, NamespaceMappings
+from mongo_connector.doc_managers import tracing
+from mongo_connector.doc_managers.tracing import trace, span
+from mongo_connector.doc_managers.operation_buffer import (
+    OperationBuffer,
+    UPSERT,
+    UPDATE,
+    REMOVE
+)
 from mongo_connector.doc_managers.mappings import (
     is_mapped,
+    is_update_mapped,
     get_mapped_document,
     get_primary_key,
+    get_projection,
+    get_row_digest,
+    get_transform_stats,
     get_scalar_array_fields,
     validate_mapping
 )
 from mongo_connector.doc_managers.sql import (
-    sql_table_exists,
     sql_create_table,
     sql_delete_rows,
     sql_bulk_insert,
+    sql_insert_statements,
+    map_documents,
+    sql_execute_statements,
     object_id_adapter,
     sql_delete_rows_where,
     to_sql_value,
     sql_drop_table,
-    sql_add_foreign_keys
+    sql_drop_tables,
+    sql_add_foreign_keys,
+    sql_create_checkpoint_table,
+    sql_get_checkpoints,
+    sql_set_checkpoint,
+    sql_delete_checkpoint,
+    sql_create_hash_partitions,
+    sql_create_default_partition,
+    sql_create_range_partition,
+    sql_get_partitions,
+    sql_get_table_stats,
+    sql_get_last_doc,
+    sql_search,
+    StatementBatch,
+    DEFAULT_MAX_STATEMENT_ROWS,
+    TIMESTAMP_COLUMN
 )
 
 from mongo_connector.doc_managers.utils import (
     get_array_fields,
     db_and_collection,
     get_any_array_fields,
-    ARRAY_OF_SCALARS_TYPE,
-    ARRAY_TYPE,
     get_nested_field_from_document,
+    get_column_type,
+    is_linked_table_field,
+    get_period_start,
+    shift_period,
+    get_partition_name,
+    COLLECTION_OPTIONS,
+    LRUCache,
     LOG
 )
 
 
 DEFAULT_MAPPINGS_JSON_FILE_NAME = 'mappings.json'
+DEFAULT_DEAD_LETTERS_FILE_NAME = 'dead_letters.jsonl'
+DEFAULT_ROW_HASH_CACHE_SIZE = 0
+DEFAULT_COALESCE_MAX_OPERATIONS = 1000
+DEFAULT_CATCH_UP_BATCH_SIZE = 1000
+DEFAULT_CATCH_UP_INTERVAL = 1
+DEFAULT_BLOAT_THRESHOLD = 0.2
+# Operation applying a catch-up batch in an apply lane
+GROUP = u'group'
 
 class DocManager(DocManagerBase):
     """DocManager that connects to any SQL database"""
@@ -59,10 +112,89 @@ class DocManager(DocManagerBase):
         self.auto_commit_interval = auto_commit_interval
         self.chunk_size = chunk_size
         self._formatter = DocumentFlattener()
-        self.pgsql = psycopg2.connect(url)
+        # Apply lanes bind their own connection to their thread
+        self.local = threading.local()
+        self.main_pgsql = psycopg2.connect(url)
         self.insert_accumulator = {}
+        self.checkpoints = {}
+        self.partitions_maintained_on = None
+        self.partitions_lock = threading.Lock()
+        # Dead tuple ratios of the tables are checked every bloatCheckInterval
+        # seconds when set
+        self.bloat_check_interval = kwargs.get('bloatCheckInterval', 0)
+        self.bloat_threshold = kwargs.get('bloatThreshold', DEFAULT_BLOAT_THRESHOLD)
+        self.bloat_checked_at = time()
+        self.bloat_lock = threading.Lock()
+        self.table_stats = {}
+        self.timestamped_tables = {}
+        # Indexes created for each table, see plan_indexes
+        self.index_plan = {}
         self.client = MongoClient(kwargs['mongoUrl'])
         self.quiet = kwargs.get('quiet', False)
+        # Linked documents beyond this number of rows go to another statement
+        self.max_statement_rows = kwargs.get('maxStatementRows', DEFAULT_MAX_STATEMENT_ROWS)
+        self.isolate_errors = kwargs.get('isolateErrors', False)
+        self.dead_letters = None
+        # Digests of the last rows written for each document, by (namespace, _id)
+        self.row_hashes = None
+        row_hash_cache_size = kwargs.get('rowHashCacheSize', DEFAULT_ROW_HASH_CACHE_SIZE)
+
+        if row_hash_cache_size > 0:
+            self.row_hashes = LRUCache(row_hash_cache_size)
+
+        # Operations on the same document are merged during coalesceWindow
+        # seconds when set. mongo-connector saves its oplog progress without
+        # calling commit, buffered operations are lost if the process dies
+        self.operations = None
+        self.operations_lock = threading.RLock()
+        self.operations_flusher = None
+        self.stopped = threading.Event()
+        coalesce_window = kwargs.get('coalesceWindow', 0)
+
+        if coalesce_window > 0:
+            self.operations = OperationBuffer(
+                coalesce_window,
+                kwargs.get('coalesceMaxOperations', DEFAULT_COALESCE_MAX_OPERATIONS)
+            )
+
+        # Operations are applied by batches of one transaction while the oplog
+        # lag is above catchUpLag seconds, when set
+        self.lag_monitor = None
+        self.catch_up_operations = None
+        catch_up_lag = kwargs.get('catchUpLag', 0)
+
+        if catch_up_lag > 0:
+            self.lag_monitor = LagMonitor(catch_up_lag, kwargs.get('catchUpResumeLag'))
+            self.catch_up_operations = OperationBuffer(
+                kwargs.get('catchUpInterval', DEFAULT_CATCH_UP_INTERVAL),
+                kwargs.get('catchUpBatchSize', DEFAULT_CATCH_UP_BATCH_SIZE)
+            )
+
+        # Operations and the documents read from MongoDB are written to
+        # recordFile when set, to be replayed by the replay module
+        self.recorder = None
+
+        if kwargs.get('recordFile'):
+            self.recorder = OplogRecorder(kwargs['recordFile'])
+
+        # Spans of a sample of the operations are written to traceFile when set
+        self.traced = bool(kwargs.get('traceFile'))
+
+        if self.traced:
+            tracing.configure(
+                kwargs['traceFile'],
+                kwargs.get('traceSampleRate', tracing.DEFAULT_SAMPLE_RATE)
+            )
+
+        # Mapped part of the last written documents, read on update instead of
+        # MongoDB when documentCacheSize is set
+        self.document_cache = None
+        document_cache_size = kwargs.get('documentCacheSize', 0)
+
+        if self.isolate_errors:
+            self.dead_letters = DeadLetterFile(
+                kwargs.get('deadLetterFile', DEFAULT_DEAD_LETTERS_FILE_NAME)
+            )
 
         mappings_json_file_name = kwargs.get('mappingFile', DEFAULT_MAPPINGS_JSON_FILE_NAME)
         register_adapter(ObjectId, object_id_adapter)
@@ -74,70 +206,200 @@ class DocManager(DocManagerBase):
             self.mappings = json.load(mappings_file)
 
         validate_mapping(self.mappings)
+        # Database keys may be wildcard patterns
+        self.mappings = NamespaceMappings(self.mappings)
         self.pgsql.set_session(deferrable=True)
         self._init_schema()
 
+        if document_cache_size > 0:
+            self.document_cache = DocumentCache(
+                self.mappings,
+                document_cache_size,
+                kwargs.get('documentCacheFile')
+            )
+
+        # Bulk loads map documents in worker processes when set
+        self.mapping_pool = None
+        mapping_workers = kwargs.get('mappingWorkers', 0)
+
+        if mapping_workers > 0:
+            self.mapping_pool = MappingPool(self.mappings, mapping_workers, max_rows=self.max_statement_rows)
+
+        # Operations are applied by applyWorkers threads when set
+        self.lanes = None
+        apply_workers = kwargs.get('applyWorkers', 0)
+
+        if apply_workers > 0:
+            self.lanes = ApplyLanes(
+                apply_workers,
+                self._apply_in_lane,
+                initializer=self._connect_lane,
+                finalizer=self._disconnect_lane
+            )
+
+        if self.operations is not None or self.catch_up_operations is not None:
+            # Flushes the operations of documents which are no longer written
+            self.operations_flusher = threading.Thread(target=self._run_operations_flusher)
+            self.operations_flusher.daemon = True
+            self.operations_flusher.start()
+
+    @property
+    def pgsql(self):
+        return getattr(self.local, 'pgsql', self.main_pgsql)
+
+    def _connect_lane(self):
+        self.local.pgsql = psycopg2.connect(self.url)
+        self.local.pgsql.set_session(deferrable=True)
+
+    def _disconnect_lane(self):
+        self.local.pgsql.close()
+
     def _init_schema(self):
         self.prepare_mappings()
 
         try:
+            with self.pgsql.cursor() as cursor:
+                sql_create_checkpoint_table(cursor)
+                self.checkpoints = sql_get_checkpoints(cursor)
+                self._commit()
+
             for database in self.mappings:
                 foreign_keys = []
+                # Tables of an interrupted bulk load are kept to resume it
+                preserved_tables = self.get_checkpointed_tables(database)
+
+                linked_tables = set()
+                foreign_key_columns = get_foreign_key_columns(self.mappings, database)
+
+                for collection in self.mappings[database]:
+                    linked_tables.update(self.get_linked_tables(database, collection))
 
                 with self.pgsql.cursor() as cursor:
+                    # The schema is sent in a single round trip, the tables
+                    # being dropped at once before their creation
+                    batch = StatementBatch(cursor)
+                    created_tables = [
+                        collection for collection in self.mappings[database]
+                        if collection not in preserved_tables
+                    ]
+                    sql_drop_tables(batch, created_tables)
+
                     for collection in self.mappings[database]:
                         self.insert_accumulator[collection] = 0
+                        # Tables of the replicated collections record the oplog
+                        # timestamp of their last write
+                        timestamped = collection not in linked_tables
+
+                        if timestamped:
+                            id_mapping = self.mappings[database][collection].get('_id', {})
+                            self.timestamped_tables[u'{0}.{1}'.format(database, collection)] = (
+                                collection,
+                                id_mapping.get('dest'),
+                                self.mappings[database][collection].get('discriminator')
+                            )
+
+                        if collection in preserved_tables:
+                            LOG.info(u"Keeping table %s to resume its bulk load", collection)
+                            continue
 
                         pk_found = False
                         pk_name = self.mappings[database][collection]['pk']
+                        partition = self.mappings[database][collection].get('partition')
+                        storage = self.mappings[database][collection].get('storage')
+                        discriminator = self.mappings[database][collection].get('discriminator')
                         columns = ['_creationdate TIMESTAMP']
-                        indices = [u"INDEX idx_{0}__creation_date ON {0} (_creationdate DESC)".format(collection)] + \
-                                  self.mappings[database][collection].get('indices', [])
+                        pk_constraint = "CONSTRAINT {0}_PK PRIMARY KEY".format(collection.upper())
+                        columns_constraint = ''
+                        indexes = plan_indexes(
+                            self.mappings,
+                            database,
+                            collection,
+                            timestamped,
+                            foreign_key_columns
+                        )
+                        self.index_plan[collection] = indexes
+
+                        if timestamped:
+                            columns.append(TIMESTAMP_COLUMN + ' BIGINT')
+
+                        if partition is not None and partition['type'] == 'RANGE':
+                            # A unique constraint must include the partition key,
+                            # the primary key is only indexed
+                            pk_constraint = ''
+
+                        if discriminator is not None:
+                            # Rows of the databases sharing the table are told
+                            # apart by the discriminator, which leads their key
+                            columns.append(discriminator + ' TEXT NOT NULL')
+
+                            if pk_constraint:
+                                columns_constraint = "CONSTRAINT {0}_PK PRIMARY KEY ({1}, {2})".format(
+                                    collection.upper(),
+                                    discriminator,
+                                    pk_name
+                                )
+
+                            pk_constraint = ''
 
                         for column in self.mappings[database][collection]:
+                            if column in COLLECTION_OPTIONS:
+                                continue
+
                             column_mapping = self.mappings[database][collection][column]
 
                             if 'dest' in column_mapping:
                                 name = column_mapping['dest']
-                                column_type = column_mapping['type']
+                                column_type = get_column_type(column_mapping)
                                 nullable = column_mapping.get('nullable', True)
 
                                 constraints = ''
                                 if name == pk_name:
-                                    constraints = "CONSTRAINT {0}_PK PRIMARY KEY".format(collection.upper())
+                                    constraints = pk_constraint
                                     pk_found = True
 
                                 if not nullable:
                                     constraints = '{} NOT NULL'.format(constraints)
 
-                                if column_type != ARRAY_TYPE and column_type != ARRAY_OF_SCALARS_TYPE:
+                                if not is_linked_table_field(column_mapping):
                                     columns.append(name + ' ' + column_type + ' ' + constraints)
 
-                                if 'index' in column_mapping:
-                                    indices.append(u"INDEX idx_{2}_{0} ON {1} ({0})".format(name, collection, collection.replace('.', '_')))
-
-                            if 'fk' in column_mapping:
+                            if 'fk' in column_mapping and column_mapping['dest'] not in preserved_tables:
                                 foreign_keys.append({
                                     'table': column_mapping['dest'],
                                     'ref': collection,
                                     'fk': column_mapping['fk'],
-                                    'pk': pk_name
+                                    'pk': pk_name,
+                                    'discriminator': discriminator
                                 })
 
                         if not pk_found:
-                            columns.append(pk_name + ' SERIAL CONSTRAINT ' + collection.upper() + '_PK PRIMARY KEY')
+                            columns.append(pk_name + ' SERIAL ' + pk_constraint)
+
+                        if columns_constraint:
+                            columns.append(columns_constraint)
 
-                        if sql_table_exists(cursor, collection):
-                            sql_drop_table(cursor, collection)
+                        if partition is None:
+                            sql_create_table(batch, collection, columns, storage=storage)
 
-                        sql_create_table(cursor, collection, columns)
+                        elif partition['type'] == 'HASH':
+                            sql_create_table(batch, collection, columns, u"HASH ({0})".format(pk_name))
+                            sql_create_hash_partitions(batch, collection, partition['modulus'], storage)
 
-                        for index in indices:
-                            cursor.execute("CREATE " + index)
+                        else:
+                            sql_create_table(batch, collection, columns, u"RANGE ({0})".format(
+                                partition.get('column', '_creationdate')
+                            ))
+                            sql_create_default_partition(batch, collection, storage)
 
+                        for index in indexes:
+                            batch.execute("CREATE " + index['sql'])
 
-                    sql_add_foreign_keys(cursor, foreign_keys)
-                    self.commit()
+                    sql_add_foreign_keys(batch, foreign_keys)
+                    batch.flush()
+                    self._commit()
+
+            self.maintain_partitions()
+            self._report_index_plan()
 
         except psycopg2.Error:
             LOG.error(u"A fatal error occured during tables creation")
@@ -145,17 +407,285 @@ class DocManager(DocManagerBase):
             if not self.quiet:
                 LOG.error(u"Traceback:\n%s", traceback.format_exc())
 
+    def _report_index_plan(self):
+        required = []
+
+        for table in sorted(self.index_plan):
+            for index in self.index_plan[table]:
+                LOG.debug(u"Index %s of table %s: %s", index['name'], table, index['reason'])
+
+                if index['required']:
+                    required.append(index['name'])
+
+        if required:
+            LOG.info(u"Indexes required by the connector: %s", u', '.join(required))
+
     def stop(self):
-        pass
+        self.stopped.set()
+        self.barrier()
+
+        if self.lanes is not None:
+            self.lanes.close()
+
+        if self.dead_letters is not None:
+            self.dead_letters.close()
+
+        if self.document_cache is not None:
+            LOG.info(u"Document cache statistics: %s", self.document_cache.stats())
+            self.document_cache.close()
+
+        if self.lag_monitor is not None:
+            LOG.info(u"Oplog lag statistics: %s", self.lag_monitor.stats())
+
+        transform_stats = get_transform_stats()
+
+        if transform_stats:
+            LOG.info(u"Memoized transform statistics: %s", transform_stats)
+
+        if self.traced:
+            tracing.configure(None)
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        if self.mapping_pool is not None:
+            self.mapping_pool.close()
 
     def upsert(self, doc, namespace, timestamp):
+        if self.recorder is not None:
+            self.recorder.upsert(namespace, doc, timestamp)
+
         if not is_mapped(self.mappings, namespace):
             return
 
+        if self.document_cache is not None:
+            self.document_cache.put(namespace, doc)
+
+        self._write(namespace, doc['_id'], UPSERT, doc, timestamp)
+
+    def _write(self, namespace, document_id, operation, argument, timestamp):
+        if self.lag_monitor is not None and self.lag_monitor.observe(timestamp):
+            self._switch_mode()
+
+        operations = self._get_operations()
+
+        if operations is None:
+            self._apply(namespace, document_id, operation, argument, timestamp)
+            return
+
+        with self.operations_lock:
+            if not operations.add(namespace, document_id, operation, argument, timestamp):
+                self.flush_operations()
+                self._apply(namespace, document_id, operation, argument, timestamp)
+
+            elif operations.is_due():
+                self.flush_operations()
+
+    def _get_operations(self):
+        """Returns the buffer of the current mode, None when operations are
+        applied as they come.
+        """
+        if self.lag_monitor is not None and self.lag_monitor.catching_up:
+            return self.catch_up_operations
+
+        return self.operations
+
+    def _switch_mode(self):
+        # The operations buffered in the previous mode are applied first
+        self.flush_operations()
+
+        if self.lag_monitor.catching_up:
+            LOG.info(u"Oplog lag of %ss, switching to catch-up mode", int(self.lag_monitor.lag))
+
+        else:
+            LOG.info(u"Oplog lag of %ss, switching back to low-latency mode", int(self.lag_monitor.lag))
+
+    def _apply(self, namespace, document_id, operation, argument, timestamp):
+        if self.lanes is not None:
+            self.lanes.submit(namespace, document_id, operation, argument, timestamp)
+
+        else:
+            self._apply_operation(namespace, document_id, operation, argument, timestamp)
+
+    def _apply_in_lane(self, *operation):
+        try:
+            self._apply_operation(*operation)
+
+        except Exception:
+            # Keeps the connection of the lane usable
+            self.pgsql.rollback()
+            raise
+
+    def _apply_operation(self, namespace, document_id, operation, argument, timestamp):
+        with trace(operation, ns=namespace):
+            if operation == GROUP:
+                self._apply_group(argument)
+
+            elif operation == UPSERT:
+                self._apply_upsert(argument, namespace, timestamp)
+
+            elif operation == UPDATE:
+                self._apply_update(document_id, argument, namespace, timestamp)
+
+            else:
+                self._apply_remove(document_id, namespace, timestamp)
+
+    def barrier(self):
+        """Applies the buffered operations and waits for the apply lanes."""
+        self.flush_operations()
+
+        if self.lanes is not None:
+            self.lanes.join()
+
+    def flush_operations(self):
+        """Applies the buffered operations."""
+        with self.operations_lock:
+            if self.operations is not None:
+                for operation in self.operations.drain():
+                    self._apply(*operation)
+
+            if self.catch_up_operations is not None and len(self.catch_up_operations):
+                self._apply_groups(self.catch_up_operations.drain())
+
+    def _run_operations_flusher(self):
+        window = min(
+            operations.window
+            for operations in (self.operations, self.catch_up_operations)
+            if operations is not None
+        )
+
+        while not self.stopped.wait(window):
+            with self.operations_lock:
+                operations = self._get_operations()
+
+                if operations is not None and operations.is_due():
+                    self.flush_operations()
+
+    def _apply_groups(self, operations):
+        """Applies a catch-up batch, split by apply lane."""
+        if self.lanes is None:
+            self._apply_group(operations)
+            return
+
+        groups = [[] for _ in range(len(self.lanes))]
+
+        for operation in operations:
+            groups[self.lanes.lane(operation[0], operation[1])].append(operation)
+
+        for lane, group in enumerate(groups):
+            if group:
+                self.lanes.submit_to(lane, None, None, GROUP, group, None)
+
+    def _apply_group(self, operations):
+        """Applies operations in a single transaction whose commit does not
+        wait for the WAL flush. The documents of the updates are read with one
+        query and the rows of the removed documents deleted with one statement
+        per collection.
+        When an operation fails, the transaction is rolled back and the
+        operations are applied one by one.
+        """
+        self.local.grouped = True
+
+        try:
+            with self.pgsql.cursor() as cursor:
+                cursor.execute(u"SET LOCAL synchronous_commit TO OFF")
+
+            self._apply_batch(operations)
+
+            if self.pgsql.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                raise psycopg2.InternalError(u"Catch-up batch aborted")
+
+            self._commit()
+            return
+
+        except psycopg2.Error:
+            self.pgsql.rollback()
+            LOG.warning(u"Impossible to apply a catch-up batch of %s operations, applying them one by one", len(operations))
+
+            # The digests of the rolled back rows were recorded
+            if self.row_hashes is not None:
+                for namespace, document_id, _, _, _ in operations:
+                    self.row_hashes.pop((namespace, document_id))
+
+        finally:
+            self.local.grouped = False
+
+        for operation in operations:
+            try:
+                self._apply_operation(*operation)
+
+            except psycopg2.Error:
+                self.pgsql.rollback()
+                LOG.error(u"Impossible to apply %s to %s", operation[2:], operation[0])
+
+                if not self.quiet:
+                    LOG.error(u"Traceback:\n%s", traceback.format_exc())
+
+    def _apply_batch(self, operations):
+        updated = {}
+        removed = {}
+
+        for namespace, document_id, operation, _, _ in operations:
+            if operation == UPDATE:
+                updated.setdefault(namespace, []).append(document_id)
+
+            elif operation == REMOVE:
+                removed.setdefault(namespace, []).append(document_id)
+
+        documents = {}
+
+        for namespace, document_ids in updated.items():
+            for document_id, document in self._fetch_documents(namespace, document_ids).items():
+                documents[(namespace, document_id)] = document
+
+        for namespace, document_ids in removed.items():
+            self._apply_removes(namespace, document_ids)
+
+        # The written documents of a collection are mapped together, so that
+        # batch transforms are called once per column
+        written = {}
+
+        for namespace, document_id, operation, argument, _ in operations:
+            if operation == UPSERT:
+                written.setdefault(namespace, []).append(argument)
+
+            elif operation == UPDATE and (namespace, document_id) in documents:
+                written.setdefault(namespace, []).append(documents[(namespace, document_id)])
+
+        mapped_documents = {}
+
+        for namespace, written_documents in written.items():
+            for document, mapped_document in zip(
+                written_documents,
+                map_documents(self.mappings, namespace, written_documents)
+            ):
+                mapped_documents[id(document)] = mapped_document
+
+        for namespace, document_id, operation, argument, timestamp in operations:
+            if operation == UPSERT:
+                self._apply_upsert(argument, namespace, timestamp, mapped_documents.get(id(argument)))
+
+            elif operation == UPDATE and (namespace, document_id) in documents:
+                document = documents[(namespace, document_id)]
+                self._apply_update(
+                    document_id,
+                    argument,
+                    namespace,
+                    timestamp,
+                    document,
+                    mapped_documents.get(id(document))
+                )
+
+    def _commit_operation(self):
+        # The operations of a catch-up batch are committed together
+        if not getattr(self.local, 'grouped', False):
+            self._commit()
+
+    def _apply_upsert(self, doc, namespace, timestamp, mapped_document=None):
         try:
             with self.pgsql.cursor() as cursor:
-                self._upsert(namespace, doc, cursor, timestamp)
-                self.commit()
+                self._upsert(namespace, doc, cursor, timestamp, mapped_document=mapped_document)
+                self._commit_operation()
 
         except psycopg2.Error:
             LOG.error(u"Impossible to upsert %s to %s", doc, namespace)
@@ -163,23 +693,84 @@ class DocManager(DocManagerBase):
             if not self.quiet:
                 LOG.error(u"Traceback:\n%s", traceback.format_exc())
 
-    def _upsert(self, namespace, document, cursor, timestamp):
+    def _upsert(self, namespace, document, cursor, timestamp, digest=None, mapped_document=None):
+        if digest is None:
+            mapped_document = self._get_mapped_document(namespace, document, mapped_document)
+            digest = self._get_row_digest(namespace, document, mapped_document)
+
+            if self._is_row_unchanged(namespace, document, digest):
+                return
+
         db, collection = db_and_collection(namespace)
         primary_key = self.mappings[db][collection]['pk']
 
-        sql_delete_rows_where(cursor, collection, '{0} = {1}'.format(
+        sql_delete_rows_where(cursor, collection, self._scope_condition(db, collection, '{0} = {1}'.format(
             primary_key,
             to_sql_value(document[primary_key])
-        ))
+        )))
 
-        sql_bulk_insert(
+        failures = self._insert_documents(
             cursor,
-            self.mappings,
             namespace,
             [document],
-            quiet=self.quiet
+            timestamp,
+            None if mapped_document is None else [mapped_document]
         )
-        self.commit()
+        self._commit_operation()
+
+        # A failed insertion rolls back the deletion as well, the rows must be
+        # written again by the next change of the document
+        if digest is not None and not failures:
+            self.row_hashes.put((namespace, document.get('_id')), digest)
+
+    def _get_mapped_document(self, namespace, document, mapped_document=None):
+        """Returns the mapped document to insert, mapped once for both the
+        digest and the insertion when digests are kept.
+        """
+        if mapped_document is not None or self.row_hashes is None:
+            return mapped_document
+
+        return map_documents(self.mappings, namespace, [document])[0]
+
+    def _get_row_digest(self, namespace, document, mapped_document=None):
+        if self.row_hashes is None or document.get('_id') is None:
+            return None
+
+        return get_row_digest(self.mappings, document, namespace, mapped_document)
+
+    def _is_row_unchanged(self, namespace, document, digest):
+        """Tells whether the rows of a document already hold its mapped content,
+        in which case rewriting them would only produce dead tuples and WAL.
+        """
+        return digest is not None and self.row_hashes.get((namespace, document.get('_id'))) == digest
+
+    def _insert_documents(self, cursor, namespace, documents, timestamp=None, mapped_documents=None):
+        return sql_bulk_insert(
+            cursor,
+            self.mappings,
+            namespace,
+            documents,
+            quiet=self.quiet,
+            isolate_errors=self.isolate_errors,
+            dead_letters=self.dead_letters,
+            timestamp=self._get_row_timestamp(namespace, timestamp),
+            max_rows=self.max_statement_rows,
+            mapped_documents=mapped_documents
+        )
+
+    def _scope_condition(self, db, collection, condition):
+        """Restricts a condition on the rows of a table shared by several
+        databases to the rows of the given database.
+        """
+        discriminator = self.mappings[db][collection].get('discriminator')
+
+        if discriminator is None:
+            return condition
+
+        return u"{0} AND {1} = {2}".format(condition, discriminator, to_sql_value(db))
+
+    def _get_row_timestamp(self, namespace, timestamp):
+        return timestamp if self.mappings.resolve_namespace(namespace) in self.timestamped_tables else None
 
     def get_linked_tables(self, database, collection):
         linked_tables = []
@@ -192,22 +783,70 @@ class DocManager(DocManagerBase):
 
         return linked_tables
 
+    def get_checkpointed_tables(self, database):
+        tables = set()
+
+        for namespace in self.checkpoints:
+            db, collection = db_and_collection(namespace)
+
+            if self.mappings.resolve(db) != database or not is_mapped(self.mappings, namespace):
+                continue
+
+            pending = [collection]
+
+            while pending:
+                table = pending.pop()
+
+                if table not in tables and table in self.mappings[db]:
+                    tables.add(table)
+                    pending.extend(self.get_linked_tables(db, table))
+
+        return tables
+
     def bulk_upsert(self, documents, namespace, timestamp):
+        if self.recorder is not None:
+            documents = self.recorder.bulk_upsert(namespace, documents, timestamp)
+
         LOG.info('Inspecting %s...', namespace)
+        self.barrier()
 
         if is_mapped(self.mappings, namespace):
             try:
                 LOG.info('Mapping found for %s !...', namespace)
-                LOG.info('Deleting all rows before update %s !...', namespace)
 
-                db, collection = db_and_collection(namespace)
-                for linked_table in self.get_linked_tables(db, collection):
-                    sql_delete_rows(self.pgsql.cursor(), linked_table)
+                if namespace in self.checkpoints:
+                    LOG.info(
+                        'Resuming bulk load of %s after _id %s...',
+                        namespace,
+                        self.checkpoints[namespace]
+                    )
+
+                else:
+                    LOG.info('Deleting all rows before update %s !...', namespace)
+
+                    db, collection = db_and_collection(namespace)
+                    discriminator = self.mappings[db][collection].get('discriminator')
+
+                    for table in self.get_linked_tables(db, collection) + [collection]:
+                        if discriminator is None:
+                            sql_delete_rows(self.pgsql.cursor(), table)
 
-                sql_delete_rows(self.pgsql.cursor(), collection)
-                self.commit()
+                        else:
+                            # Only the rows of this database are reloaded
+                            sql_delete_rows_where(
+                                self.pgsql.cursor(),
+                                table,
+                                u"{0} = {1}".format(discriminator, to_sql_value(db))
+                            )
+                    self._commit()
 
-                self._bulk_upsert(documents, namespace)
+                    if self.row_hashes is not None:
+                        self.row_hashes.clear(lambda key: key[0] == namespace)
+
+                    if self.document_cache is not None:
+                        self.document_cache.clear(namespace)
+
+                self._bulk_upsert(documents, namespace, timestamp)
                 LOG.info('%s done.', namespace)
 
             except psycopg2.Error:
@@ -220,43 +859,103 @@ class DocManager(DocManagerBase):
                 if not self.quiet:
                     LOG.error("Traceback:\n%s", traceback.format_exc())
 
-    def _bulk_upsert(self, documents, namespace):
-        with self.pgsql.cursor() as cursor:
-            document_buffer = []
-            insert_accumulator = 0
-
-            for document in documents:
-                document_buffer.append(document)
-                insert_accumulator += 1
+    def _bulk_upsert(self, documents, namespace, timestamp=None):
+        progress = {'copied': 0, 'skipped': 0}
+        chunks = self._iter_chunks(documents, namespace, progress)
+        timestamp = self._get_row_timestamp(namespace, timestamp)
 
-                if insert_accumulator % self.chunk_size == 0:
-                    sql_bulk_insert(
-                        cursor,
-                        self.mappings,
-                        namespace,
-                        document_buffer,
-                        quiet=self.quiet
-                    )
+        if self.mapping_pool is not None:
+            rendered_chunks = self.mapping_pool.render(namespace, chunks, timestamp)
 
-                    self.commit()
-                    document_buffer = []
-
-                    LOG.info('%s %s copied...', insert_accumulator, namespace)
+        else:
+            rendered_chunks = (
+                (chunk, sql_insert_statements(self.mappings, namespace, chunk, timestamp, self.max_statement_rows))
+                for chunk in chunks
+            )
 
-            sql_bulk_insert(
+        with self.pgsql.cursor() as cursor:
+            for chunk, statements in rendered_chunks:
+                self._bulk_insert_chunk(cursor, namespace, chunk, statements)
+                LOG.info('%s %s copied...', progress['copied'], namespace)
+
+            # The load is complete, a later bulk load must start from scratch
+            sql_delete_checkpoint(cursor, namespace)
+            self._commit()
+            self.checkpoints.pop(namespace, None)
+
+            if progress['skipped']:
+                LOG.info('%s %s already copied were skipped.', progress['skipped'], namespace)
+
+    def _iter_chunks(self, documents, namespace, progress):
+        checkpoint = self.checkpoints.get(namespace)
+        document_buffer = []
+
+        for document in documents:
+            if checkpoint is not None and self._is_checkpointed(document, checkpoint):
+                progress['skipped'] += 1
+                continue
+
+            # Dumped documents are not cached, they are read from MongoDB on
+            # their first update
+            document_buffer.append(document)
+            progress['copied'] += 1
+
+            if len(document_buffer) == self.chunk_size:
+                yield document_buffer
+                document_buffer = []
+
+        if document_buffer:
+            yield document_buffer
+
+    def _bulk_insert_chunk(self, cursor, namespace, documents, statements):
+        with trace(u'bulk_insert', ns=namespace, documents=len(documents)):
+            sql_execute_statements(
                 cursor,
-                self.mappings,
-                namespace,
-                document_buffer,
-                quiet=self.quiet
+                statements,
+                quiet=self.quiet,
+                isolate_errors=self.isolate_errors,
+                dead_letters=self.dead_letters
             )
-            self.commit()
+
+            # Written in the chunk's transaction so that it matches the table content
+            last_id = documents[-1]['_id']
+            sql_set_checkpoint(cursor, namespace, last_id)
+            self.checkpoints[namespace] = last_id
+
+            self._commit()
+
+    @staticmethod
+    def _is_checkpointed(document, checkpoint):
+        # mongo-connector dumps collections sorted by ascending _id
+        try:
+            return document['_id'] <= checkpoint
+
+        except TypeError:
+            return False
 
     def update(self, document_id, update_spec, namespace, timestamp):
+        if self.recorder is not None:
+            self.recorder.update(namespace, document_id, update_spec, timestamp)
+
         if not is_mapped(self.mappings, namespace):
             return
+
+        # Most updates only change fields which are not replicated
+        if not is_update_mapped(self.mappings, namespace, update_spec):
+            return
+
+        if self.document_cache is not None:
+            self.document_cache.update(namespace, document_id, update_spec)
+
+        self._write(namespace, document_id, UPDATE, update_spec, timestamp)
+
+    def _apply_update(self, document_id, update_spec, namespace, timestamp, updated_document=None,
+                      mapped_document=None):
         db, collection = db_and_collection(namespace)
-        updated_document = self.get_document_by_id(db, collection, document_id)
+
+        if updated_document is None:
+            updated_document = self.get_document_by_id(db, collection, document_id)
+
         primary_key = self.mappings[db][collection]['pk']
         mapped_field = self.mappings[db][collection].get(primary_key, {})
         field_type = mapped_field.get('type')
@@ -265,60 +964,284 @@ class DocManager(DocManagerBase):
         if updated_document is None:
             return
 
+        mapped_document = self._get_mapped_document(namespace, updated_document, mapped_document)
+        digest = self._get_row_digest(namespace, updated_document, mapped_document)
+
+        if self._is_row_unchanged(namespace, updated_document, digest):
+            return
+
         for arrayField in get_any_array_fields(self.mappings, db, collection, updated_document):
             dest = self.mappings[db][collection][arrayField]['dest']
             fk = self.mappings[db][collection][arrayField]['fk']
             sql_delete_rows_where(
                 self.pgsql.cursor(),
                 dest,
-                "{0} = {1}".format(fk, doc_id)
+                self._scope_condition(db, dest, "{0} = {1}".format(fk, doc_id))
             )
 
         self._upsert(namespace,
                      updated_document,
-                     self.pgsql.cursor(), timestamp)
+                     self.pgsql.cursor(), timestamp, digest, mapped_document)
 
-        self.commit()
+        self._commit_operation()
 
     def get_document_by_id(self, db, collection, document_id):
-        return self.client[db][collection].find_one({'_id': document_id})
+        namespace = u'{0}.{1}'.format(db, collection)
+
+        if self.document_cache is not None:
+            document = self.document_cache.get(namespace, document_id)
+
+            if document is not None:
+                return document
+
+        with span(u'fetch', ns=namespace):
+            document = self.client[db][collection].find_one(
+                {'_id': document_id},
+                projection=get_projection(self.mappings, namespace)
+            )
+
+        if document is not None and self.recorder is not None:
+            self.recorder.fetched(namespace, document)
+
+        if document is not None and self.document_cache is not None:
+            self.document_cache.put(namespace, document)
+
+        return document
+
+    def _fetch_documents(self, namespace, document_ids):
+        """Returns the documents found by _id, read from the document cache or
+        with a single query.
+        """
+        db, collection = db_and_collection(namespace)
+        documents = {}
+        missing = []
+
+        for document_id in document_ids:
+            document = None
+
+            if self.document_cache is not None:
+                document = self.document_cache.get(namespace, document_id)
+
+            if document is None:
+                missing.append(document_id)
+
+            else:
+                documents[document_id] = document
+
+        if missing:
+            with span(u'fetch', ns=namespace, documents=len(missing)):
+                documents_found = self.client[db][collection].find(
+                    {'_id': {'$in': missing}},
+                    projection=get_projection(self.mappings, namespace)
+                )
+
+                for document in documents_found:
+                    documents[document['_id']] = document
+
+                    if self.recorder is not None:
+                        self.recorder.fetched(namespace, document)
+
+                    if self.document_cache is not None:
+                        self.document_cache.put(namespace, document)
+
+        return documents
 
     def remove(self, document_id, namespace, timestamp):
+        if self.recorder is not None:
+            self.recorder.remove(namespace, document_id, timestamp)
+
         if not is_mapped(self.mappings, namespace):
             return
 
+        if self.document_cache is not None:
+            self.document_cache.remove(namespace, document_id)
+
+        self._write(namespace, document_id, REMOVE, None, timestamp)
+
+    def _apply_remove(self, document_id, namespace, timestamp):
+        self._apply_removes(namespace, [document_id])
+
+    def _apply_removes(self, namespace, document_ids):
         with self.pgsql.cursor() as cursor:
             db, collection = db_and_collection(namespace)
             primary_key = self.mappings[db][collection]['pk']
             mapped_field = self.mappings[db][collection].get(primary_key, {})
             field_type = mapped_field.get('type')
-            doc_id = to_sql_value(document_id, vtype=field_type)
+            doc_ids = [to_sql_value(document_id, vtype=field_type) for document_id in document_ids]
+
+            if len(doc_ids) == 1:
+                condition = u"= {0}".format(doc_ids[0])
+
+            else:
+                condition = u"IN ({0})".format(u', '.join(doc_ids))
+
             cursor.execute(
-                "DELETE from {0} WHERE {1} = {2};".format(
+                u"DELETE from {0} WHERE {1};".format(
                     collection.lower(),
-                    primary_key,
-                    doc_id
+                    self._scope_condition(db, collection, u"{0} {1}".format(primary_key, condition))
                 )
             )
-            self.commit()
+            self._commit_operation()
+
+        if self.row_hashes is not None:
+            for document_id in document_ids:
+                self.row_hashes.pop((namespace, document_id))
 
     def search(self, start_ts, end_ts):
-        pass
+        self.barrier()
+
+        # A server side cursor streams the documents
+        with self.pgsql.cursor(name='mongo_connector_search') as cursor:
+            for document in sql_search(cursor, self._get_searchable_tables(), start_ts, end_ts):
+                yield document
 
     def commit(self):
-        self.pgsql.commit()
+        self.barrier()
+        self._commit()
+
+    def _commit(self):
+        with span(u'commit'):
+            self.pgsql.commit()
+
+        if self.partitions_maintained_on is not None and \
+                self.partitions_maintained_on != datetime.utcnow().date():
+            with self.partitions_lock:
+                # Another lane may have maintained them meanwhile
+                if self.partitions_maintained_on != datetime.utcnow().date():
+                    self.maintain_partitions()
+
+        if self._is_bloat_check_due():
+            with self.bloat_lock:
+                if self._is_bloat_check_due():
+                    self.check_bloat()
+
+    def _is_bloat_check_due(self):
+        return self.bloat_check_interval > 0 and time() - self.bloat_checked_at >= self.bloat_check_interval
+
+    def check_bloat(self):
+        """Reads the dead tuple ratio of the mapped tables, which grows when
+        autovacuum does not keep up with the rows rewritten by the updates.
+        The tables above bloatThreshold are logged as warnings.
+        """
+        self.bloat_checked_at = time()
+        tables = [collection for database in self.mappings for collection in self.mappings[database]]
+
+        try:
+            with self.pgsql.cursor() as cursor:
+                stats = sql_get_table_stats(cursor, tables)
+
+            self.pgsql.commit()
+
+        except psycopg2.Error:
+            self.pgsql.rollback()
+            LOG.error(u"Impossible to read the statistics of the tables")
+
+            if not self.quiet:
+                LOG.error(u"Traceback:\n%s", traceback.format_exc())
+
+            return
+
+        for table in sorted(stats):
+            live, dead = stats[table]
+            ratio = float(dead) / (live + dead) if live + dead else 0.0
+            self.table_stats[table] = {'live': live, 'dead': dead, 'dead_ratio': ratio}
+            log = LOG.warning if ratio >= self.bloat_threshold else LOG.debug
+            log(u"Table %s has %s dead tuples for %s live tuples (%.1f%%)", table, dead, live, 100 * ratio)
+
+    def maintain_partitions(self, today=None):
+        """Creates the upcoming partitions of the range partitioned tables and
+        drops the ones older than their retention. A failure is logged and the
+        maintenance is attempted again on the next day.
+        """
+        today = today or datetime.utcnow().date()
+
+        try:
+            maintained = self._maintain_partitions(today)
+            self.pgsql.commit()
+
+        except psycopg2.Error:
+            self.pgsql.rollback()
+            # Creating a partition fails when the default partition holds rows of its range
+            LOG.error(u"Impossible to maintain the partitions")
+
+            if not self.quiet:
+                LOG.error(u"Traceback:\n%s", traceback.format_exc())
+
+            maintained = any(
+                self.mappings[database][collection].get('partition', {}).get('type') == 'RANGE'
+                for database in self.mappings
+                for collection in self.mappings[database]
+            )
+
+        if maintained:
+            self.partitions_maintained_on = today
+
+    def _maintain_partitions(self, today):
+        """Returns whether there are range partitioned tables."""
+        maintained = False
+
+        with self.pgsql.cursor() as cursor:
+            for database in self.mappings:
+                for collection in self.mappings[database]:
+                    partition = self.mappings[database][collection].get('partition')
+
+                    if partition is None or partition['type'] != 'RANGE':
+                        continue
+
+                    maintained = True
+                    interval = partition.get('interval', 'month')
+                    retention = partition.get('retention')
+                    current = get_period_start(interval, today)
+                    first = shift_period(interval, current, -retention) if retention else current
+
+                    for offset in range(partition.get('premake', 1) + 1 + (retention or 0)):
+                        start = shift_period(interval, first, offset)
+                        sql_create_range_partition(
+                            cursor,
+                            collection,
+                            get_partition_name(collection, start),
+                            start,
+                            shift_period(interval, start, 1),
+                            self.mappings[database][collection].get('storage')
+                        )
+
+                    if retention:
+                        oldest = get_partition_name(collection, first)
+
+                        for name in sql_get_partitions(cursor, collection):
+                            # Names are zero padded dates, their order is chronological
+                            if name[-9:-8] == 'p' and name[-8:].isdigit() and name < oldest:
+                                LOG.info(u"Dropping expired partition %s", name)
+                                sql_drop_table(cursor, name)
+
+        return maintained
 
     def get_last_doc(self):
-        pass
+        # The last document must not be an operation lost on a crash
+        self.commit()
+
+        with self.pgsql.cursor() as cursor:
+            return sql_get_last_doc(cursor, self._get_searchable_tables())
+
+    def _get_searchable_tables(self):
+        # Documents can only be fetched back from tables storing their _id,
+        # and under a database name, which the tables of a database pattern
+        # only store in their discriminator
+        return [
+            (namespace, table, id_column, discriminator)
+            for namespace, (table, id_column, discriminator) in sorted(self.timestamped_tables.items())
+            if id_column is not None
+            and (discriminator is not None or not is_pattern(db_and_collection(namespace)[0]))
+        ]
 
     def handle_command(self, doc, namespace, timestamp):
-        pass
+        self.commit()
 
     def prepare_mappings(self):
         # Set default values for dest fields
         for db in self.mappings:
             for collection in self.mappings[db]:
                 for field in self.mappings[db][collection]:
-                    if isinstance(self.mappings[db][collection][field], dict):
+                    if field not in COLLECTION_OPTIONS and isinstance(self.mappings[db][collection][field], dict):
                         if 'dest' not in self.mappings[db][collection][field]:
                             self.mappings[db][collection][field]['dest'] = field
@@ -0,0 +1,390 @@
+# coding: utf8
+
+"""Records the operations given to the doc manager and replays them to
+benchmark the connector against a local PostgreSQL server:
+
+    python -m mongo_connector.doc_managers.replay recording.bson.gz --mapping mappings.json
+
+The recording is streamed, the documents read from MongoDB being served from
+a bounded cache of the last recorded versions.
+"""
+
+import argparse
+import copy
+import gzip
+import itertools
+import json
+import math
+import threading
+from collections import deque
+from time import sleep, time
+
+import bson
+from bson import json_util
+
+from mongo_connector.doc_managers.utils import LOG, LRUCache
+from mongo_connector.errors import InvalidConfiguration
+
+
+UPSERT = u'upsert'
+UPDATE = u'update'
+REMOVE = u'remove'
+BULK_UPSERT = u'bulk_upsert'
+# Records of the documents of a bulk upsert, which ends with an END record
+DOCUMENT = u'document'
+END = u'end'
+# Records of the documents read from MongoDB, served back on replay
+FETCH = u'fetch'
+
+# Recorded documents kept to serve the reads of the doc manager
+DOCUMENT_CACHE_SIZE = 100000
+# Records read ahead of an update looking for the document it fetches
+LOOKAHEAD = 1000
+
+PERCENTILES = (50, 90, 99)
+# Statistics of the closed connections are collected asynchronously
+STATS_DELAY = 1
+
+
+class OplogRecorder(object):
+    """Writes the operations given to the doc manager and the documents it
+    reads from MongoDB to a gzipped sequence of BSON records.
+    The documents of a bulk upsert are written as they are read, along with
+    the number of their bulk upsert since other operations may be recorded
+    meanwhile.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._bulks = itertools.count()
+
+    def _write(self, record):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(bson.BSON.encode(record))
+
+    def upsert(self, namespace, document, timestamp):
+        self._write({'op': UPSERT, 'ns': namespace, 'doc': document, 'ts': timestamp})
+
+    def update(self, namespace, document_id, update_spec, timestamp):
+        self._write({'op': UPDATE, 'ns': namespace, 'id': document_id, 'spec': update_spec, 'ts': timestamp})
+
+    def remove(self, namespace, document_id, timestamp):
+        self._write({'op': REMOVE, 'ns': namespace, 'id': document_id, 'ts': timestamp})
+
+    def bulk_upsert(self, namespace, documents, timestamp):
+        """Returns the documents, which are recorded as they are read."""
+        with self._lock:
+            bulk = next(self._bulks)
+
+        self._write({'op': BULK_UPSERT, 'ns': namespace, 'ts': timestamp, 'bulk': bulk})
+
+        for document in documents:
+            self._write({'op': DOCUMENT, 'doc': document, 'bulk': bulk})
+            yield document
+
+        self._write({'op': END, 'bulk': bulk})
+
+    def fetched(self, namespace, document):
+        self._write({'op': FETCH, 'ns': namespace, 'doc': document})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    """Yields the records of a recording."""
+    with gzip.open(path, 'rb') as recording:
+        for record in bson.decode_file_iter(recording):
+            yield record
+
+
+def _document_key(namespace, document_id):
+    # _id may be a document
+    return namespace, json_util.dumps(document_id, sort_keys=True)
+
+
+class RecordedMongo(object):
+    """Stand-in for the MongoClient of the doc manager, serving the last
+    recorded version read so far of the documents read from MongoDB or
+    upserted, up to maxsize documents.
+    """
+
+    def __init__(self, maxsize=DOCUMENT_CACHE_SIZE):
+        self.documents = LRUCache(maxsize)
+
+    def has(self, namespace, document_id):
+        return _document_key(namespace, document_id) in self.documents
+
+    def add(self, namespace, document):
+        self.documents.put(_document_key(namespace, document['_id']), document)
+
+    def get(self, namespace, document_id):
+        document = self.documents.get(_document_key(namespace, document_id))
+
+        # The write path adds the foreign keys to the linked documents
+        return copy.deepcopy(document)
+
+    def __getitem__(self, db):
+        return _RecordedDatabase(self, db)
+
+
+class _RecordedDatabase(object):
+    def __init__(self, client, db):
+        self.client = client
+        self.db = db
+
+    def __getitem__(self, collection):
+        return _RecordedCollection(self.client, u'{0}.{1}'.format(self.db, collection))
+
+
+class _RecordedCollection(object):
+    def __init__(self, client, namespace):
+        self.client = client
+        self.namespace = namespace
+
+    def find_one(self, spec, projection=None):
+        return self.client.get(self.namespace, spec['_id'])
+
+    def find(self, spec, projection=None):
+        documents = (self.client.get(self.namespace, document_id) for document_id in spec['_id']['$in'])
+
+        return [document for document in documents if document is not None]
+
+
+class _Records(object):
+    """Iterates over the records of a recording, the documents of a bulk
+    upsert being read apart from the operations recorded meanwhile, which
+    are replayed after it. The documents of the records are added to mongo
+    as they are read from the file.
+    """
+
+    def __init__(self, path, mongo):
+        self.records = read_recording(path)
+        self.mongo = mongo
+        self.pending = deque()
+        self._bulk_namespaces = {}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pending:
+            return self.pending.popleft()
+
+        return self._read()
+
+    next = __next__
+
+    def _read(self):
+        record = next(self.records)
+        operation = record['op']
+
+        if operation in (UPSERT, FETCH):
+            self.mongo.add(record['ns'], record['doc'])
+
+        elif operation == BULK_UPSERT:
+            self._bulk_namespaces[record['bulk']] = record['ns']
+
+        elif operation == DOCUMENT:
+            self.mongo.add(self._bulk_namespaces[record['bulk']], record['doc'])
+
+        elif operation == END:
+            self._bulk_namespaces.pop(record['bulk'], None)
+
+        return record
+
+    def read_ahead(self, namespace, document_id):
+        """Reads up to LOOKAHEAD records until the document is fetched,
+        they are then replayed in order.
+        """
+        if self.mongo.has(namespace, document_id):
+            return
+
+        key = _document_key(namespace, document_id)
+
+        for _ in range(LOOKAHEAD):
+            try:
+                record = self._read()
+
+            except StopIteration:
+                return
+
+            self.pending.append(record)
+
+            if record['op'] == FETCH and _document_key(record['ns'], record['doc']['_id']) == key:
+                return
+
+    def bulk_documents(self, bulk, progress):
+        skipped = []
+
+        try:
+            for record in self:
+                if record.get('bulk') != bulk:
+                    skipped.append(record)
+
+                elif record['op'] == DOCUMENT:
+                    progress['documents'] += 1
+                    yield record['doc']
+
+                elif record['op'] == END:
+                    return
+
+        finally:
+            self.pending.extendleft(reversed(skipped))
+
+
+def _percentile(values, percentile):
+    # Nearest rank of sorted values
+    rank = int(math.ceil(percentile / 100.0 * len(values)))
+
+    return values[max(rank, 1) - 1]
+
+
+def replay(path, doc_manager):
+    """Replays the operations of a recording, returns the operation and
+    document counts, the throughput and the latency percentiles of the calls
+    in milliseconds. The time spent writing buffered operations at the end is
+    included in the throughput.
+    The client of the doc manager is replaced by the recorded documents.
+    """
+    doc_manager.client = RecordedMongo()
+    records = _Records(path, doc_manager.client)
+    latencies = []
+    counts = {}
+    progress = {'documents': 0}
+    started = time()
+
+    for record in records:
+        operation = record['op']
+
+        if operation in (FETCH, DOCUMENT, END):
+            continue
+
+        call_started = time()
+
+        if operation == UPSERT:
+            doc_manager.upsert(record['doc'], record['ns'], record['ts'])
+            progress['documents'] += 1
+
+        elif operation == UPDATE:
+            # Not timed, the document is read before the update is applied
+            records.read_ahead(record['ns'], record['id'])
+            call_started = time()
+            doc_manager.update(record['id'], record['spec'], record['ns'], record['ts'])
+
+        elif operation == REMOVE:
+            doc_manager.remove(record['id'], record['ns'], record['ts'])
+
+        elif operation == BULK_UPSERT:
+            doc_manager.bulk_upsert(records.bulk_documents(record['bulk'], progress), record['ns'], record['ts'])
+
+        else:
+            LOG.warning(u"Unknown recorded operation %s", operation)
+            continue
+
+        if operation != BULK_UPSERT:
+            latencies.append((time() - call_started) * 1000)
+
+        counts[operation] = counts.get(operation, 0) + 1
+
+    doc_manager.commit()
+    seconds = time() - started
+    latencies.sort()
+    operations = sum(count for operation, count in counts.items() if operation != BULK_UPSERT)
+
+    return {
+        'operations': counts,
+        'documents': progress['documents'],
+        'seconds': seconds,
+        'operations_per_second': operations / seconds if seconds else None,
+        'documents_per_second': progress['documents'] / seconds if seconds else None,
+        'latency_ms': dict(
+            [('p{0}'.format(percentile), _percentile(latencies, percentile)) for percentile in PERCENTILES] +
+            [('max', latencies[-1])]
+        ) if latencies else None
+    }
+
+
+def _get_rows_written(url):
+    import psycopg2
+    from mongo_connector.doc_managers.sql import sql_get_rows_written
+
+    connection = psycopg2.connect(url)
+
+    try:
+        with connection.cursor() as cursor:
+            return sql_get_rows_written(cursor)
+
+    finally:
+        connection.close()
+
+
+def run(path, mapping_file, url=None, options=None, drop=False):
+    """Replays a recording with a doc manager writing to url, or to a
+    temporary server started with testing.postgresql, and returns the
+    report of replay along with the rows written.
+    The doc manager recreates the mapped tables, so drop must be set to
+    replay against url.
+    """
+    from mongo_connector.doc_managers.postgresql_manager import DocManager
+
+    if url is not None and not drop:
+        raise InvalidConfiguration(
+            u"The mapped tables of {0} would be dropped, set drop to replay against it".format(url)
+        )
+
+    server = None
+
+    if url is None:
+        import testing.postgresql
+
+        server = testing.postgresql.Postgresql()
+        url = server.url()
+
+    try:
+        kwargs = dict(options or {}, mongoUrl='mongodb://localhost', mappingFile=mapping_file)
+        doc_manager = DocManager(url, **kwargs)
+        rows_written = _get_rows_written(url)
+
+        try:
+            report = replay(path, doc_manager)
+
+        finally:
+            doc_manager.stop()
+            # Statistics are reported when the connections are closed
+            doc_manager.main_pgsql.close()
+
+        sleep(STATS_DELAY)
+        report['rows_written'] = _get_rows_written(url) - rows_written
+
+        return report
+
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u"Replays the operations recorded with the recordFile option")
+    parser.add_argument('recording', help=u"file written with the recordFile option")
+    parser.add_argument('--mapping', default='mappings.json', help=u"mapping file")
+    parser.add_argument('--url', help=u"PostgreSQL URL, a temporary server is started when not set")
+    parser.add_argument('--drop', action='store_true', help=u"drop and recreate the mapped tables of --url")
+    parser.add_argument('--options', default='{}', help=u"JSON object of doc manager options")
+    args = parser.parse_args(argv)
+
+    if args.url is not None and not args.drop:
+        parser.error(u"the mapped tables of --url are dropped and recreated, pass --drop to confirm")
+
+    report = run(args.recording, args.mapping, args.url, json.loads(args.options), args.drop)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
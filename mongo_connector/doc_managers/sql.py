@@ -1,21 +1,29 @@
 # coding: utf8
 
-import unicodedata
-
+import base64
+import datetime
+import json
 import re
 import traceback
+import uuid
 from builtins import chr
+from collections import deque
 from future.utils import iteritems
 from past.builtins import long, basestring, unicode
 from psycopg2._psycopg import AsIs
 import psycopg2
+from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
 
 
 from mongo_connector.doc_managers.mappings import (
     get_mapped_document,
-    get_transformed_value,
-    get_transformed_document
+    get_transformed_documents
 )
+from mongo_connector.doc_managers.tracing import span
 
 from mongo_connector.doc_managers.utils import (
     extract_creation_date,
@@ -23,16 +31,30 @@ from mongo_connector.doc_managers.utils import (
     db_and_collection,
     get_array_of_scalar_fields,
     get_nested_field_from_document,
+    get_column_type,
+    is_linked_table_field,
     flatten_query_tree,
-    ARRAY_OF_SCALARS_TYPE,
-    ARRAY_TYPE,
+    COLLECTION_OPTIONS,
+    JSON_TYPES,
     LOG
 )
 
 
-all_chars = (chr(i) for i in range(0x10000))
-control_chars = ''.join(c for c in all_chars if unicodedata.category(c) == 'Cc')
+# Characters of the unicode category Cc (C0 controls, DEL and C1 controls), not
+# computed with unicodedata at import time as it requires scanning the whole BMP
+control_chars = u''.join(chr(i) for i in list(range(0x00, 0x20)) + list(range(0x7f, 0xa0)))
 control_char_re = re.compile('[%s]' % re.escape(control_chars))
+# Removes the control characters and escapes the quotes of a text in a single pass
+_text_translation = dict.fromkeys(ord(c) for c in control_chars)
+_text_translation[ord(u"'")] = u"''"
+# PostgreSQL rejects the NUL character in JSONB strings
+json_nul_re = re.compile(r'(?<!\\)((?:\\\\)*)\\u0000')
+
+CHECKPOINT_TABLE = u'_mongo_connector_checkpoints'
+# Oplog timestamp of the last write, stored in the tables of the replicated collections
+TIMESTAMP_COLUMN = u'_ts'
+# Rows inserted by a statement, beyond which linked documents go to a new one
+DEFAULT_MAX_STATEMENT_ROWS = 1000
 
 
 class ForeignKey(unicode):
@@ -43,6 +65,25 @@ class ForeignKey(unicode):
         return self
 
 
+class StatementBatch(object):
+    """Cursor-like object collecting the statements executed on it, to send
+    them to the server in a single round trip when flushed. Only suitable for
+    statements whose results are not read, such as DDL.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = []
+
+    def execute(self, sql):
+        self.statements.append(sql)
+
+    def flush(self):
+        if self.statements:
+            self.cursor.execute(u';\n'.join(self.statements))
+            self.statements = []
+
+
 def to_sql_list(items):
     return ' ({0}) '.format(','.join(items))
 
@@ -62,7 +103,8 @@ def sql_delete_rows(cursor, table):
 
 
 def sql_delete_rows_where(cursor, table, where_clause):
-    cursor.execute(u"DELETE FROM {0} WHERE {1}".format(table.lower(), where_clause))
+    with span(u'execute', table=table):
+        cursor.execute(u"DELETE FROM {0} WHERE {1}".format(table.lower(), where_clause))
 
 
 def sql_drop_table(cursor, tableName):
@@ -70,233 +112,615 @@ def sql_drop_table(cursor, tableName):
     cursor.execute(sql)
 
 
-def sql_create_table(cursor, tableName, columns):
+def sql_drop_tables(cursor, tables):
+    if tables:
+        sql = u"DROP TABLE IF EXISTS {0} CASCADE".format(
+            ', '.join(table.lower() for table in tables)
+        )
+        cursor.execute(sql)
+
+
+def sql_storage_parameters(storage):
+    """Returns the WITH clause setting the storage parameters of a table, or an
+    empty string.
+    """
+    if not storage:
+        return u''
+
+    parameters = []
+
+    for name, value in sorted(iteritems(storage)):
+        if isinstance(value, bool):
+            value = u'true' if value else u'false'
+
+        elif isinstance(value, basestring):
+            value = u"'{0}'".format(value.replace(u"'", u"''"))
+
+        parameters.append(u'{0}={1}'.format(name, value))
+
+    return u' WITH ({0})'.format(u', '.join(parameters))
+
+
+def sql_create_table(cursor, tableName, columns, partition_by=None, storage=None):
     columns.sort()
     sql = u"CREATE TABLE {0} {1}".format(tableName.lower(), to_sql_list(columns))
+
+    if partition_by is not None:
+        # Storage parameters only apply to the partitions
+        sql += u"PARTITION BY {0}".format(partition_by)
+
+    else:
+        sql += sql_storage_parameters(storage)
+
     cursor.execute(sql)
 
 
+def sql_create_hash_partitions(cursor, table, modulus, storage=None):
+    for remainder in range(modulus):
+        cursor.execute(
+            u"CREATE TABLE {0}_h{1} PARTITION OF {0} FOR VALUES WITH (MODULUS {2}, REMAINDER {1}){3}".format(
+                table.lower(),
+                remainder,
+                modulus,
+                sql_storage_parameters(storage)
+            )
+        )
+
+
+def sql_create_default_partition(cursor, table, storage=None):
+    cursor.execute(
+        u"CREATE TABLE IF NOT EXISTS {0}_default PARTITION OF {0} DEFAULT{1}".format(
+            table.lower(),
+            sql_storage_parameters(storage)
+        )
+    )
+
+
+def sql_create_range_partition(cursor, table, partition, start, end, storage=None):
+    cursor.execute(
+        u"CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ('{2}') TO ('{3}'){4}".format(
+            partition,
+            table.lower(),
+            start.isoformat(),
+            end.isoformat(),
+            sql_storage_parameters(storage)
+        )
+    )
+
+
+def sql_get_partitions(cursor, table):
+    cursor.execute(
+        u"SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        u"WHERE i.inhparent = '{0}'::regclass".format(table.lower())
+    )
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def sql_get_table_stats(cursor, tables):
+    """Returns the live and dead tuples of the tables, partitions being counted
+    in their table.
+    """
+    if not tables:
+        return {}
+
+    cursor.execute(
+        u"SELECT COALESCE(p.relname, s.relname), SUM(s.n_live_tup), SUM(s.n_dead_tup) "
+        u"FROM pg_stat_user_tables s "
+        u"LEFT JOIN pg_inherits i ON i.inhrelid = s.relid "
+        u"LEFT JOIN pg_class p ON p.oid = i.inhparent "
+        u"WHERE s.schemaname = 'public' AND COALESCE(p.relname, s.relname) IN ({0}) "
+        u"GROUP BY 1".format(u', '.join(u"'{0}'".format(table.lower()) for table in tables))
+    )
+
+    return dict((table, (int(live), int(dead))) for table, live, dead in cursor.fetchall())
+
+
+def sql_get_rows_written(cursor):
+    """Returns the rows inserted, updated and deleted in the mapped tables
+    since the statistics were reset, as counted by the statistics collector.
+    """
+    cursor.execute(
+        u"SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables "
+        u"WHERE schemaname = 'public' AND relname <> '{0}'".format(CHECKPOINT_TABLE)
+    )
+
+    return int(cursor.fetchone()[0])
+
+
 def sql_add_foreign_keys(cursor, foreign_keys):
     fmt = 'ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {}({}) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
 
     for foreign_key in foreign_keys:
+        fk = foreign_key['fk']
+        pk = foreign_key['pk']
+
+        # Rows of shared tables reference the parent row of their database
+        if foreign_key.get('discriminator') is not None:
+            fk = u'{0}, {1}'.format(foreign_key['discriminator'], fk)
+            pk = u'{0}, {1}'.format(foreign_key['discriminator'], pk)
+
         cmd = fmt.format(
             foreign_key['table'],
             '{0}_{1}_fk'.format(foreign_key['table'], foreign_key['fk']),
-            foreign_key['fk'],
+            fk,
             foreign_key['ref'],
-            foreign_key['pk']
+            pk
         )
         cursor.execute(cmd)
 
 
-def sql_bulk_insert(cursor, mappings, namespace, documents, quiet=False):
+def sql_create_checkpoint_table(cursor):
+    cursor.execute(
+        u"CREATE TABLE IF NOT EXISTS {0} (namespace TEXT CONSTRAINT {1}_PK PRIMARY KEY, last_id TEXT NOT NULL)".format(
+            CHECKPOINT_TABLE,
+            CHECKPOINT_TABLE.upper()
+        )
+    )
+
+
+def sql_get_checkpoints(cursor):
+    cursor.execute(u"SELECT namespace, last_id FROM {0}".format(CHECKPOINT_TABLE))
+
+    return {
+        namespace: json_util.loads(last_id)['_id']
+        for namespace, last_id in cursor.fetchall()
+    }
+
+
+def sql_set_checkpoint(cursor, namespace, last_id):
+    cursor.execute(
+        u"INSERT INTO {0} (namespace, last_id) VALUES ({1}, {2}) "
+        u"ON CONFLICT (namespace) DO UPDATE SET last_id = EXCLUDED.last_id".format(
+            CHECKPOINT_TABLE,
+            to_sql_value(namespace),
+            to_sql_value(json_util.dumps({'_id': last_id}))
+        )
+    )
+
+
+def sql_delete_checkpoint(cursor, namespace):
+    sql_delete_rows_where(
+        cursor,
+        CHECKPOINT_TABLE,
+        u"namespace = {0}".format(to_sql_value(namespace))
+    )
+
+
+def _sql_timestamped_tables_query(tables, where_clause, suffix=u''):
     queries = []
-    _sql_bulk_insert(queries, mappings, namespace, documents)
 
-    for querytree in queries:
-        query = flatten_query_tree([querytree])
+    for entry in tables:
+        namespace, table, id_column, discriminator = (tuple(entry) + (None,))[:4]
+        ns = to_sql_value(namespace)
+
+        if discriminator is not None:
+            # The database of the rows of a shared table is their discriminator
+            ns = u"{0} || {1}".format(discriminator, to_sql_value(u'.' + db_and_collection(namespace)[1]))
+
+        queries.append(u"(SELECT {0} AS ns, {1}::TEXT AS _id, {2} AS _ts FROM {3} WHERE {4}{5})".format(
+            ns,
+            id_column,
+            TIMESTAMP_COLUMN,
+            table.lower(),
+            where_clause,
+            suffix
+        ))
+
+    return u' UNION ALL '.join(queries)
+
+
+def sql_get_last_doc(cursor, tables):
+    """Returns the most recently written document of the given tables.
+    Tables are given as (namespace, table, id column[, discriminator]) tuples,
+    each of them is looked up through its timestamp index.
+    """
+    if not tables:
+        return None
+
+    cursor.execute(u"SELECT ns, _id, _ts FROM ({0}) AS last_docs ORDER BY _ts DESC LIMIT 1".format(
+        _sql_timestamped_tables_query(
+            tables,
+            u"{0} IS NOT NULL".format(TIMESTAMP_COLUMN),
+            u" ORDER BY {0} DESC LIMIT 1".format(TIMESTAMP_COLUMN)
+        )
+    ))
+    row = cursor.fetchone()
 
-        with_stmts = []
-        final_stmt = ''
+    if row is None:
+        return None
 
-        for subquery in query:
-            keyvals = dict(zip(subquery['keys'], subquery['values']))
-            foreign_keys = {}
-            values = {}
+    return {'ns': row[0], '_id': row[1], '_ts': row[2]}
 
-            for key in keyvals:
-                val = keyvals[key]
 
-                if isinstance(val, ForeignKey):
-                    foreign_keys[key] = val.split('.')[1]
+def sql_search(cursor, tables, start_ts, end_ts):
+    if not tables:
+        return
 
-                else:
-                    values[key] = val
+    cursor.execute(_sql_timestamped_tables_query(
+        tables,
+        u"{0} BETWEEN {1} AND {2}".format(
+            TIMESTAMP_COLUMN,
+            to_sql_value(start_ts),
+            to_sql_value(end_ts)
+        )
+    ))
 
-            foreign_keys_sorted = sorted(foreign_keys.keys())
-            values_sorted = sorted(values.keys())
+    for namespace, document_id, timestamp in cursor:
+        yield {'ns': namespace, '_id': document_id, '_ts': timestamp}
 
-            data_alias = '{0}_data_{1}'.format(
-                subquery['collection'],
-                subquery['idx']
-            )
-            rows_alias = '{0}_rows_{1}'.format(
-                subquery['collection'],
-                subquery['idx']
-            )
-            subquery['alias'] = {
-                'data': data_alias,
-                'rows': rows_alias
-            }
 
-            with_stmts.append(
-                '{alias} ({columns}) AS (VALUES ({values}))'.format(
-                    alias=data_alias,
-                    columns=', '.join(values_sorted),
-                    values=', '.join([values[key] for key in values_sorted])
-                )
+def sql_bulk_insert(cursor, mappings, namespace, documents, quiet=False, isolate_errors=False, dead_letters=None,
+                    timestamp=None, max_rows=DEFAULT_MAX_STATEMENT_ROWS, mapped_documents=None):
+    """Inserts the documents, returns the number of failed statements."""
+    return sql_execute_statements(
+        cursor,
+        sql_insert_statements(mappings, namespace, documents, timestamp, max_rows, mapped_documents),
+        quiet=quiet,
+        isolate_errors=isolate_errors,
+        dead_letters=dead_letters
+    )
+
+
+def sql_execute_statements(cursor, statements, quiet=False, isolate_errors=False, dead_letters=None):
+    """Executes the statements, returns the number of failed ones, which are
+    logged.
+    """
+    if isolate_errors:
+        return _sql_execute_isolated(cursor, list(statements), quiet, dead_letters)
+
+    failures = 0
+
+    for querytree, sql in statements:
+        try:
+            with span(u'execute', table=querytree['collection']):
+                cursor.execute(sql)
+
+        except psycopg2.Error as e:
+            failures += 1
+            _log_insert_error(querytree, e, sql, quiet)
+
+    return failures
+
+
+def sql_insert_statements(mappings, namespace, documents, timestamp=None, max_rows=DEFAULT_MAX_STATEMENT_ROWS,
+                          mapped_documents=None):
+    """Yields the (querytree, sql) insertion statements of the documents, the
+    querytree being the one of the root document of the statement.
+    A document whose linked tables hold more than max_rows rows is inserted
+    in several statements.
+    The documents are mapped and transformed as a batch, unless their mapped
+    documents are given, as returned by map_documents.
+    """
+    documents = list(documents)
+
+    if mapped_documents is None:
+        mapped_documents = map_documents(mappings, namespace, documents)
+
+    for document, mapped_document in zip(documents, mapped_documents):
+        for querytree, forest in _iter_document_forests(
+            mappings, namespace, document, timestamp, max_rows, mapped_document
+        ):
+            with span(u'render', ns=namespace):
+                sql = _sql_insert_statement(forest)
+
+            yield querytree, sql
+
+
+def _sql_insert_statement(forest):
+    query = flatten_query_tree(forest)
+
+    with_stmts = []
+    final_stmt = ''
+
+    for subquery in query:
+        keyvals = dict(zip(subquery['keys'], subquery['values']))
+        foreign_keys = {}
+        values = {}
+
+        for key in keyvals:
+            val = keyvals[key]
+
+            if isinstance(val, ForeignKey):
+                foreign_keys[key] = val.split('.')[1]
+
+            else:
+                values[key] = val
+
+        foreign_keys_sorted = sorted(foreign_keys.keys())
+        values_sorted = sorted(values.keys())
+
+        data_alias = '{0}_data_{1}'.format(
+            subquery['collection'],
+            subquery['idx']
+        )
+        rows_alias = '{0}_rows_{1}'.format(
+            subquery['collection'],
+            subquery['idx']
+        )
+        subquery['alias'] = {
+            'data': data_alias,
+            'rows': rows_alias
+        }
+
+        with_stmts.append(
+            '{alias} ({columns}) AS (VALUES ({values}))'.format(
+                alias=data_alias,
+                columns=', '.join(values_sorted),
+                values=', '.join([values[key] for key in values_sorted])
             )
+        )
 
-            keys = ', '.join(values_sorted + foreign_keys_sorted)
-            projection = [
-                '{0}.{1} AS {1}'.format(data_alias, key)
-                for key in values_sorted
-            ]
-            aliases = [data_alias]
+        keys = ', '.join(values_sorted + foreign_keys_sorted)
+        projection = [
+            '{0}.{1} AS {1}'.format(data_alias, key)
+            for key in values_sorted
+        ]
+        aliases = [data_alias]
 
-            if 'parent' in subquery:
-                psubquery = query[subquery['parent']]
-                parent_rows_alias = psubquery['alias']['rows']
+        if 'parent' in subquery:
+            psubquery = query[subquery['parent']]
+            parent_rows_alias = psubquery['alias']['rows']
 
-                projection += [
-                    '{0}.{1} AS {2}'.format(
-                        parent_rows_alias,
-                        foreign_keys[key],
-                        key
-                    )
-                    for key in foreign_keys_sorted
-                ]
-                aliases.append(parent_rows_alias)
-
-            projection = ', '.join(projection)
-            aliases = ', '.join(aliases)
-
-            if not subquery['last']:
-                with_stmts.append(
-                    '{alias} AS (INSERT INTO {table} ({columns}) SELECT {projection} FROM {aliases} RETURNING {pk})'.format(
-                        alias=rows_alias,
-                        table=subquery['collection'],
-                        columns=keys,
-                        projection=projection,
-                        aliases=aliases,
-                        pk=subquery['pk']
-                    )
+            projection += [
+                '{0}.{1} AS {2}'.format(
+                    parent_rows_alias,
+                    foreign_keys[key],
+                    key
                 )
+                for key in foreign_keys_sorted
+            ]
+            aliases.append(parent_rows_alias)
 
-            else:
-                final_stmt = 'INSERT INTO {table} ({columns}) SELECT {projection} FROM {aliases}'.format(
+        projection = ', '.join(projection)
+        aliases = ', '.join(aliases)
+
+        if not subquery['last']:
+            with_stmts.append(
+                '{alias} AS (INSERT INTO {table} ({columns}) SELECT {projection} FROM {aliases} RETURNING {pk})'.format(
+                    alias=rows_alias,
                     table=subquery['collection'],
                     columns=keys,
                     projection=projection,
-                    aliases=aliases
+                    aliases=aliases,
+                    pk=subquery['pk']
                 )
+            )
 
-        sql = 'WITH {0} {1}'.format(
-            ', '.join(with_stmts),
-            final_stmt
-        )
-
-        try:
-            cursor.execute(sql)
-
-        except psycopg2.Error as e:
-            LOG.error(
-                u"Impossible to upsert document %s in namespace %s: %s\n%s",
-                querytree['document']['mapped'][querytree['pk']],
-                querytree['collection'],
-                e,
-                sql
+        else:
+            final_stmt = 'INSERT INTO {table} ({columns}) SELECT {projection} FROM {aliases}'.format(
+                table=subquery['collection'],
+                columns=keys,
+                projection=projection,
+                aliases=aliases
             )
 
-            if not quiet:
-                LOG.error(u"Traceback:\n%s", traceback.format_exc())
+    sql = 'WITH {0} {1}'.format(
+        ', '.join(with_stmts),
+        final_stmt
+    )
 
+    return sql
 
-def _sql_bulk_insert(query, mappings, namespace, documents):
-    if not documents:
-        return
 
+def map_documents(mappings, namespace, documents):
+    """Returns the mapped documents of a namespace, their batch transforms
+    being called once per column. The other transforms are not applied to
+    the written rows.
+    """
     db, collection = db_and_collection(namespace)
 
-    primary_key = mappings[db][collection]['pk']
-    keys = [
-        (k, v['dest']) for k, v in iteritems(mappings[db][collection])
-        if 'dest' in v
-        and v['type'] not in [ARRAY_TYPE, ARRAY_OF_SCALARS_TYPE]
-    ]
-    keys.sort(key=lambda x: x[1])
-
-    for document in documents:
-        mapped_document = get_mapped_document(mappings, document, namespace)
-        values = [
-            to_sql_value(
-                extract_creation_date(mapped_document, primary_key),
-                vtype='TIMESTAMP'
-            )
-        ]
+    return get_transformed_documents(
+        mappings,
+        db,
+        collection,
+        [get_mapped_document(mappings, document, namespace) for document in documents],
+        batch_only=True
+    )
 
-        for key, mapkey in keys:
-            field_mapping = mappings[db][collection][key]
 
-            if mapkey in mapped_document:
-                values.append(
-                    to_sql_value(
-                        mapped_document[mapkey],
-                        vtype=field_mapping['type']
-                    )
-                )
+def _iter_document_forests(mappings, namespace, document, timestamp, max_rows, mapped_document=None):
+    """Yields the subqueries of a document and of its linked documents, split
+    in forests of about max_rows rows.
+    Rows whose primary key is generated are only known in their statement,
+    they come with all their linked rows. The other ones are expanded lazily,
+    their linked rows starting a new forest when the current one is full.
+    """
+    root = _sql_subquery(mappings, namespace, document, timestamp, mapped_document)
+    forest = [root]
+    rows = 1 + _expand_generated_key_subquery(mappings, root, namespace, document)
+    statement = 0
+    root['statement'] = statement
+    # Subqueries with a known primary key whose linked rows are not built yet
+    pending = deque()
+
+    if not _has_generated_key(root):
+        pending.append((root, namespace, document))
+
+    while pending:
+        parent, parent_namespace, parent_document = pending.popleft()
+
+        for linked_namespace, linked_document in _iter_linked_documents(
+            mappings, parent_namespace, parent_document, parent['document']['mapped']
+        ):
+            subquery = _sql_subquery(mappings, linked_namespace, linked_document)
+            size = 1 + _expand_generated_key_subquery(mappings, subquery, linked_namespace, linked_document)
+
+            if forest and rows + size > max_rows:
+                yield root, forest
+                forest = []
+                rows = 0
+                statement += 1
+
+            rows += size
+            subquery['statement'] = statement
+
+            if parent['statement'] == statement:
+                parent['queries'].append(subquery)
+
+            else:
+                # The foreign key is a value, the parent row is not needed
+                forest.append(subquery)
+
+            if not _has_generated_key(subquery):
+                pending.append((subquery, linked_namespace, linked_document))
+
+    if forest:
+        yield root, forest
+
+
+def _has_generated_key(subquery):
+    return subquery['pk'] not in subquery['document']['mapped']
+
+
+def _expand_generated_key_subquery(mappings, subquery, namespace, document):
+    """Adds the subqueries of all the linked documents to a subquery whose
+    primary key is generated, returns their count.
+    """
+    if not _has_generated_key(subquery):
+        return 0
+
+    count = 0
+    pending = [(subquery, namespace, document)]
+
+    while pending:
+        parent, parent_namespace, parent_document = pending.pop()
+
+        for linked_namespace, linked_document in _iter_linked_documents(
+            mappings, parent_namespace, parent_document, parent['document']['mapped']
+        ):
+            linked_subquery = _sql_subquery(mappings, linked_namespace, linked_document)
+            parent['queries'].append(linked_subquery)
+            pending.append((linked_subquery, linked_namespace, linked_document))
+            count += 1
+
+    return count
+
+
+def _sql_execute_isolated(cursor, statements, quiet=False, dead_letters=None):
+    """Executes the statements by batch under a savepoint.
+    When a batch fails, the savepoint is rolled back and the batch is split in
+    two halves until the failing documents are isolated. Those are logged and
+    sent to the dead letters, the others are kept in the current transaction.
+    The statements of a document are kept together, its linked rows would
+    otherwise violate their deferred foreign keys at commit.
+    Returns the number of failed statements.
+    """
+    documents = _group_statements_by_document(statements)
+    pending = [documents] if documents else []
+    failures = 0
+
+    while pending:
+        batch = pending.pop()
+        cursor.execute(u"SAVEPOINT bulk_insert")
+
+        try:
+            with span(u'execute', statements=sum(len(document) for document in batch)):
+                cursor.execute(u'; '.join(sql for document in batch for _, sql in document))
+
+        except psycopg2.Error as e:
+            cursor.execute(u"ROLLBACK TO SAVEPOINT bulk_insert; RELEASE SAVEPOINT bulk_insert")
+
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                pending.append(batch[middle:])
+                pending.append(batch[:middle])
 
             else:
-                values.append(
-                    to_sql_value(
-                        None,
-                        vtype=field_mapping['type']
+                failures += len(batch[0])
+                querytree = batch[0][0][0]
+                sql = u'; '.join(sql for _, sql in batch[0])
+                _log_insert_error(querytree, e, sql, quiet)
+
+                if dead_letters is not None:
+                    dead_letters.write(
+                        querytree['namespace'],
+                        querytree['document']['raw'],
+                        e,
+                        sql
                     )
-                )
 
-        subquery = {
-            'collection': collection,
-            'document': {
-                'raw': document,
-                'mapped': mapped_document
-            },
-            'keys': ['_creationDate'] + [k[1] for k in keys],
-            'values': values,
-            'pk': primary_key,
-            'queries': []
-        }
-        query.append(subquery)
-
-        insert_document_arrays(
-            collection,
-            subquery['queries'],
-            db,
-            document,
-            mapped_document,
-            mappings,
-            primary_key
-        )
-        insert_scalar_arrays(
-            collection,
-            subquery['queries'],
-            db,
-            document,
-            mapped_document,
-            mappings,
-            primary_key
-        )
+        else:
+            cursor.execute(u"RELEASE SAVEPOINT bulk_insert")
 
-def insert_scalar_arrays(collection, query, db, document, mapped_document, mappings, primary_key):
-    pk = mapped_document.get(
-        primary_key,
-        ForeignKey('{0}.{1}'.format(collection, primary_key))
-    )
+    return failures
 
-    for arrayField in get_array_of_scalar_fields(mappings, db, collection, document):
-        dest = mappings[db][collection][arrayField]['dest']
-        fk = mappings[db][collection][arrayField]['fk']
-        value_field = mappings[db][collection][arrayField]['valueField']
-        scalar_values = get_nested_field_from_document(document, arrayField)
 
-        linked_documents = []
-        for value in scalar_values:
-            linked_documents.append({fk: pk, value_field: value})
+def _group_statements_by_document(statements):
+    """Returns the lists of the consecutive statements of each root document,
+    which share its querytree.
+    """
+    documents = []
+
+    for querytree, sql in statements:
+        if documents and documents[-1][0][0] is querytree:
+            documents[-1].append((querytree, sql))
+
+        else:
+            documents.append([(querytree, sql)])
+
+    return documents
+
+
+def _log_insert_error(querytree, error, sql, quiet=False):
+    LOG.error(
+        u"Impossible to upsert document %s in namespace %s: %s\n%s",
+        querytree['document']['mapped'].get(querytree['pk']),
+        querytree['collection'],
+        error,
+        sql
+    )
+
+    if not quiet:
+        LOG.error(u"Traceback:\n%s", traceback.format_exc())
 
-        _sql_bulk_insert(query, mappings, "{0}.{1}".format(db, dest), linked_documents)
 
+def _sql_subquery(mappings, namespace, document, timestamp=None, mapped_document=None):
+    db, collection = db_and_collection(namespace)
 
-def insert_document_arrays(collection, query, db, document, mapped_document, mappings, primary_key):
+    primary_key = mappings[db][collection]['pk']
+    columns = get_columns(mappings, db, collection)
+
+    if mapped_document is None:
+        # Linked documents are mapped along with the rows of their parent
+        mapped_document = map_documents(mappings, namespace, [document])[0]
+    values = [get_encoder('TIMESTAMP')(extract_creation_date(mapped_document, primary_key))]
+
+    for _, mapkey, encode in columns:
+        values.append(encode(mapped_document.get(mapkey)))
+
+    subquery = {
+        'namespace': namespace,
+        'collection': collection,
+        'document': {
+            'raw': document,
+            'mapped': mapped_document
+        },
+        'keys': ['_creationDate'] + [column[1] for column in columns],
+        'values': values,
+        'pk': primary_key,
+        'queries': []
+    }
+
+    if timestamp is not None:
+        subquery['keys'].append(TIMESTAMP_COLUMN)
+        subquery['values'].append(get_encoder('BIGINT')(timestamp))
+
+    discriminator = mappings[db][collection].get('discriminator')
+
+    if discriminator is not None:
+        subquery['keys'].append(discriminator)
+        subquery['values'].append(get_encoder('TEXT')(db))
+
+    return subquery
+
+
+def _iter_linked_documents(mappings, namespace, document, mapped_document):
+    """Yields the (namespace, document) linked documents of a document, with
+    their foreign key set.
+    """
+    db, collection = db_and_collection(namespace)
+    primary_key = mappings[db][collection]['pk']
     pk = mapped_document.get(
         primary_key,
         ForeignKey('{0}.{1}'.format(collection, primary_key))
@@ -305,12 +729,20 @@ def insert_document_arrays(collection, query, db, document, mapped_document, map
     for arrayField in get_array_fields(mappings, db, collection, document):
         dest = mappings[db][collection][arrayField]['dest']
         fk = mappings[db][collection][arrayField]['fk']
-        linked_documents = get_nested_field_from_document(document, arrayField)
+        linked_namespace = "{0}.{1}".format(db, dest)
 
-        for linked_document in linked_documents:
+        for linked_document in get_nested_field_from_document(document, arrayField):
             linked_document[fk] = pk
+            yield linked_namespace, linked_document
+
+    for arrayField in get_array_of_scalar_fields(mappings, db, collection, document):
+        dest = mappings[db][collection][arrayField]['dest']
+        fk = mappings[db][collection][arrayField]['fk']
+        value_field = mappings[db][collection][arrayField]['valueField']
+        linked_namespace = "{0}.{1}".format(db, dest)
 
-        _sql_bulk_insert(query, mappings, "{0}.{1}".format(db, dest), linked_documents)
+        for value in get_nested_field_from_document(document, arrayField):
+            yield linked_namespace, {fk: pk, value_field: value}
 
 
 def get_document_keys(document):
@@ -324,36 +756,253 @@ def remove_control_chars(s):
     return control_char_re.sub('', s)
 
 
-def to_sql_value(value, vtype=None):
-    result = None
+def _json_default(value):
+    if isinstance(value, (ObjectId, uuid.UUID)):
+        return str(value)
+
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    elif isinstance(value, Decimal128):
+        return str(value.to_decimal())
+
+    elif isinstance(value, Timestamp):
+        return {'t': value.time, 'i': value.inc}
+
+    elif isinstance(value, (Binary, bytes)):
+        return base64.b64encode(value).decode('ascii')
+
+    return json_util.default(value)
 
+
+def to_json(value):
+    result = json.dumps(
+        value,
+        default=_json_default,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+
+    if u'\\u0000' in result:
+        result = json_nul_re.sub(r'\1', result)
+
+    return result
+
+
+def _to_sql_literal(value):
     if value is None:
-        result = 'NULL'
+        return 'NULL'
 
     elif isinstance(value, (int, long, float, complex)):
-        result = str(value)
-
-    elif isinstance(value, bool):
-        result = str(value).upper()
+        return str(value)
 
     elif isinstance(value, ForeignKey):
-        result = value
+        return value
 
     elif isinstance(value, basestring):
-        result = u"'{0}'".format(
+        return u"'{0}'".format(
             remove_control_chars(value).replace("'", "''")
         )
 
-    else:
-        result = u"'{0}'".format(str(value))
+    elif isinstance(value, (list, tuple)):
+        return u"ARRAY[{0}]".format(
+            ', '.join(_to_sql_literal(item) for item in value)
+        )
 
-    if vtype is not None and not isinstance(result, ForeignKey):
-        if 'SERIAL' in vtype:
-            vtype = vtype.replace('SERIAL', 'INT')
+    return u"'{0}'".format(str(value))
 
-        result = u"{0}::{1}".format(result, vtype)
 
-    return result
+def _encode_generic(value, cast):
+    result = _to_sql_literal(value)
+
+    # Foreign keys are projected from the parent rows, they are not values
+    if isinstance(result, ForeignKey):
+        return result
+
+    return result + cast
+
+
+def _generic_encoder(cast):
+    def encode(value):
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _int_encoder(cast):
+    null = u'NULL' + cast
+
+    def encode(value):
+        if value.__class__ in _INT_CLASSES:
+            return str(value) + cast
+
+        elif value is None:
+            return null
+
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _float_encoder(cast):
+    null = u'NULL' + cast
+
+    def encode(value):
+        if value.__class__ in _NUMBER_CLASSES:
+            return str(value) + cast
+
+        elif value is None:
+            return null
+
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _bool_encoder(cast):
+    null = u'NULL' + cast
+    true = u'TRUE' + cast
+    false = u'FALSE' + cast
+
+    def encode(value):
+        if value is True:
+            return true
+
+        elif value is False:
+            return false
+
+        elif value is None:
+            return null
+
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _text_encoder(cast):
+    null = u'NULL' + cast
+
+    def encode(value):
+        if value.__class__ is unicode:
+            return u"'" + value.translate(_text_translation) + u"'" + cast
+
+        elif value is None:
+            return null
+
+        elif value.__class__ is ObjectId:
+            return u"'" + str(value) + u"'" + cast
+
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _timestamp_encoder(cast):
+    null = u'NULL' + cast
+
+    def encode(value):
+        if value.__class__ in _DATE_CLASSES:
+            return u"'" + str(value) + u"'" + cast
+
+        elif value is None:
+            return null
+
+        return _encode_generic(value, cast)
+
+    return encode
+
+
+def _json_encoder(cast):
+    null = u'NULL' + cast
+
+    def encode(value):
+        if value is None:
+            return null
+
+        return u"'" + to_json(value).replace(u"'", u"''") + u"'" + cast
+
+    return encode
+
+
+_INT_CLASSES = (int, long)
+_NUMBER_CLASSES = (int, long, float)
+_DATE_CLASSES = (datetime.datetime, datetime.date, datetime.time)
+
+# Encoder factories by declared SQL type, called with the cast to append
+ENCODER_FACTORIES = {}
+
+for _vtype in ('SMALLINT', 'INTEGER', 'INT', 'BIGINT', 'SERIAL', 'BIGSERIAL'):
+    ENCODER_FACTORIES[_vtype] = _int_encoder
+
+for _vtype in ('DECIMAL', 'NUMERIC', 'REAL', 'DOUBLE PRECISION'):
+    ENCODER_FACTORIES[_vtype] = _float_encoder
+
+for _vtype in ('CHARACTER VARYING', 'VARCHAR', 'CHARACTER', 'CHAR', 'TEXT', 'UUID'):
+    ENCODER_FACTORIES[_vtype] = _text_encoder
+
+for _vtype in ('TIMESTAMP', 'DATE', 'TIME'):
+    ENCODER_FACTORIES[_vtype] = _timestamp_encoder
+
+for _vtype in JSON_TYPES:
+    ENCODER_FACTORIES[_vtype] = _json_encoder
+
+ENCODER_FACTORIES['BOOLEAN'] = _bool_encoder
+
+_encoders = {}
+_columns = {}
+
+
+def register_encoder(vtype, factory):
+    """Registers the encoder factory of a SQL type. The factory is called with
+    the cast to append (e.g. '::INT') and returns a function rendering a value
+    as a SQL literal of this type.
+    """
+    ENCODER_FACTORIES[vtype] = factory
+    _encoders.clear()
+    _columns.clear()
+
+
+def get_encoder(vtype):
+    encoder = _encoders.get(vtype)
+
+    if encoder is None:
+        cast = u'::{0}'.format(vtype.replace('SERIAL', 'INT'))
+        factory = ENCODER_FACTORIES.get(vtype, _generic_encoder)
+        encoder = _encoders[vtype] = factory(cast)
+
+    return encoder
+
+
+def get_columns(mappings, db, collection):
+    """Returns the (field, column, encoder) tuples of the columns of a mapped
+    collection, sorted by column name.
+    Mappings are not expected to change once loaded, the columns are computed
+    once for each collection mapping.
+    """
+    collection_mapping = mappings[db][collection]
+    cached = _columns.get((db, collection))
+
+    if cached is not None and cached[0] is collection_mapping:
+        return cached[1]
+
+    columns = [
+        (field, field_mapping['dest'], get_encoder(get_column_type(field_mapping)))
+        for field, field_mapping in iteritems(collection_mapping)
+        if field not in COLLECTION_OPTIONS
+        and 'dest' in field_mapping
+        and not is_linked_table_field(field_mapping)
+    ]
+    columns.sort(key=lambda column: column[1])
+    _columns[(db, collection)] = (collection_mapping, columns)
+
+    return columns
+
+
+def to_sql_value(value, vtype=None):
+    if vtype is None:
+        return _to_sql_literal(value)
+
+    return get_encoder(vtype)(value)
 
 
 def object_id_adapter(object_id):
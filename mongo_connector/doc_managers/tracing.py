@@ -0,0 +1,137 @@
+# coding: utf8
+
+import io
+import json
+import os
+import random
+import threading
+from time import time
+
+
+DEFAULT_SAMPLE_RATE = 0.01
+
+# Tracer of the process, set by configure
+_tracer = None
+
+
+class _NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, args, root):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.root = root
+        self.start = None
+
+    def __enter__(self):
+        if self.root:
+            self.tracer.local.sampled = True
+
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time()
+
+        if self.root:
+            self.tracer.local.sampled = False
+
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        self.tracer.write(self.name, self.start, end, self.args)
+        return False
+
+
+class Tracer(object):
+    """Writes the spans of the sampled operations to a file in the Chrome
+    trace event format, which can be opened with chrome://tracing or Perfetto.
+    The file holds a JSON array of complete events, one per line, which is
+    left open so that an interrupted trace stays readable.
+    """
+
+    def __init__(self, path, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.local = threading.local()
+        self.pid = os.getpid()
+        self._file = io.open(path, 'w', encoding='utf8')
+        self._file.write(u'[\n')
+        self._lock = threading.Lock()
+
+    def trace(self, name, args):
+        """Returns the span of an operation, which is recorded along with its
+        nested spans for a sample of the operations.
+        """
+        if getattr(self.local, 'sampled', False):
+            return _Span(self, name, args, False)
+
+        if random.random() >= self.sample_rate:
+            return _NOOP_SPAN
+
+        return _Span(self, name, args, True)
+
+    def span(self, name, args):
+        if not getattr(self.local, 'sampled', False):
+            return _NOOP_SPAN
+
+        return _Span(self, name, args, False)
+
+    def write(self, name, start, end, args):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': int(start * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': args
+        }
+        line = json.dumps(event, default=repr)
+
+        with self._lock:
+            if self._file is not None:
+                self._file.write(u'{0},\n'.format(line))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+
+def configure(path, sample_rate=DEFAULT_SAMPLE_RATE):
+    """Enables tracing, or disables it when path is None."""
+    global _tracer
+
+    if _tracer is not None:
+        _tracer.close()
+
+    _tracer = Tracer(path, sample_rate) if path else None
+
+
+def trace(name, **args):
+    """Returns the span of an operation, which starts a trace when sampled."""
+    if _tracer is None:
+        return _NOOP_SPAN
+
+    return _tracer.trace(name, args)
+
+
+def span(name, **args):
+    """Returns a span nested in the trace of the current operation, which is
+    only recorded when the operation is sampled.
+    """
+    if _tracer is None:
+        return _NOOP_SPAN
+
+    return _tracer.span(name, args)
@@ -0,0 +1,125 @@
+# coding: utf8
+
+from collections import OrderedDict
+
+from mongo_connector.doc_managers.utils import LRUCache
+
+
+_MISSING = object()
+
+
+def _cache_key(value):
+    """Returns the cache key of a value, or None when it is unhashable.
+    The type is part of the key, 1, 1.0 and True being equal.
+    """
+    key = (type(value), value)
+
+    try:
+        hash(key)
+
+    except TypeError:
+        return None
+
+    return key
+
+
+class MemoizedTransform(object):
+    """Transform of a field keeping the results of its most recently seen
+    values, for pure transforms of low cardinality inputs. Unhashable values
+    are transformed without the cache.
+    A batch transform is only called with the distinct values missing from
+    the cache.
+    """
+
+    def __init__(self, transform, maxsize, batch=False):
+        self.transform = transform
+        self.batch = batch
+        self.cache = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def __call__(self, value):
+        if self.batch:
+            return self._transform_column(value)
+
+        key = _cache_key(value)
+
+        if key is None:
+            self.bypassed += 1
+            return self.transform(value)
+
+        result = self.cache.get(key, _MISSING)
+
+        if result is not _MISSING:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self.transform(value)
+        self.cache.put(key, result)
+
+        return result
+
+    def _transform_column(self, values):
+        values = list(values)
+        results = [None] * len(values)
+        # Indexes of the values missing from the cache, by key
+        missing = OrderedDict()
+        unhashable = []
+
+        for i, value in enumerate(values):
+            key = _cache_key(value)
+
+            if key is None:
+                unhashable.append(i)
+                continue
+
+            result = self.cache.get(key, _MISSING)
+
+            if result is _MISSING:
+                missing.setdefault(key, []).append(i)
+
+            else:
+                self.hits += 1
+                results[i] = result
+
+        computed = [indexes[0] for indexes in missing.values()] + unhashable
+
+        if not computed:
+            return results
+
+        transformed = list(self.transform([values[i] for i in computed]))
+
+        if len(transformed) != len(computed):
+            raise ValueError(u'Batch transform returned {0} values instead of {1}'.format(
+                len(transformed),
+                len(computed)
+            ))
+
+        for i, result in zip(computed, transformed):
+            results[i] = result
+
+        for key, indexes in missing.items():
+            result = results[indexes[0]]
+            self.cache.put(key, result)
+            self.misses += 1
+            self.hits += len(indexes) - 1
+
+            for i in indexes[1:]:
+                results[i] = result
+
+        self.bypassed += len(unhashable)
+
+        return results
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_ratio': float(self.hits) / lookups if lookups else None
+        }
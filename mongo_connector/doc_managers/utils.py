@@ -2,12 +2,74 @@
 
 from bson.objectid import ObjectId
 from future.utils import iteritems
+from collections import OrderedDict
+from datetime import date, timedelta
 import logging
+import threading
 
 
 LOG = logging.getLogger(__name__)
 ARRAY_TYPE = u'_ARRAY'
 ARRAY_OF_SCALARS_TYPE = u'_ARRAY_OF_SCALARS'
+JSON_TYPES = (u'JSON', u'JSONB')
+# Mapping key of the column storing every field not mapped elsewhere
+UNMAPPED_FIELD = u'*'
+# Collection mapping keys which are settings rather than fields
+COLLECTION_OPTIONS = (u'pk', u'indices', u'partition', u'bookkeepingIndexes', u'storage', u'discriminator')
+PARTITION_INTERVALS = (u'day', u'week', u'month', u'year')
+
+
+class LRUCache(object):
+    """Thread safe mapping keeping its most recently used entries, up to
+    maxsize.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+
+            except KeyError:
+                return default
+
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Stores an entry, returns the (key, value) entry it evicted if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+
+            if len(self._entries) > self.maxsize:
+                return self._entries.popitem(last=False)
+
+        return None
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self, predicate=None):
+        """Removes every entry, or the ones whose key matches the predicate."""
+        with self._lock:
+            if predicate is None:
+                self._entries.clear()
+                return
+
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
 
 
 def extract_creation_date(document, primary_key):
@@ -37,7 +99,10 @@ def get_array_fields(mappings, db, collection, document):
 
 
 def get_array_of_scalar_fields(mappings, db, collection, document):
-    return get_fields_of_type(mappings, db, collection, document, ARRAY_OF_SCALARS_TYPE)
+    return [
+        k for k in get_fields_of_type(mappings, db, collection, document, ARRAY_OF_SCALARS_TYPE)
+        if not is_native_array_field(mappings[db][collection][k])
+    ]
 
 
 def get_any_array_fields(mappings, db, collection, document):
@@ -51,7 +116,8 @@ def get_fields_of_type(mappings, db, collection, document, type):
 
     return [
         k for k, v in iteritems(mappings[db][collection])
-        if get_nested_field_from_document(document, k) and 'type' in v and v['type'] == type
+        if k not in COLLECTION_OPTIONS and get_nested_field_from_document(document, k) and 'type' in v and
+        v['type'] == type
         ]
 
 
@@ -62,6 +128,53 @@ def is_array_field(mappings, db, collection, field):
     return mappings[db][collection][field]['type'] == ARRAY_TYPE
 
 
+def is_native_array_field(field_mapping):
+    return field_mapping.get('type') == ARRAY_OF_SCALARS_TYPE and 'valueType' in field_mapping
+
+
+def is_linked_table_field(field_mapping):
+    return field_mapping.get('type') in (ARRAY_TYPE, ARRAY_OF_SCALARS_TYPE) \
+        and not is_native_array_field(field_mapping)
+
+
+def get_column_type(field_mapping):
+    if is_native_array_field(field_mapping):
+        return u'{0}[]'.format(field_mapping['valueType'])
+
+    return field_mapping['type']
+
+
+def get_period_start(interval, day):
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+
+    elif interval == 'month':
+        return day.replace(day=1)
+
+    elif interval == 'year':
+        return day.replace(month=1, day=1)
+
+    return day
+
+
+def shift_period(interval, start, count):
+    if interval == 'week':
+        return start + timedelta(weeks=count)
+
+    elif interval == 'month':
+        years, month = divmod(start.month - 1 + count, 12)
+        return date(start.year + years, month + 1, 1)
+
+    elif interval == 'year':
+        return start.replace(year=start.year + count)
+
+    return start + timedelta(days=count)
+
+
+def get_partition_name(table, start):
+    return u'{0}_p{1}'.format(table.lower(), start.strftime('%Y%m%d'))
+
+
 def map_value_to_pgsql(value):
     return value if not isinstance(value, ObjectId) else str(value)
 
@@ -95,28 +208,24 @@ def get_nested_field_from_document(document, dot_notation_key):
 
 
 def flatten_query_tree(query, i=0):
-    if not query:
-        return []
-
+    """Returns the subqueries of the query tree in depth-first order, with their
+    index and the one of their parent.
+    """
     result = []
+    stack = list(reversed(query))
 
-    for subquery in query:
-        subquery['idx'] = i
+    while stack:
+        subquery = stack.pop()
+        subquery['idx'] = i + len(result)
+        subquery['last'] = False
+        result.append(subquery)
 
         for child in subquery['queries']:
             child['parent'] = subquery['idx']
 
-        local_result = flatten_query_tree(subquery['queries'], i + 1)
-
-        result.append(subquery)
-        result += local_result
-        i += len(local_result) + 1
-
-
-    for subquery in result:
-        subquery['last'] = False
+        stack.extend(reversed(subquery['queries']))
 
-    if len(result):
+    if result:
         result[-1]['last'] = True
 
     return result
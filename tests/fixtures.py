@@ -119,13 +119,14 @@ TEST_PGMAN_UPDATE = ' '.join([
     line.strip(' ')
     for line in """
         WITH
-            col_data_0 (_creationDate, _id, field1) AS
-                (VALUES (NULL::TIMESTAMP, 1::INT, 'val1'::TEXT)),
+            col_data_0 (_creationDate, _id, _ts, field1) AS
+                (VALUES (NULL::TIMESTAMP, 1::INT, 1::BIGINT, 'val1'::TEXT)),
             col_rows_0 AS
-                (INSERT INTO col (_creationDate, _id, field1)
+                (INSERT INTO col (_creationDate, _id, _ts, field1)
                 SELECT
                     col_data_0._creationDate AS _creationDate,
                     col_data_0._id AS _id,
+                    col_data_0._ts AS _ts,
                     col_data_0.field1 AS field1
                 FROM col_data_0
                 RETURNING _id),
@@ -148,13 +149,14 @@ TEST_PGMAN_BULK_UPSERT_1 = ' '.join([
     line.strip(' ')
     for line in """
         WITH
-            col_data_0 (_creationDate, _id, field1) AS
-                (VALUES (NULL::TIMESTAMP, 1::INT, 'val1'::TEXT)),
+            col_data_0 (_creationDate, _id, _ts, field1) AS
+                (VALUES (NULL::TIMESTAMP, 1::INT, 1::BIGINT, 'val1'::TEXT)),
             col_rows_0 AS
-                (INSERT INTO col (_creationDate, _id, field1)
+                (INSERT INTO col (_creationDate, _id, _ts, field1)
                 SELECT
                     col_data_0._creationDate AS _creationDate,
                     col_data_0._id AS _id,
+                    col_data_0._ts AS _ts,
                     col_data_0.field1 AS field1
                 FROM col_data_0
                 RETURNING _id),
@@ -177,13 +179,14 @@ TEST_PGMAN_BULK_UPSERT_2 = ' '.join([
     line.strip(' ')
     for line in """
         WITH
-            col_data_0 (_creationDate, _id, field1) AS
-                (VALUES (NULL::TIMESTAMP, 2::INT, 'val2'::TEXT)),
+            col_data_0 (_creationDate, _id, _ts, field1) AS
+                (VALUES (NULL::TIMESTAMP, 2::INT, 1::BIGINT, 'val2'::TEXT)),
             col_rows_0 AS
-                (INSERT INTO col (_creationDate, _id, field1)
+                (INSERT INTO col (_creationDate, _id, _ts, field1)
                 SELECT
                     col_data_0._creationDate AS _creationDate,
                     col_data_0._id AS _id,
+                    col_data_0._ts AS _ts,
                     col_data_0.field1 AS field1
                 FROM col_data_0
                 RETURNING _id),
@@ -206,13 +209,14 @@ TEST_PGMAN_BULK_UPSERT_3 = ' '.join([
     line.strip(' ')
     for line in """
         WITH
-            col_data_0 (_creationDate, _id, field1) AS
-                (VALUES (NULL::TIMESTAMP, 3::INT, 'val3'::TEXT)),
+            col_data_0 (_creationDate, _id, _ts, field1) AS
+                (VALUES (NULL::TIMESTAMP, 3::INT, 1::BIGINT, 'val3'::TEXT)),
             col_rows_0 AS
-                (INSERT INTO col (_creationDate, _id, field1)
+                (INSERT INTO col (_creationDate, _id, _ts, field1)
                 SELECT
                     col_data_0._creationDate AS _creationDate,
                     col_data_0._id AS _id,
+                    col_data_0._ts AS _ts,
                     col_data_0.field1 AS field1
                 FROM col_data_0
                 RETURNING _id),
@@ -235,13 +239,14 @@ TEST_PGMAN_UPSERT = ' '.join([
     line.strip(' ')
     for line in """
         WITH
-            col_data_0 (_creationDate, _id, field1) AS
-                (VALUES (NULL::TIMESTAMP, 1::INT, 'val1'::TEXT)),
+            col_data_0 (_creationDate, _id, _ts, field1) AS
+                (VALUES (NULL::TIMESTAMP, 1::INT, 1::BIGINT, 'val1'::TEXT)),
             col_rows_0 AS
-                (INSERT INTO col (_creationDate, _id, field1)
+                (INSERT INTO col (_creationDate, _id, _ts, field1)
                 SELECT
                     col_data_0._creationDate AS _creationDate,
                     col_data_0._id AS _id,
+                    col_data_0._ts AS _ts,
                     col_data_0.field1 AS field1
                 FROM col_data_0
                 RETURNING _id),
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import threading
+
+from mongo_connector.doc_managers.apply_lanes import ApplyLanes
+
+
+class TestApplyLanes(TestCase):
+    def test_document_order(self):
+        applied = {}
+        threads = {}
+        lock = threading.Lock()
+
+        def apply(namespace, document_id, value):
+            with lock:
+                applied.setdefault(document_id, []).append(value)
+                threads.setdefault(document_id, set()).add(threading.current_thread().name)
+
+        lanes = ApplyLanes(4, apply)
+
+        for value in range(50):
+            for document_id in range(10):
+                lanes.submit('db.col', document_id, value)
+
+        lanes.join()
+
+        try:
+            for document_id in range(10):
+                self.assertEqual(applied[document_id], list(range(50)))
+                self.assertEqual(len(threads[document_id]), 1)
+
+        finally:
+            lanes.close()
+
+    def test_submit_to(self):
+        threads = {}
+
+        def apply(namespace, document_id):
+            threads[document_id] = threading.current_thread().name
+
+        lanes = ApplyLanes(3, apply)
+        self.assertEqual(len(lanes), 3)
+
+        for document_id in range(10):
+            lanes.submit('db.col', document_id)
+            lanes.submit_to(lanes.lane('db.col', document_id), 'db.col', str(document_id))
+
+        lanes.join()
+        lanes.close()
+
+        for document_id in range(10):
+            self.assertEqual(threads[document_id], threads[str(document_id)])
+
+    def test_initializer_and_errors(self):
+        local = threading.local()
+        connections = []
+        applied = []
+
+        def initializer():
+            local.connection = len(connections)
+            connections.append(local.connection)
+
+        def apply(namespace, document_id):
+            if document_id == 'bad':
+                raise ValueError(document_id)
+
+            applied.append(local.connection)
+
+        lanes = ApplyLanes(2, apply, initializer=initializer)
+        lanes.submit('db.col', 'bad')
+        lanes.submit('db.col', {'unhashable': True})
+        lanes.submit('db.col', 1)
+        lanes.join()
+        lanes.close()
+
+        self.assertEqual(sorted(connections), [0, 1])
+        self.assertEqual(len(applied), 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import os
+import shutil
+import tempfile
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+from mongo_connector.doc_managers.dead_letters import DeadLetterFile
+
+
+class TestDeadLetterFile(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'dead_letters.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write(self):
+        dead_letters = DeadLetterFile(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+        oid = ObjectId()
+        dead_letters.write('db.col', {'_id': oid}, ValueError('boom\n'), 'SELECT 1')
+        dead_letters.write('db.col', {'_id': 2}, ValueError('bang'), 'SELECT 2')
+        dead_letters.close()
+
+        with open(self.path) as dead_letters_file:
+            lines = [json_util.loads(line) for line in dead_letters_file]
+
+        self.assertEqual(lines, [
+            {'ns': 'db.col', 'document': {'_id': oid}, 'error': 'boom', 'sql': 'SELECT 1'},
+            {'ns': 'db.col', 'document': {'_id': 2}, 'error': 'bang', 'sql': 'SELECT 2'}
+        ])
+
+
+if __name__ == '__main__':
+    main()
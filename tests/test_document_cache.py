@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import os
+import shutil
+import tempfile
+
+from mongo_connector.doc_managers.document_cache import (
+    DocumentCache,
+    UnsupportedUpdate,
+    apply_update_spec
+)
+
+
+MAPPING = {
+    'db': {
+        'col': {
+            'pk': '_id',
+            '_id': {'dest': '_id', 'type': 'INT'},
+            'a.b': {'dest': 'ab', 'type': 'INT'},
+            'items': {'dest': 'col_items', 'type': '_ARRAY', 'fk': 'id_col'}
+        },
+        'col_items': {
+            'pk': '_id',
+            'id_col': {'dest': 'id_col', 'type': 'INT'},
+            'value': {'dest': 'value', 'type': 'INT'}
+        }
+    }
+}
+
+
+class TestApplyUpdateSpec(TestCase):
+    def test_operators(self):
+        document = {'a': {'b': 1}, 'items': [{'value': 1}, {'value': 2}], 'n': 2}
+
+        apply_update_spec(document, {
+            '$v': 1,
+            '$set': {'a.c.d': 'x', 'items.1.value': 3},
+            '$unset': {'a.b': True, 'missing.field': True},
+            '$inc': {'n': 1, 'm': 5},
+            '$mul': {'p': 2},
+            '$min': {'n': 1},
+            '$max': {'q': 4}
+        })
+
+        self.assertEqual(document, {
+            'a': {'c': {'d': 'x'}},
+            'items': [{'value': 1}, {'value': 3}],
+            'n': 1,
+            'm': 5,
+            'p': 0,
+            'q': 4
+        })
+
+    def test_unsupported(self):
+        for update_spec in [
+            {'$push': {'items': {'value': 4}}},
+            {'$set': {'items.$.value': 4}},
+            {'$set': {'items.5.value': 4}},
+            {'$set': {'items.value': 4}},
+            {'$inc': {'a': 1}},
+            {'$v': 2, 'diff': {}}
+        ]:
+            with self.assertRaises(UnsupportedUpdate):
+                apply_update_spec({'a': {'b': 1}, 'items': [{'value': 1}]}, update_spec)
+
+
+class TestDocumentCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        cache = DocumentCache(MAPPING, 10)
+        document = {'_id': 1, 'a': {'b': 1, 'c': 2}, 'items': [{'value': 1}], 'other': 'x'}
+        cache.put('db.col', document)
+
+        # Insertion adds the foreign keys to the linked documents
+        document['items'][0]['id_col'] = 1
+
+        self.assertEqual(cache.get('db.col', 1), {'_id': 1, 'a': {'b': 1, 'c': 2}, 'items': [{'value': 1}]})
+        self.assertIsNone(cache.get('db.col', 2))
+
+        cache.update('db.col', 1, {'$set': {'a.b': 5}})
+        self.assertEqual(cache.get('db.col', 1)['a'], {'b': 5, 'c': 2})
+
+        cache.update('db.col', 1, {'$push': {'items': {'value': 2}}})
+        self.assertIsNone(cache.get('db.col', 1))
+
+        cache.update('db.col', 1, {'a': {'b': 6}, 'other': 'y'})
+        self.assertEqual(cache.get('db.col', 1), {'_id': 1, 'a': {'b': 6}})
+
+        cache.remove('db.col', 1)
+        self.assertIsNone(cache.get('db.col', 1))
+
+        self.assertEqual(cache.stats(), {
+            'size': 0,
+            'hits': 3,
+            'misses': 3,
+            'evictions': 0,
+            'invalidations': 1
+        })
+
+    def test_oplog_diff(self):
+        cache = DocumentCache(MAPPING, 10)
+        cache.put('db.col', {'_id': 1, 'a': {'b': 1}})
+
+        # Not a replacement document, whose projection would only hold _id
+        cache.update('db.col', 1, {'diff': {'u': {'a': {'b': 2}}}})
+
+        self.assertIsNone(cache.get('db.col', 1))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_spill(self):
+        cache = DocumentCache(MAPPING, 2, os.path.join(self.tmpdir, 'documents'))
+
+        for i in range(5):
+            cache.put('db.col', {'_id': i, 'a': {'b': i}})
+
+        self.assertEqual(cache.stats()['evictions'], 3)
+        self.assertEqual(cache.get('db.col', 0), {'_id': 0, 'a': {'b': 0}})
+
+        cache.update('db.col', 1, {'$set': {'a.b': 10}})
+        self.assertEqual(cache.get('db.col', 1), {'_id': 1, 'a': {'b': 10}})
+
+        cache.clear('db.col')
+
+        for i in range(5):
+            self.assertIsNone(cache.get('db.col', i))
+
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
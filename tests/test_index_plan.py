@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import json
+
+from mongo_connector.doc_managers.index_plan import (
+    get_foreign_key_columns,
+    plan_indexes,
+    CREATION_DATE,
+    FOREIGN_KEY,
+    MAPPING,
+    PRIMARY_KEY,
+    TIMESTAMP
+)
+from mongo_connector.doc_managers.mappings import validate_mapping
+
+
+MAPPING_WITH_LINKS = {
+    'db': {
+        'col': {
+            'pk': '_id',
+            'indices': ['UNIQUE INDEX idx_col_name ON col (name)'],
+            '_id': {'dest': '_id', 'type': 'INT'},
+            'name': {'dest': 'name', 'type': 'TEXT'},
+            'tags': {'dest': 'tags', 'type': 'JSONB', 'index': True},
+            'items': {'dest': 'col_items', 'type': '_ARRAY', 'fk': 'id_col', 'index': True},
+            'values': {'dest': 'col_values', 'type': '_ARRAY_OF_SCALARS', 'fk': 'id_col', 'valueField': 'value'}
+        },
+        'other': {
+            'pk': '_id',
+            '_id': {'dest': '_id', 'type': 'INT'},
+            'items': {'dest': 'col_items', 'type': '_ARRAY', 'fk': 'id_other'}
+        },
+        'col_items': {
+            'pk': '_id',
+            'bookkeepingIndexes': False,
+            '_id': {'dest': '_id', 'type': 'SERIAL'},
+            'id_col': {'dest': 'id_col', 'type': 'INT', 'index': True},
+            'id_other': {'dest': 'id_other', 'type': 'INT'}
+        },
+        'col_values': {
+            'pk': '_id',
+            'partition': {'type': 'RANGE', 'interval': 'month'},
+            '_id': {'dest': '_id', 'type': 'SERIAL'},
+            'id_col': {'dest': 'id_col', 'type': 'INT'},
+            'value': {'dest': 'value', 'type': 'INT'}
+        }
+    }
+}
+
+
+def summary(indexes):
+    return [(index['name'], index['reason'], index['required']) for index in indexes]
+
+
+class TestIndexPlan(TestCase):
+    def test_valid_mapping(self):
+        validate_mapping(MAPPING_WITH_LINKS)
+
+    def test_foreign_key_columns(self):
+        self.assertEqual(get_foreign_key_columns(MAPPING_WITH_LINKS, 'db'), {
+            'col_items': ['id_col', 'id_other'],
+            'col_values': ['id_col']
+        })
+
+    def test_parent_table(self):
+        indexes = plan_indexes(MAPPING_WITH_LINKS, 'db', 'col', True)
+
+        self.assertEqual(summary(indexes), [
+            ('idx_col__creation_date', CREATION_DATE, False),
+            ('idx_col_name', MAPPING, False),
+            ('idx_col__ts', TIMESTAMP, True),
+            ('idx_col_tags', MAPPING, False)
+        ])
+        self.assertEqual(indexes[3]['sql'], 'INDEX idx_col_tags ON col USING GIN (tags)')
+
+    def test_linked_tables(self):
+        indexes = plan_indexes(MAPPING_WITH_LINKS, 'db', 'col_items', False)
+
+        # The foreign key indexed by the mapping is not indexed twice
+        self.assertEqual(summary(indexes), [
+            ('idx_col_items_id_col', FOREIGN_KEY, True),
+            ('idx_col_items__fk_id_other', FOREIGN_KEY, True)
+        ])
+        self.assertEqual(indexes[1]['sql'], 'INDEX idx_col_items__fk_id_other ON col_items (id_other)')
+
+        indexes = plan_indexes(MAPPING_WITH_LINKS, 'db', 'col_values', False)
+
+        self.assertEqual(summary(indexes), [
+            ('idx_col_values__creation_date', CREATION_DATE, False),
+            ('idx_col_values__pk', PRIMARY_KEY, True),
+            ('idx_col_values__fk_id_col', FOREIGN_KEY, True)
+        ])
+
+    def test_discriminator(self):
+        mapping = json.loads(json.dumps(MAPPING_WITH_LINKS))
+
+        for collection in mapping['db'].values():
+            collection['discriminator'] = 'tenant'
+
+        validate_mapping(mapping)
+
+        # Foreign keys are looked up within the rows of a database
+        indexes = plan_indexes(mapping, 'db', 'col_items', False)
+        self.assertEqual(summary(indexes), [
+            ('idx_col_items_id_col', FOREIGN_KEY, True),
+            ('idx_col_items__fk_id_col', FOREIGN_KEY, True),
+            ('idx_col_items__fk_id_other', FOREIGN_KEY, True)
+        ])
+        self.assertEqual(indexes[1]['sql'], 'INDEX idx_col_items__fk_id_col ON col_items (tenant, id_col)')
+
+        indexes = plan_indexes(mapping, 'db', 'col_values', False)
+        self.assertEqual(indexes[1]['sql'], 'INDEX idx_col_values__pk ON col_values (tenant, _id)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+
+from bson.timestamp import Timestamp
+
+from mongo_connector.doc_managers.lag_monitor import LagMonitor, get_timestamp_time
+
+
+class TestLagMonitor(TestCase):
+    def test_get_timestamp_time(self):
+        self.assertEqual(get_timestamp_time(Timestamp(1000, 3)), 1000)
+        self.assertEqual(get_timestamp_time((1000 << 32) + 3), 1000)
+
+    def test_hysteresis(self):
+        monitor = LagMonitor(60, 10)
+        now = 100000
+
+        self.assertFalse(monitor.observe(None, now))
+        self.assertFalse(monitor.observe((now - 30) << 32, now))
+        self.assertFalse(monitor.catching_up)
+
+        self.assertTrue(monitor.observe((now - 3600) << 32, now))
+        self.assertTrue(monitor.catching_up)
+
+        # Still lagging, though under the catch-up threshold
+        self.assertFalse(monitor.observe((now - 30) << 32, now))
+        self.assertTrue(monitor.catching_up)
+
+        self.assertTrue(monitor.observe(Timestamp(now - 5, 1), now))
+        self.assertFalse(monitor.catching_up)
+
+        self.assertEqual(monitor.stats(), {'lag': 5, 'catching_up': False, 'switches': 2})
+
+    def test_default_resume_lag(self):
+        self.assertEqual(LagMonitor(60).resume_lag, 15)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+
+from bson.objectid import ObjectId
+
+from mongo_connector.doc_managers import sql
+from mongo_connector.doc_managers.mapping_pool import MappingPool
+
+
+MAPPING = {
+    'db': {
+        'col': {
+            'pk': '_id',
+            '_id': {
+                'dest': '_id',
+                'type': 'TEXT'
+            },
+            'field1': {
+                'dest': 'field1',
+                'type': 'TEXT'
+            }
+        }
+    }
+}
+
+
+class TestMappingPool(TestCase):
+    def setUp(self):
+        self.pool = MappingPool(MAPPING, 2, max_pending=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_render(self):
+        chunks = [
+            [
+                {'_id': ObjectId(), 'field1': 'val{0}'.format(i * 10 + j)}
+                for j in range(3)
+            ]
+            for i in range(5)
+        ]
+
+        got = list(self.pool.render('db.col', iter(chunks), timestamp=None))
+
+        self.assertEqual([chunk for chunk, _ in got], chunks)
+
+        for chunk, statements in got:
+            expected = list(sql.sql_insert_statements(MAPPING, 'db.col', chunk))
+            self.assertEqual(
+                [stmt for _, stmt in statements],
+                [stmt for _, stmt in expected]
+            )
+
+            for document, (querytree, _) in zip(chunk, statements):
+                self.assertEqual(querytree['namespace'], 'db.col')
+                self.assertEqual(querytree['collection'], 'col')
+                self.assertIs(querytree['document']['raw'], document)
+                self.assertEqual(
+                    querytree['document']['mapped'],
+                    {'_id': str(document['_id'])}
+                )
+
+
+class TestMappingPoolMaxRows(TestCase):
+    def test_render_split_documents(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'dest': '_id', 'type': 'INT'},
+                    'tags': {'dest': 'col_tags', 'type': '_ARRAY_OF_SCALARS', 'fk': 'id_col', 'valueField': 'tag'}
+                },
+                'col_tags': {
+                    'pk': '_id',
+                    '_id': {'dest': '_id', 'type': 'SERIAL'},
+                    'id_col': {'dest': 'id_col', 'type': 'INT'},
+                    'tag': {'dest': 'tag', 'type': 'TEXT'}
+                }
+            }
+        }
+        chunk = [{'_id': 1, 'tags': ['a', 'b', 'c']}, {'_id': 2, 'tags': []}]
+        pool = MappingPool(mapping, 1, max_rows=2)
+
+        try:
+            [(_, statements)] = list(pool.render('db.col', [chunk]))
+
+        finally:
+            pool.close()
+
+        self.assertEqual(
+            [querytree['document']['raw']['_id'] for querytree, _ in statements],
+            [1, 1, 2]
+        )
+
+
+if __name__ == '__main__':
+    main()
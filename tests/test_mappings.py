@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from unittest import TestCase, main
+from mock import patch
 
 from mongo_connector.doc_managers import mappings
 
@@ -9,6 +10,10 @@ def parseInt(val):
     return int(val)
 
 
+def parseInts(values):
+    return [int(val) for val in values]
+
+
 class TestPostgreSQLMappings(TestCase):
     def test_clean_and_flatten_doc(self):
         mapping = {
@@ -510,6 +515,353 @@ class TestPostgreSQLMappings(TestCase):
 
         mappings.validate_mapping(mapping)
 
+    def test_invalid_mapping_memoize_without_batch_transform(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'active': {
+                        'type': 'BOOLEAN',
+                        'transform': '@package.module.transform_str_to_bool',
+                        'memoize': 10
+                    }
+                }
+            }
+        }
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['active']['batchTransform'] = True
+        mappings.validate_mapping(mapping)
+
+    def test_valid_mapping_per_value_transform(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'active': {
+                        'type': 'BOOLEAN',
+                        'transform': '@package.module.transform_str_to_bool'
+                    }
+                }
+            }
+        }
+
+        with patch('mongo_connector.doc_managers.mappings.LOG') as log:
+            mappings.validate_mapping(mapping)
+
+        # Not applied to the written rows, unlike batch transforms
+        self.assertEqual(log.warning.call_args[0][1:], ('testdb', 'testcol', 'active'))
+
+        mapping['testdb']['testcol']['active']['batchTransform'] = True
+
+        with patch('mongo_connector.doc_managers.mappings.LOG') as log:
+            mappings.validate_mapping(mapping)
+
+        log.warning.assert_not_called()
+
+    def test_valid_mapping_native_array_of_scalar(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'tags': {
+                        'type': '_ARRAY_OF_SCALARS',
+                        'valueType': 'TEXT'
+                    }
+                }
+            }
+        }
+
+        mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['tags']['valueType'] = 'STRING'
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+    def test_mapped_document_native_array_of_scalar(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT', 'dest': '_id'},
+                    'a.tags': {
+                        'type': '_ARRAY_OF_SCALARS',
+                        'valueType': 'TEXT',
+                        'dest': 'tags'
+                    }
+                }
+            }
+        }
+        doc = {'_id': 1, 'a': {'tags': ['x', 'y']}}
+
+        got = mappings.get_mapped_document(mapping, doc, 'db.col')
+        self.assertEqual(got, {'_id': 1, 'tags': ['x', 'y']})
+
+    def test_mapping_partition(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    'partition': {'type': 'HASH'},
+                    '_id': {'type': 'INT'},
+                    'date': {'type': 'TIMESTAMP'}
+                }
+            }
+        }
+
+        # Missing modulus
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['partition']['modulus'] = 4
+        mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['partition'] = {
+            'type': 'RANGE',
+            'column': 'missing',
+            'interval': 'month'
+        }
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['partition']['column'] = 'date'
+        mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['partition']['interval'] = 'hour'
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+    def test_mapping_storage(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    'storage': {
+                        'fillfactor': 70,
+                        'autovacuum_vacuum_scale_factor': 0.01,
+                        'autovacuum_vacuum_cost_limit': 1000,
+                        'toast.autovacuum_enabled': True,
+                        'toast_tuple_target': 4080
+                    },
+                    '_id': {'type': 'INT'}
+                }
+            }
+        }
+
+        mappings.validate_mapping(mapping)
+
+        for storage in [{'fillfactor': 5}, {'unknown': 1}, {'fillfactor=1) --': 1}]:
+            mapping['testdb']['testcol']['storage'] = storage
+
+            with self.assertRaises(mappings.InvalidConfiguration):
+                mappings.validate_mapping(mapping)
+
+    def test_mapping_patterns(self):
+        mapping = {
+            'tenant_*': {
+                'col': {
+                    'pk': '_id',
+                    'discriminator': 'tenant',
+                    '_id': {'type': 'INT'}
+                }
+            }
+        }
+
+        mappings.validate_mapping(mapping)
+
+        # The tables of a pattern are shared by the matching databases
+        del mapping['tenant_*']['col']['discriminator']
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['tenant_*']['col']['discriminator'] = 'tenant'
+        mapping['tenant_*']['col_*'] = mapping['tenant_*'].pop('col')
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+    def test_mapping_discriminator(self):
+        mapping = {
+            'tenant_*': {
+                'col': {
+                    'pk': '_id',
+                    'discriminator': 'tenant',
+                    '_id': {'type': 'INT'},
+                    'a': {
+                        'type': '_ARRAY',
+                        'fk': 'id_col',
+                        'dest': 'col_a'
+                    }
+                },
+                'col_a': {
+                    'pk': '_id',
+                    'discriminator': 'tenant',
+                    '_id': {'type': 'SERIAL'},
+                    'id_col': {'type': 'INT'}
+                }
+            }
+        }
+
+        mappings.validate_mapping(mapping)
+
+        # Linked rows are keyed by the discriminator of their parent rows
+        del mapping['tenant_*']['col_a']['discriminator']
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['tenant_*']['col_a']['discriminator'] = 'tenant id'
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+    def test_invalid_mapping_range_partition_linked_table(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    'partition': {'type': 'RANGE'},
+                    '_id': {'type': 'INT'},
+                    'a': {
+                        'type': '_ARRAY',
+                        'fk': 'id_testcol',
+                        'dest': 'testcol_a'
+                    }
+                },
+                'testcol_a': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'id_testcol': {'type': 'INT'}
+                }
+            }
+        }
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+    def test_invalid_mapping_unmapped_fields(self):
+        mapping = {
+            'testdb': {
+                'testcol': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    '*': {'type': 'JSONB'}
+                }
+            }
+        }
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['*'] = {'type': 'TEXT', 'dest': 'extra'}
+
+        with self.assertRaises(mappings.InvalidConfiguration):
+            mappings.validate_mapping(mapping)
+
+        mapping['testdb']['testcol']['*'] = {'type': 'JSONB', 'dest': 'extra'}
+        mappings.validate_mapping(mapping)
+
+    def test_mapped_document_jsonb(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT', 'dest': '_id'},
+                    'a.b': {'type': 'INT', 'dest': 'ab'},
+                    'meta': {'type': 'JSONB', 'dest': 'meta'},
+                    'comments': {'type': '_ARRAY', 'dest': 'comments', 'fk': 'id'},
+                    '*': {'type': 'JSONB', 'dest': 'extra'}
+                }
+            }
+        }
+        doc = {
+            '_id': 1,
+            'a': {'b': 2, 'c': 3},
+            'meta': {'x': {'y': [1, 2]}},
+            'comments': [{'text': 'foo'}],
+            'other': 'bar'
+        }
+
+        got = mappings.get_mapped_document(mapping, doc, 'db.col')
+        self.assertEqual(got, {
+            '_id': 1,
+            'ab': 2,
+            'meta': {'x': {'y': [1, 2]}},
+            'extra': {'a': {'c': 3}, 'other': 'bar'}
+        })
+
+    def test_is_update_mapped(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT', 'dest': '_id'},
+                    'a.b': {'type': 'INT', 'dest': 'ab'},
+                    'meta': {'type': 'JSONB', 'dest': 'meta'},
+                    'comments': {'type': '_ARRAY', 'dest': 'comments', 'fk': 'id'}
+                }
+            }
+        }
+
+        def is_update_mapped(update_spec):
+            return mappings.is_update_mapped(mapping, 'db.col', update_spec)
+
+        self.assertFalse(is_update_mapped({'$set': {'lastSeenAt': 1}, '$inc': {'counter': 1}}))
+        self.assertFalse(is_update_mapped({'$v': 1, '$set': {'a.c': 1}}))
+        self.assertFalse(is_update_mapped({'$rename': {'x': 'y'}}))
+        self.assertTrue(is_update_mapped({'$set': {'a.b': 1}}))
+        self.assertTrue(is_update_mapped({'$set': {'a': {'b': 1}}}))
+        self.assertTrue(is_update_mapped({'$unset': {'meta.x.y': 1}}))
+        self.assertTrue(is_update_mapped({'$set': {'comments.0.text': 'foo'}}))
+        self.assertTrue(is_update_mapped({'$set': {'comments.$.text': 'foo'}}))
+        self.assertTrue(is_update_mapped({'$push': {'comments': {'text': 'foo'}}}))
+        self.assertTrue(is_update_mapped({'$rename': {'x': 'a.b'}}))
+        # Replacements and unknown operators
+        self.assertTrue(is_update_mapped({'lastSeenAt': 1}))
+        self.assertTrue(is_update_mapped({'$v': 2, 'diff': {'u': {'lastSeenAt': 1}}}))
+
+        mapping['db']['col'] = dict(mapping['db']['col'], **{'*': {'type': 'JSONB', 'dest': 'extra'}})
+        self.assertTrue(is_update_mapped({'$set': {'lastSeenAt': 1}}))
+
+    def test_get_projection(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'a.b': {'type': 'INT'},
+                    'a.c.d': {'type': 'INT'},
+                    'e': {'type': '_ARRAY_OF_SCALARS'},
+                    'e.0': {'type': 'INT'},
+                    'f': {'type': 'JSONB'},
+                    'f.g': {'type': 'INT'}
+                },
+                'all': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    '*': {'type': 'JSONB'}
+                }
+            }
+        }
+
+        self.assertEqual(mappings.get_projection(mapping, 'db.col'), {
+            '_id': True,
+            'a.b': True,
+            'a.c.d': True,
+            'e': True,
+            'f': True
+        })
+        self.assertIsNone(mappings.get_projection(mapping, 'db.all'))
+
     def test_get_transform_value_with_eval(self):
         mapped_field = {
             'type': 'INT',
@@ -588,6 +940,83 @@ class TestPostgreSQLMappings(TestCase):
         got = mappings.get_transformed_document(mapping, 'db', 'col', doc)
         self.assertEqual(got, {'str_to_int': '42'})
 
+    def test_get_transformed_documents(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'ints': {
+                        'type': 'INT',
+                        'dest': 'ints',
+                        'transform': '@tests.test_mappings.parseInts',
+                        'batchTransform': True
+                    },
+                    'str_to_int': {
+                        'type': 'INT',
+                        'dest': 'str_to_int',
+                        'transform': '@tests.test_mappings.parseInt'
+                    }
+                }
+            }
+        }
+        docs = [{'ints': '1', 'str_to_int': '2'}, {'str_to_int': '3'}, {'ints': '4'}]
+
+        got = mappings.get_transformed_documents(mapping, 'db', 'col', docs)
+        self.assertEqual(got, [{'ints': 1, 'str_to_int': 2}, {'str_to_int': 3}, {'ints': 4}])
+        self.assertEqual(docs[0], {'ints': '1', 'str_to_int': '2'})
+
+        # A failing batch leaves its column untransformed
+        docs.append({'ints': 'a'})
+        got = mappings.get_transformed_documents(mapping, 'db', 'col', docs)
+        self.assertEqual([doc.get('ints') for doc in got], ['1', None, '4', 'a'])
+
+        # Batch transforms also transform single values
+        got = mappings.get_transformed_value(mapping['db']['col']['ints'], {'ints': '5'}, 'ints')
+        self.assertEqual(got, 5)
+
+    def test_memoized_transform(self):
+        mapping = {
+            'db': {
+                'memo': {
+                    'str_to_int': {
+                        'type': 'INT',
+                        'dest': 'str_to_int',
+                        'transform': '@tests.test_mappings.parseInt',
+                        'memoize': 10
+                    },
+                    'ints': {
+                        'type': 'INT',
+                        'dest': 'ints',
+                        'transform': '@tests.test_mappings.parseInts',
+                        'batchTransform': True,
+                        'memoize': 10
+                    }
+                }
+            }
+        }
+        docs = [{'str_to_int': '1', 'ints': '1'}, {'str_to_int': '1', 'ints': '2'}, {'str_to_int': '1a'}]
+
+        got = mappings.get_transformed_documents(mapping, 'db', 'memo', docs)
+        self.assertEqual(got, [{'str_to_int': 1, 'ints': 1}, {'str_to_int': 1, 'ints': 2}, {'str_to_int': '1a'}])
+
+        stats = mappings.get_transform_stats()
+        self.assertEqual(stats['db.memo.str_to_int']['hits'], 1)
+        self.assertEqual(stats['db.memo.str_to_int']['misses'], 2)
+        self.assertEqual(stats['db.memo.ints']['misses'], 2)
+
+        # The failed value is transformed again
+        mappings.get_transformed_documents(mapping, 'db', 'memo', docs)
+        stats = mappings.get_transform_stats()
+        self.assertEqual(stats['db.memo.str_to_int']['hits'], 3)
+        self.assertEqual(stats['db.memo.str_to_int']['misses'], 3)
+        self.assertEqual(stats['db.memo.ints']['hits'], 2)
+
+        # Each database keeps its own cache
+        mapping['other'] = mapping['db']
+        mappings.get_transformed_documents(mapping, 'other', 'memo', docs)
+        stats = mappings.get_transform_stats()
+        self.assertEqual(stats['other.memo.ints']['misses'], 2)
+        self.assertEqual(stats['db.memo.ints']['hits'], 2)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import pickle
+
+from mongo_connector.doc_managers.namespace_index import (
+    NamespaceIndex,
+    NamespaceMappings,
+    is_pattern
+)
+
+
+class TestNamespaceIndex(TestCase):
+    def test_is_pattern(self):
+        self.assertTrue(is_pattern('tenant_*'))
+        self.assertTrue(is_pattern('tenant_?'))
+        self.assertTrue(is_pattern('tenant_[0-9]'))
+        self.assertFalse(is_pattern('tenant'))
+
+    def test_match(self):
+        index = NamespaceIndex(['*', 'tenant_*', 'tenant_1*', 'tenant_[0-9][0-9]', 'other?'])
+
+        self.assertEqual(index.match('tenant_0001'), 'tenant_*')
+        self.assertEqual(index.match('tenant_1234'), 'tenant_1*')
+        self.assertEqual(index.match('tenant_12'), 'tenant_1*')
+        self.assertEqual(index.match('tenant_42'), 'tenant_[0-9][0-9]')
+        self.assertEqual(index.match('other1'), 'other?')
+        self.assertEqual(index.match('other12'), '*')
+        self.assertIsNone(NamespaceIndex(['tenant_*']).match('Tenant_1'))
+
+
+class TestNamespaceMappings(TestCase):
+    def setUp(self):
+        self.mappings = NamespaceMappings({
+            'tenant_*': {'col': {'pk': '_id'}},
+            'tenant_admin': {'users': {'pk': '_id'}}
+        })
+
+    def test_lookup(self):
+        self.assertIn('tenant_0001', self.mappings)
+        self.assertIn('tenant_*', self.mappings)
+        self.assertNotIn('other', self.mappings)
+
+        self.assertIs(self.mappings['tenant_0001'], self.mappings['tenant_*'])
+        self.assertIn('users', self.mappings['tenant_admin'])
+        self.assertIsNone(self.mappings.get('other'))
+
+        with self.assertRaises(KeyError):
+            self.mappings['other']
+
+        self.assertEqual(self.mappings.resolve_namespace('tenant_0002.col'), 'tenant_*.col')
+        self.assertIsNone(self.mappings.resolve_namespace('other.col'))
+        self.assertEqual(sorted(self.mappings), ['tenant_*', 'tenant_admin'])
+
+    def test_update(self):
+        self.assertNotIn('other_1', self.mappings)
+
+        self.mappings['other_*'] = {}
+        self.assertIn('other_1', self.mappings)
+
+        del self.mappings['tenant_*']
+        self.assertNotIn('tenant_0001', self.mappings)
+
+    def test_pickle(self):
+        mappings = pickle.loads(pickle.dumps(self.mappings))
+
+        self.assertIsInstance(mappings, NamespaceMappings)
+        self.assertEqual(mappings, self.mappings)
+        self.assertIn('tenant_0001', mappings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+
+from mongo_connector.doc_managers.operation_buffer import (
+    OperationBuffer,
+    UPSERT,
+    UPDATE,
+    REMOVE
+)
+
+
+class TestOperationBuffer(TestCase):
+    def test_merge(self):
+        buffer = OperationBuffer(1, 10)
+
+        self.assertTrue(buffer.add('db.col', 1, UPSERT, {'_id': 1, 'a': 1}, 1))
+        self.assertTrue(buffer.add('db.col', 2, UPSERT, {'_id': 2}, 2))
+        self.assertTrue(buffer.add('db.col', 1, UPSERT, {'_id': 1, 'a': 2}, 3))
+        self.assertTrue(buffer.add('db.col', 1, UPDATE, {'$set': {'a': 3}}, 4))
+        self.assertTrue(buffer.add('db.col', 2, REMOVE, None, 5))
+        self.assertEqual(len(buffer), 2)
+
+        self.assertEqual(buffer.drain(), [
+            ('db.col', 1, UPDATE, {'$set': {'a': 3}}, 4),
+            ('db.col', 2, REMOVE, None, 5)
+        ])
+        self.assertEqual(len(buffer), 0)
+
+    def test_update_after_remove(self):
+        buffer = OperationBuffer(1, 10)
+
+        buffer.add('db.col', 1, REMOVE, None, 1)
+        self.assertFalse(buffer.add('db.col', 1, UPDATE, {'$set': {'a': 1}}, 2))
+        self.assertTrue(buffer.add('db.col', 1, UPSERT, {'_id': 1}, 3))
+        self.assertEqual(buffer.drain(), [('db.col', 1, UPSERT, {'_id': 1}, 3)])
+
+        self.assertFalse(buffer.add('db.col', {'a': 1}, UPSERT, {'_id': {'a': 1}}, 4))
+
+    def test_is_due(self):
+        buffer = OperationBuffer(1, 2)
+        self.assertFalse(buffer.is_due())
+
+        buffer.add('db.col', 1, UPSERT, {'_id': 1}, 1)
+        self.assertFalse(buffer.is_due())
+        self.assertTrue(buffer.is_due(buffer._started + 1))
+
+        buffer.add('db.col', 2, UPSERT, {'_id': 2}, 2)
+        self.assertTrue(buffer.is_due())
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,24 @@
 
 from unittest import TestCase, main
 from mock import MagicMock, patch, mock_open, call
-from time import time
+from datetime import date
 import json
-
-from mongo_connector.doc_managers import postgresql_manager
+import os.path
+import psycopg2
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mongo_connector.doc_managers import postgresql_manager, replay
+from mongo_connector.doc_managers.mappings import validate_mapping
 from .fixtures import *
 
 
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
 MAPPING_RAW = '''{
     "db": {
         "col": {
@@ -116,6 +127,9 @@ MAPPING = {
 }
 
 
+# Mapped fields of db.col read from MongoDB
+PROJECTION = {'_id': True, 'field1': True, 'field2': True}
+
 class TestPostgreSQLManager(TestCase):
     def setUp(self):
         self.psql_module_patcher = patch(
@@ -187,26 +201,116 @@ class TestManagerInitialization(TestPostgreSQLManager):
         )
 
         pconn.set_session.assert_called_with(deferrable=True)
-        cursor.execute.assert_has_calls([
-            call('DROP TABLE IF EXISTS col CASCADE'),
-            call(
-                'CREATE TABLE col  (_creationdate TIMESTAMP,_id INT CONSTRAINT COL_PK PRIMARY KEY,field1 TEXT ) '
-            ),
-            call(
-                'CREATE TABLE col_field2  (_creationdate TIMESTAMP,_id SERIAL CONSTRAINT COL_FIELD2_PK PRIMARY KEY,id_col INT ,subfield1 TEXT ) '
-            ),
-            call(
-                'CREATE TABLE col_field2_subfield2  (_creationdate TIMESTAMP,_id SERIAL CONSTRAINT COL_FIELD2_SUBFIELD2_PK PRIMARY KEY,id_col_field2 SERIAL ,scalar INT ) '
-            ),
-            call(
-                'CREATE INDEX idx_col__creation_date ON col (_creationdate DESC)'
-            ),
-            call(
-                'ALTER TABLE col_field2 ADD CONSTRAINT col_field2_id_col_fk FOREIGN KEY (id_col) REFERENCES col(_id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
-            )
-        ], any_order=True)
+        # The schema is created in a single round trip
+        scripts = [
+            args[0] for args, _ in cursor.execute.call_args_list
+            if 'CREATE TABLE col ' in args[0]
+        ]
+        self.assertEqual(len(scripts), 1)
+        statements = scripts[0].split(';\n')
+
+        for statement in [
+            'DROP TABLE IF EXISTS col, col_field2, col_field2_subfield2 CASCADE',
+            'CREATE TABLE col  (_creationdate TIMESTAMP,_id INT CONSTRAINT COL_PK PRIMARY KEY,_ts BIGINT,field1 TEXT ) ',
+            'CREATE TABLE col_field2  (_creationdate TIMESTAMP,_id SERIAL CONSTRAINT COL_FIELD2_PK PRIMARY KEY,id_col INT ,subfield1 TEXT ) ',
+            'CREATE TABLE col_field2_subfield2  (_creationdate TIMESTAMP,_id SERIAL CONSTRAINT COL_FIELD2_SUBFIELD2_PK PRIMARY KEY,id_col_field2 SERIAL ,scalar INT ) ',
+            'CREATE INDEX idx_col__creation_date ON col (_creationdate DESC)',
+            'CREATE INDEX idx_col__ts ON col (_ts DESC)',
+            'CREATE INDEX idx_col_field2__fk_id_col ON col_field2 (id_col)',
+            'CREATE INDEX idx_col_field2_subfield2__fk_id_col_field2 ON col_field2_subfield2 (id_col_field2)',
+            'ALTER TABLE col_field2 ADD CONSTRAINT col_field2_id_col_fk FOREIGN KEY (id_col) REFERENCES col(_id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
+        ]:
+            self.assertIn(statement, statements)
 
         pconn.commit.assert_called()
+        self.assertEqual(docmgr.timestamped_tables, {'db.col': ('col', '_id', None)})
+
+    def test_checkpointed_tables_are_kept(self):
+        pconn = MagicMock()
+        self.psql_module.connect.return_value = pconn
+        cursor = MagicMock()
+        pconn.cursor.return_value.__enter__.return_value = cursor
+        cursor.fetchall.return_value = [('db.col', '{"_id": 2}')]
+
+        self.ospath.isfile.return_value = True
+
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl')
+
+        self.assertEqual(docmgr.checkpoints, {'db.col': 2})
+        self.assertEqual(
+            docmgr.get_checkpointed_tables('db'),
+            {'col', 'col_field2', 'col_field2_subfield2'}
+        )
+
+        for args, _ in cursor.execute.call_args_list:
+            self.assertNotIn('DROP TABLE', args[0])
+            self.assertNotIn('CREATE TABLE col', args[0])
+
+
+class TestStartup(TestPostgreSQLManager):
+    def test_import_time(self):
+        script = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "import mongo_connector.doc_managers.postgresql_manager\n"
+            "print(time.time() - start)\n"
+            "print('jsonschema' in sys.modules or 'RestrictedPython' in sys.modules)\n"
+        )
+        elapsed, eager = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=ROOT_DIR
+        ).decode().split()
+
+        # Validation and transform machinery are imported on first use
+        self.assertEqual(eager, 'False')
+        self.assertLess(float(elapsed), 2)
+
+    def test_time_to_ready(self):
+        mapping = {'db': {}}
+
+        for i in range(500):
+            mapping['db']['col{0}'.format(i)] = {
+                'pk': '_id',
+                '_id': {'dest': '_id', 'type': 'INT'},
+                'name': {'dest': 'name', 'type': 'TEXT', 'index': True},
+                'items': {'dest': 'col{0}_items'.format(i), 'type': '_ARRAY', 'fk': 'id_col'}
+            }
+            mapping['db']['col{0}_items'.format(i)] = {
+                'pk': '_id',
+                'id_col': {'dest': 'id_col', 'type': 'INT'},
+                'value': {'dest': 'value', 'type': 'TEXT'}
+            }
+
+        self.builtin_open_patcher.stop()
+        self.builtin_open_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.open',
+            mock_open(read_data=json.dumps(mapping)),
+            create=True
+        )
+        self.builtin_open_patcher.start()
+        # The validation imports jsonschema on first use, which needs os.path
+        self.ospath_patcher.stop()
+        self.ospath_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.os.path.isfile',
+            return_value=True
+        )
+        self.ospath_patcher.start()
+        self.validate_mapping.side_effect = validate_mapping
+
+        pconn = MagicMock()
+        self.psql_module.connect.return_value = pconn
+        cursor = MagicMock()
+        pconn.cursor.return_value.__enter__.return_value = cursor
+        cursor.fetchall.return_value = []
+
+        start = time.time()
+        postgresql_manager.DocManager('url', mongoUrl='murl')
+        elapsed = time.time() - start
+
+        # Checkpoint table, checkpoints and the whole schema
+        self.assertEqual(cursor.execute.call_count, 3)
+        self.assertEqual(cursor.execute.call_args_list[-1][0][0].count('CREATE TABLE'), 1000)
+        self.assertLess(elapsed, 5)
 
 
 class TestManager(TestPostgreSQLManager):
@@ -243,7 +347,7 @@ class TestManager(TestPostgreSQLManager):
 
         self.mconn.__getitem__.assert_called_with('db')
         self.mdb.__getitem__.assert_called_with('col')
-        self.mcol.find_one.assert_called_with({'_id': 1})
+        self.mcol.find_one.assert_called_with({'_id': 1}, projection=PROJECTION)
 
         self.assertEqual(got, expected)
 
@@ -257,13 +361,58 @@ class TestManager(TestPostgreSQLManager):
                 }
             ]
         }
-        now = time()
+        now = 1
 
         self.docmgr.upsert(doc, 'db.col', now)
 
         self.cursor.execute.assert_called_with(TEST_PGMAN_UPSERT)
         self.pconn.commit.assert_called()
 
+    def test_upsert_unchanged_rows(self):
+        # Documents are built for each call, the insertion adds the foreign
+        # keys to the subdocuments
+        def document(**fields):
+            doc = {
+                '_id': 1,
+                'field1': 'val1',
+                'field2': [
+                    {
+                        'subfield1': 'subval1'
+                    }
+                ]
+            }
+            doc.update(fields)
+            return doc
+
+        self.docmgr.row_hashes = postgresql_manager.LRUCache(10)
+        self.docmgr.upsert(document(), 'db.col', 1)
+        self.cursor.execute.reset_mock()
+
+        # Same mapped content, only the unmapped fields changed
+        self.mcol.find_one.return_value = document(lastSeenAt=2)
+        self.docmgr.upsert(document(lastSeenAt=2), 'db.col', 2)
+        self.docmgr.update(1, {'$set': {'field1': 'val1'}}, 'db.col', 3)
+        self.cursor.execute.assert_not_called()
+
+        # Child rows are part of the content
+        self.docmgr.upsert(document(field2=[{'subfield1': 'subval2'}]), 'db.col', 4)
+        self.cursor.execute.assert_any_call('DELETE FROM col WHERE _id = 1')
+
+        # Removed rows are written again
+        self.docmgr.remove(1, 'db.col', 5)
+        self.cursor.execute.reset_mock()
+        self.docmgr.upsert(document(field2=[{'subfield1': 'subval2'}]), 'db.col', 6)
+        self.cursor.execute.assert_any_call('DELETE FROM col WHERE _id = 1')
+
+        # Failed writes are not recorded as written
+        self.docmgr.row_hashes.clear()
+        self.cursor.execute.side_effect = [None, psycopg2.IntegrityError('duplicate key')]
+        self.docmgr.upsert(document(field1='val3'), 'db.col', 7)
+        self.cursor.execute.side_effect = None
+        self.cursor.execute.reset_mock()
+        self.docmgr.upsert(document(field1='val3'), 'db.col', 8)
+        self.cursor.execute.assert_any_call('DELETE FROM col WHERE _id = 1')
+
     def test_bulk_upsert(self):
         doc1 = {
             '_id': 1,
@@ -286,7 +435,7 @@ class TestManager(TestPostgreSQLManager):
                 {'subfield1': 'subval3'}
             ]
         }
-        now = time()
+        now = 1
 
         self.docmgr.bulk_upsert([doc1, doc2, doc3], 'db.col', now)
 
@@ -297,6 +446,51 @@ class TestManager(TestPostgreSQLManager):
         ], any_order=True)
         self.pconn.commit.assert_called()
 
+    def test_bulk_upsert_checkpoint(self):
+        docs = [
+            {'_id': i, 'field1': 'val{0}'.format(i)}
+            for i in range(1, 4)
+        ]
+        now = 1
+
+        self.docmgr.bulk_upsert(docs, 'db.col', now)
+
+        self.cursor.execute.assert_has_calls([
+            call('DELETE FROM col'),
+            call(
+                "INSERT INTO _mongo_connector_checkpoints (namespace, last_id) VALUES ('db.col', '{\"_id\": 2}') "
+                "ON CONFLICT (namespace) DO UPDATE SET last_id = EXCLUDED.last_id"
+            ),
+            call(
+                "INSERT INTO _mongo_connector_checkpoints (namespace, last_id) VALUES ('db.col', '{\"_id\": 3}') "
+                "ON CONFLICT (namespace) DO UPDATE SET last_id = EXCLUDED.last_id"
+            ),
+            call("DELETE FROM _mongo_connector_checkpoints WHERE namespace = 'db.col'")
+        ], any_order=True)
+        self.assertEqual(self.docmgr.checkpoints, {})
+
+    def test_bulk_upsert_resume(self):
+        docs = [
+            {'_id': i, 'field1': 'val{0}'.format(i)}
+            for i in range(1, 4)
+        ]
+        now = 1
+
+        self.docmgr.checkpoints['db.col'] = 2
+        self.cursor.execute.reset_mock()
+
+        self.docmgr.bulk_upsert(docs, 'db.col', now)
+
+        executed = [args[0] for args, _ in self.cursor.execute.call_args_list]
+
+        self.assertNotIn('DELETE FROM col', executed)
+        self.assertEqual(
+            len([sql for sql in executed if sql.startswith('WITH col_data_0')]),
+            1
+        )
+        self.assertIn("'val3'::TEXT", executed[0])
+        self.assertEqual(self.docmgr.checkpoints, {})
+
     def test_update(self):
         doc_id = 1
         doc = {
@@ -306,7 +500,7 @@ class TestManager(TestPostgreSQLManager):
                 {'subfield1': 'subval1'}
             ]
         }
-        now = time()
+        now = 1
 
         self.mcol.find_one.return_value = doc
 
@@ -314,7 +508,7 @@ class TestManager(TestPostgreSQLManager):
 
         self.mconn.__getitem__.assert_called_with('db')
         self.mdb.__getitem__.assert_called_with('col')
-        self.mcol.find_one.assert_called_with({'_id': 1})
+        self.mcol.find_one.assert_called_with({'_id': 1}, projection=PROJECTION)
 
         self.cursor.execute.assert_has_calls([
             call(
@@ -324,8 +518,353 @@ class TestManager(TestPostgreSQLManager):
         ], any_order=True)
         self.pconn.commit.assert_called()
 
+    def test_update_unmapped_fields(self):
+        self.cursor.execute.reset_mock()
+        self.docmgr.update(1, {'$set': {'lastSeenAt': 1}, '$inc': {'counter': 1}}, 'db.col', 1)
+
+        self.mcol.find_one.assert_not_called()
+        self.cursor.execute.assert_not_called()
+
+    def test_coalesce_operations(self):
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', coalesceWindow=60)
+        self.cursor.execute.reset_mock()
+
+        try:
+            for i in range(5):
+                docmgr.upsert({'_id': 1, 'field1': 'val{0}'.format(i)}, 'db.col', i)
+
+            docmgr.upsert({'_id': 2, 'field1': 'val'}, 'db.col', 5)
+            docmgr.remove(2, 'db.col', 6)
+            self.cursor.execute.assert_not_called()
+
+            docmgr.commit()
+
+        finally:
+            docmgr.stop()
+
+        executed = [args[0] for args, _ in self.cursor.execute.call_args_list]
+        self.assertEqual(executed[0], 'DELETE FROM col WHERE _id = 1')
+        self.assertIn("'val4'::TEXT", executed[1])
+        self.assertEqual(executed[2:], ['DELETE from col WHERE _id = 2::INT;'])
+
+    def test_coalesce_operations_flushed_on_command(self):
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', coalesceWindow=60)
+        self.pconn.commit.reset_mock()
+
+        try:
+            docmgr.upsert({'_id': 1, 'field1': 'val'}, 'db.col', 1)
+            self.pconn.commit.assert_not_called()
+
+            docmgr.handle_command({'drop': 'col'}, 'db.$cmd', 2)
+
+        finally:
+            docmgr.stop()
+
+        self.assertIn("'val'::TEXT", self.cursor.execute.call_args_list[-1][0][0])
+        self.pconn.commit.assert_called()
+
+    def test_apply_lanes(self):
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', applyWorkers=2)
+        self.cursor.execute.reset_mock()
+
+        try:
+            for i in range(10):
+                docmgr.upsert({'_id': i, 'field1': 'val'}, 'db.col', i)
+
+            docmgr.remove(3, 'db.col', 10)
+            docmgr.commit()
+            executed = [args[0] for args, _ in self.cursor.execute.call_args_list]
+
+        finally:
+            docmgr.stop()
+
+        # Each lane has its own connection, besides the ones of both managers
+        self.assertEqual(self.psql_module.connect.call_count, 4)
+        self.assertEqual(len([sql for sql in executed if sql.startswith('WITH')]), 10)
+        self.assertIn('DELETE from col WHERE _id = 3::INT;', executed)
+        self.assertLess(
+            executed.index('DELETE FROM col WHERE _id = 3'),
+            executed.index('DELETE from col WHERE _id = 3::INT;')
+        )
+
+    def test_catch_up_mode(self):
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', catchUpLag=60, catchUpInterval=60)
+        self.cursor.execute.reset_mock()
+        self.pconn.commit.reset_mock()
+        self.mcol.find.return_value = [{'_id': 2, 'field1': 'val2'}]
+        late = int(time.time() - 3600) << 32
+
+        try:
+            docmgr.upsert({'_id': 1, 'field1': 'val1'}, 'db.col', late)
+            docmgr.update(2, {'$set': {'field1': 'val2'}}, 'db.col', late + 1)
+            docmgr.update(5, {'$set': {'field1': 'val5'}}, 'db.col', late + 2)
+            docmgr.remove(3, 'db.col', late + 3)
+            docmgr.remove(4, 'db.col', late + 4)
+
+            self.assertTrue(docmgr.lag_monitor.catching_up)
+            self.cursor.execute.assert_not_called()
+
+            docmgr.commit()
+            executed = [args[0] for args, _ in self.cursor.execute.call_args_list]
+            self.mcol.find.assert_called_once_with({'_id': {'$in': [2, 5]}}, projection=PROJECTION)
+            self.mcol.find_one.assert_not_called()
+
+            self.assertEqual(executed[0], 'SET LOCAL synchronous_commit TO OFF')
+            self.assertEqual(executed[1], 'DELETE from col WHERE _id IN (3::INT, 4::INT);')
+            self.assertIn("'val1'::TEXT", executed[3])
+            self.assertIn("'val2'::TEXT", executed[-1])
+            # The batch and the commit of the connector
+            self.assertEqual(self.pconn.commit.call_count, 2)
+
+            # Caught up
+            docmgr.remove(6, 'db.col', int(time.time()) << 32)
+            self.assertFalse(docmgr.lag_monitor.catching_up)
+            self.cursor.execute.assert_called_with('DELETE from col WHERE _id = 6::INT;')
+
+        finally:
+            docmgr.stop()
+
+    def test_trace_file(self):
+        # The trace file is written to a real directory
+        self.ospath_patcher.stop()
+        self.ospath_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.os.path.isfile',
+            return_value=True
+        )
+        self.ospath_patcher.start()
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'trace.json')
+
+        try:
+            docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', traceFile=path, traceSampleRate=1)
+            docmgr.upsert({'_id': 1, 'field1': 'val1'}, 'db.col', 1)
+            docmgr.stop()
+
+            with open(path) as trace_file:
+                events = json.loads(trace_file.read().rstrip().rstrip(',') + ']')
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(
+            [event['name'] for event in events],
+            ['execute', 'map', 'render', 'execute', 'commit', 'commit', 'upsert']
+        )
+
+    def test_record_file(self):
+        # The recording is written to a real directory
+        self.ospath_patcher.stop()
+        self.ospath_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.os.path.isfile',
+            return_value=True
+        )
+        self.ospath_patcher.start()
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'recording.bson.gz')
+
+        try:
+            docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', recordFile=path)
+            docmgr.upsert({'_id': 1, 'field1': 'val1'}, 'db.col', 1)
+            self.mcol.find_one.return_value = {'_id': 1, 'field1': 'val2'}
+            docmgr.update(1, {'$set': {'field1': 'val2'}}, 'db.col', 2)
+            docmgr.remove(1, 'other.col', 3)
+            docmgr.stop()
+
+            records = list(replay.read_recording(path))
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual([record['op'] for record in records], ['upsert', 'update', 'fetch', 'remove'])
+        self.assertEqual(records[2]['doc'], {'_id': 1, 'field1': 'val2'})
+
+    def test_database_pattern(self):
+        self.builtin_open_patcher.stop()
+        self.builtin_open_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.open',
+            mock_open(read_data=json.dumps({'tenant_*': MAPPING['db']})),
+            create=True
+        )
+        self.builtin_open_patcher.start()
+
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl')
+        self.assertEqual(docmgr.timestamped_tables, {'tenant_*.col': ('col', '_id', None)})
+        # Rows without a discriminator cannot be searched under their database
+        self.assertEqual(docmgr._get_searchable_tables(), [])
+        self.cursor.execute.reset_mock()
+
+        docmgr.upsert({'_id': 1, 'field1': 'val1'}, 'other.col', 1)
+        self.cursor.execute.assert_not_called()
+
+        docmgr.upsert({'_id': 1, 'field1': 'val1', 'field2': [{'subfield1': 'a'}]}, 'tenant_0042.col', 1)
+        sql = self.cursor.execute.call_args[0][0]
+        self.assertIn('INSERT INTO col (_creationDate, _id, _ts, field1)', sql)
+        self.assertIn('INSERT INTO col_field2', sql)
+
+        self.mcol.find_one.return_value = {'_id': 1, 'field1': 'val2'}
+        docmgr.update(1, {'$set': {'field1': 'val2'}}, 'tenant_0042.col', 2)
+        self.mconn.__getitem__.assert_called_with('tenant_0042')
+
+    def test_discriminator(self):
+        mapping = json.loads(json.dumps(MAPPING['db']))
+
+        for collection in mapping.values():
+            collection['discriminator'] = 'tenant'
+
+        self.builtin_open_patcher.stop()
+        self.builtin_open_patcher = patch(
+            'mongo_connector.doc_managers.postgresql_manager.open',
+            mock_open(read_data=json.dumps({'tenant_*': mapping})),
+            create=True
+        )
+        self.builtin_open_patcher.start()
+        self.cursor.execute.reset_mock()
+
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl')
+        schema = ' '.join(str(c[0][0]) for c in self.cursor.execute.call_args_list)
+        self.assertIn('tenant TEXT NOT NULL', schema)
+        self.assertIn('CONSTRAINT COL_PK PRIMARY KEY (tenant, _id)', schema)
+        self.assertIn('FOREIGN KEY (tenant, id_col) REFERENCES col(tenant, _id)', schema)
+        self.assertIn('INDEX idx_col_field2__fk_id_col ON col_field2 (tenant, id_col)', schema)
+
+        self.cursor.execute.reset_mock()
+        docmgr.upsert({'_id': 1, 'field1': 'val1'}, 'tenant_a.col', 1)
+        delete, insert = [c[0][0] for c in self.cursor.execute.call_args_list[:2]]
+        self.assertEqual(delete, "DELETE FROM col WHERE _id = 1 AND tenant = 'tenant_a'")
+        self.assertIn('INSERT INTO col (_creationDate, _id, _ts, field1, tenant)', insert)
+        self.assertIn("'tenant_a'::TEXT", insert)
+
+        docmgr.remove(1, 'tenant_a.col', 2)
+        self.cursor.execute.assert_called_with("DELETE from col WHERE _id = 1::INT AND tenant = 'tenant_a';")
+
+        self.cursor.__iter__.return_value = iter([('tenant_a.col', '1', 42)])
+        list(docmgr.search(40, 50))
+        self.cursor.execute.assert_called_with(
+            "(SELECT tenant || '.col' AS ns, _id::TEXT AS _id, _ts AS _ts FROM col WHERE _ts BETWEEN 40 AND 50)"
+        )
+
+    def test_document_cache(self):
+        docmgr = postgresql_manager.DocManager('url', mongoUrl='murl', documentCacheSize=10)
+        docmgr.upsert({'_id': 1, 'field1': 'val1', 'other': 'x'}, 'db.col', 1)
+        self.cursor.execute.reset_mock()
+
+        docmgr.update(1, {'$set': {'field1': 'val2'}}, 'db.col', 2)
+
+        self.mcol.find_one.assert_not_called()
+        self.assertIn("'val2'::TEXT", self.cursor.execute.call_args[0][0])
+
+        # Unsupported updates are read from MongoDB
+        self.mcol.find_one.return_value = {'_id': 1, 'field1': 'val3', 'field2': [{'subfield1': 'a'}]}
+        docmgr.update(1, {'$push': {'field2': {'subfield1': 'a'}}}, 'db.col', 3)
+        self.mcol.find_one.assert_called_with({'_id': 1}, projection=PROJECTION)
+
+        self.assertEqual(docmgr.document_cache.stats()['hits'], 1)
+        self.assertEqual(docmgr.document_cache.stats()['misses'], 1)
+
+        # Bulk loads leave the cache to the updates
+        with patch.object(docmgr.document_cache, 'put') as put:
+            docmgr.bulk_upsert([{'_id': 2, 'field1': 'val1'}], 'db.col', 4)
+
+        put.assert_not_called()
+
+    def test_check_bloat(self):
+        self.docmgr.bloat_check_interval = 60
+        self.docmgr.bloat_checked_at = time.time() - 120
+        self.cursor.fetchall.return_value = [('col', 60, 40), ('col_field2', 100, 0)]
+
+        with patch('mongo_connector.doc_managers.postgresql_manager.LOG') as log:
+            self.docmgr.commit()
+
+        self.assertEqual(self.docmgr.table_stats, {
+            'col': {'live': 60, 'dead': 40, 'dead_ratio': 0.4},
+            'col_field2': {'live': 100, 'dead': 0, 'dead_ratio': 0.0}
+        })
+        self.assertEqual(log.warning.call_args[0][1:], ('col', 40, 60, 40.0))
+        self.assertIn('pg_stat_user_tables', self.cursor.execute.call_args[0][0])
+
+        # Not due yet
+        self.cursor.execute.reset_mock()
+        self.docmgr.commit()
+        self.cursor.execute.assert_not_called()
+
+    def test_maintain_partitions(self):
+        self.docmgr.mappings['db']['col']['partition'] = {
+            'type': 'RANGE',
+            'interval': 'month',
+            'premake': 1,
+            'retention': 2
+        }
+        self.cursor.fetchall.return_value = [
+            ('col_default',),
+            ('col_p20161101',),
+            ('col_p20170101',),
+            ('col_p20170301',)
+        ]
+        self.cursor.execute.reset_mock()
+
+        self.docmgr.maintain_partitions(today=date(2017, 3, 15))
+
+        self.cursor.execute.assert_has_calls([
+            call("CREATE TABLE IF NOT EXISTS col_p20170101 PARTITION OF col FOR VALUES FROM ('2017-01-01') TO ('2017-02-01')"),
+            call("CREATE TABLE IF NOT EXISTS col_p20170201 PARTITION OF col FOR VALUES FROM ('2017-02-01') TO ('2017-03-01')"),
+            call("CREATE TABLE IF NOT EXISTS col_p20170301 PARTITION OF col FOR VALUES FROM ('2017-03-01') TO ('2017-04-01')"),
+            call("CREATE TABLE IF NOT EXISTS col_p20170401 PARTITION OF col FOR VALUES FROM ('2017-04-01') TO ('2017-05-01')"),
+        ])
+        self.cursor.execute.assert_any_call('DROP TABLE IF EXISTS col_p20161101 CASCADE')
+
+        dropped = [
+            args[0] for args, _ in self.cursor.execute.call_args_list
+            if args[0].startswith('DROP')
+        ]
+        self.assertEqual(dropped, ['DROP TABLE IF EXISTS col_p20161101 CASCADE'])
+        self.assertEqual(self.docmgr.partitions_maintained_on, date(2017, 3, 15))
+
+    def test_maintain_partitions_failure(self):
+        self.docmgr.mappings['db']['col']['partition'] = {'type': 'RANGE', 'interval': 'month'}
+        self.docmgr.partitions_maintained_on = date(2017, 3, 14)
+        self.psql_module.Error = psycopg2.Error
+        self.cursor.execute.side_effect = psycopg2.IntegrityError('updated partition constraint would be violated')
+        self.pconn.rollback.reset_mock()
+
+        with patch('mongo_connector.doc_managers.postgresql_manager.LOG') as log:
+            self.docmgr.maintain_partitions(today=date(2017, 3, 15))
+
+        self.pconn.rollback.assert_called_once_with()
+        log.error.assert_called()
+        # Not attempted again on every commit
+        self.assertEqual(self.docmgr.partitions_maintained_on, date(2017, 3, 15))
+
+    def test_get_last_doc(self):
+        self.cursor.fetchone.return_value = ('db.col', '1', 42)
+
+        got = self.docmgr.get_last_doc()
+
+        self.cursor.execute.assert_called_with(
+            "SELECT ns, _id, _ts FROM ("
+            "(SELECT 'db.col' AS ns, _id::TEXT AS _id, _ts AS _ts FROM col WHERE _ts IS NOT NULL ORDER BY _ts DESC LIMIT 1)"
+            ") AS last_docs ORDER BY _ts DESC LIMIT 1"
+        )
+        self.assertEqual(got, {'ns': 'db.col', '_id': '1', '_ts': 42})
+
+        self.cursor.fetchone.return_value = None
+        self.assertIsNone(self.docmgr.get_last_doc())
+
+    def test_search(self):
+        self.cursor.__iter__.return_value = iter([('db.col', '1', 42), ('db.col', '2', 43)])
+
+        got = list(self.docmgr.search(40, 50))
+
+        self.pconn.cursor.assert_called_with(name='mongo_connector_search')
+        self.cursor.execute.assert_called_with(
+            "(SELECT 'db.col' AS ns, _id::TEXT AS _id, _ts AS _ts FROM col WHERE _ts BETWEEN 40 AND 50)"
+        )
+        self.assertEqual(got, [
+            {'ns': 'db.col', '_id': '1', '_ts': 42},
+            {'ns': 'db.col', '_id': '2', '_ts': 43}
+        ])
+
     def test_remove(self):
-        now = time()
+        now = 1
         self.docmgr.remove(1, 'db.col', now)
 
         self.cursor.execute.assert_called_with(
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+from mock import MagicMock
+import os
+import shutil
+import tempfile
+
+from mongo_connector.doc_managers import replay
+
+
+class TestReplay(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'recording.bson.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self):
+        recorder = replay.OplogRecorder(self.path)
+        documents = recorder.bulk_upsert('db.col', iter([{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}]), 1)
+
+        next(documents)
+        # Recorded by another thread during the bulk upsert
+        recorder.update('db.col', 1, {'$set': {'a': 3}}, 2)
+        list(documents)
+
+        recorder.fetched('db.col', {'_id': 1, 'a': 3})
+        recorder.upsert('db.col', {'_id': {'k': 3}, 'a': 4}, 3)
+        recorder.remove('db.col', 2, 4)
+        recorder.close()
+
+    def test_recording(self):
+        self.record()
+
+        self.assertEqual([record['op'] for record in replay.read_recording(self.path)], [
+            'bulk_upsert', 'document', 'update', 'document', 'end', 'fetch', 'upsert', 'remove'
+        ])
+
+    def test_recorded_mongo(self):
+        self.record()
+        mongo = replay.RecordedMongo()
+        list(replay._Records(self.path, mongo))
+
+        self.assertEqual(mongo['db']['col'].find_one({'_id': 1}), {'_id': 1, 'a': 3})
+        self.assertEqual(mongo['db']['col'].find_one({'_id': {'k': 3}}), {'_id': {'k': 3}, 'a': 4})
+        self.assertIsNone(mongo['db']['other'].find_one({'_id': 1}))
+        self.assertEqual(
+            mongo['db']['col'].find({'_id': {'$in': [2, 5]}}, projection={'a': True}),
+            [{'_id': 2, 'a': 2}]
+        )
+
+        # Served documents are copies
+        mongo['db']['col'].find_one({'_id': 1})['a'] = 0
+        self.assertEqual(mongo['db']['col'].find_one({'_id': 1}), {'_id': 1, 'a': 3})
+
+    def test_replay(self):
+        self.record()
+        doc_manager = MagicMock()
+        bulk_documents = []
+        doc_manager.bulk_upsert.side_effect = lambda documents, namespace, timestamp: bulk_documents.extend(documents)
+
+        report = replay.replay(self.path, doc_manager)
+
+        # Operations recorded during a bulk upsert are replayed after it
+        self.assertEqual([name for name, _, _ in doc_manager.method_calls], [
+            'bulk_upsert', 'update', 'upsert', 'remove', 'commit'
+        ])
+        self.assertEqual(bulk_documents, [{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}])
+        doc_manager.update.assert_called_with(1, {'$set': {'a': 3}}, 'db.col', 2)
+
+        self.assertEqual(report['operations'], {'bulk_upsert': 1, 'update': 1, 'upsert': 1, 'remove': 1})
+        self.assertEqual(report['documents'], 3)
+        self.assertEqual(sorted(report['latency_ms']), ['max', 'p50', 'p90', 'p99'])
+        self.assertGreater(report['operations_per_second'], 0)
+
+    def test_recorded_mongo_maxsize(self):
+        mongo = replay.RecordedMongo(maxsize=1)
+        mongo.add('db.col', {'_id': 1})
+        mongo.add('db.col', {'_id': 2})
+
+        self.assertFalse(mongo.has('db.col', 1))
+        self.assertEqual(mongo['db']['col'].find_one({'_id': 2}), {'_id': 2})
+
+    def test_replay_reads_ahead(self):
+        recorder = replay.OplogRecorder(self.path)
+        recorder.update('db.col', 1, {'$set': {'a': 2}}, 1)
+        recorder.upsert('db.col', {'_id': 2}, 2)
+        # Fetched when the buffered update is applied
+        recorder.fetched('db.col', {'_id': 1, 'a': 2})
+        recorder.close()
+
+        doc_manager = MagicMock()
+        fetched = []
+        doc_manager.update.side_effect = lambda document_id, spec, namespace, timestamp: fetched.append(
+            doc_manager.client['db']['col'].find_one({'_id': document_id})
+        )
+
+        replay.replay(self.path, doc_manager)
+
+        self.assertEqual(fetched, [{'_id': 1, 'a': 2}])
+        self.assertEqual([name for name, _, _ in doc_manager.method_calls], ['update', 'upsert', 'commit'])
+
+    def test_run_refuses_url_without_drop(self):
+        with self.assertRaises(replay.InvalidConfiguration):
+            replay.run(self.path, 'mappings.json', url='postgresql://localhost/production')
+
+        with self.assertRaises(SystemExit):
+            replay.main([self.path, '--url', 'postgresql://localhost/production'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(replay._percentile(values, 50), 50)
+        self.assertEqual(replay._percentile(values, 99), 99)
+        self.assertEqual(replay._percentile([7], 90), 7)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,26 @@
 
 from unittest import TestCase, main
 from mock import MagicMock, call
+import psycopg2
 
 from mongo_connector.doc_managers import sql, utils
 from bson.objectid import ObjectId
 
 from collections import OrderedDict
+import json
 from datetime import datetime
 from .fixtures import *
 
 
+# Columns given to the upper batch transform
+TRANSFORMED = []
+
+
+def upper(values):
+    TRANSFORMED.append(list(values))
+    return [value.upper() for value in values]
+
+
 class TestPostgreSQL(TestCase):
     def test_to_sql_list(self):
         items = ['1', '2']
@@ -52,6 +63,76 @@ class TestPostgreSQL(TestCase):
             'CREATE TABLE table  (field TEXT,id INTEGER) '
         )
 
+    def test_sql_create_partitioned_table(self):
+        cursor = MagicMock()
+        sql.sql_create_table(cursor, 'table', ['id INTEGER'], 'HASH (id)')
+        cursor.execute.assert_called_with(
+            'CREATE TABLE table  (id INTEGER) PARTITION BY HASH (id)'
+        )
+
+        sql.sql_create_hash_partitions(cursor, 'table', 2)
+        cursor.execute.assert_has_calls([
+            call('CREATE TABLE table_h0 PARTITION OF table FOR VALUES WITH (MODULUS 2, REMAINDER 0)'),
+            call('CREATE TABLE table_h1 PARTITION OF table FOR VALUES WITH (MODULUS 2, REMAINDER 1)')
+        ])
+
+        sql.sql_create_range_partition(
+            cursor, 'table', 'table_p20170301',
+            datetime(2017, 3, 1).date(), datetime(2017, 4, 1).date()
+        )
+        cursor.execute.assert_called_with(
+            "CREATE TABLE IF NOT EXISTS table_p20170301 PARTITION OF table FOR VALUES FROM ('2017-03-01') TO ('2017-04-01')"
+        )
+
+    def test_sql_create_table_storage(self):
+        cursor = MagicMock()
+        storage = OrderedDict([
+            ('fillfactor', 70),
+            ('autovacuum_vacuum_scale_factor', 0.01),
+            ('toast.autovacuum_enabled', False),
+            ('vacuum_index_cleanup', 'auto')
+        ])
+
+        sql.sql_create_table(cursor, 'table', ['id INTEGER'], storage=storage)
+        cursor.execute.assert_called_with(
+            "CREATE TABLE table  (id INTEGER)  WITH (autovacuum_vacuum_scale_factor=0.01, fillfactor=70, "
+            "toast.autovacuum_enabled=false, vacuum_index_cleanup='auto')"
+        )
+
+        # Partitioned tables hold no data, their partitions get the parameters
+        sql.sql_create_table(cursor, 'table', ['id INTEGER'], 'HASH (id)', {'fillfactor': 70})
+        cursor.execute.assert_called_with(
+            'CREATE TABLE table  (id INTEGER) PARTITION BY HASH (id)'
+        )
+
+        sql.sql_create_hash_partitions(cursor, 'table', 1, {'fillfactor': 70})
+        cursor.execute.assert_called_with(
+            'CREATE TABLE table_h0 PARTITION OF table FOR VALUES WITH (MODULUS 1, REMAINDER 0) WITH (fillfactor=70)'
+        )
+
+        sql.sql_create_default_partition(cursor, 'table', {'fillfactor': 70})
+        cursor.execute.assert_called_with(
+            'CREATE TABLE IF NOT EXISTS table_default PARTITION OF table DEFAULT WITH (fillfactor=70)'
+        )
+
+    def test_sql_get_table_stats(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [('col', 90, 10)]
+
+        self.assertEqual(sql.sql_get_table_stats(cursor, ['col', 'Col_Items']), {'col': (90, 10)})
+        self.assertIn("IN ('col', 'col_items')", cursor.execute.call_args[0][0])
+
+        cursor.reset_mock()
+        self.assertEqual(sql.sql_get_table_stats(cursor, []), {})
+        cursor.execute.assert_not_called()
+
+    def test_sql_get_rows_written(self):
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (1200,)
+
+        self.assertEqual(sql.sql_get_rows_written(cursor), 1200)
+        self.assertIn("relname <> '_mongo_connector_checkpoints'", cursor.execute.call_args[0][0])
+
     def test_sql_add_foreign_keys(self):
         cursor = MagicMock()
         foreign_keys = [
@@ -68,6 +149,29 @@ class TestPostgreSQL(TestCase):
             'ALTER TABLE table ADD CONSTRAINT table_reftable_id_fk FOREIGN KEY (reftable_id) REFERENCES reftable(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
         )
 
+    def test_sql_checkpoints(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [
+            ('db.col', '{"_id": {"$oid": "5a0c2d7ef3b6f4f2b0a1e8d1"}}')
+        ]
+
+        got = sql.sql_get_checkpoints(cursor)
+        self.assertEqual(
+            got,
+            {'db.col': ObjectId('5a0c2d7ef3b6f4f2b0a1e8d1')}
+        )
+
+        sql.sql_set_checkpoint(cursor, 'db.col', 42)
+        cursor.execute.assert_called_with(
+            "INSERT INTO _mongo_connector_checkpoints (namespace, last_id) VALUES ('db.col', '{\"_id\": 42}') "
+            "ON CONFLICT (namespace) DO UPDATE SET last_id = EXCLUDED.last_id"
+        )
+
+        sql.sql_delete_checkpoint(cursor, 'db.col')
+        cursor.execute.assert_called_with(
+            "DELETE FROM _mongo_connector_checkpoints WHERE namespace = 'db.col'"
+        )
+
     def test_sql_bulk_insert(self):
         cursor = MagicMock()
 
@@ -181,6 +285,295 @@ class TestPostgreSQL(TestCase):
             call(TEST_SQL_BULK_INSERT_ARRAY_2)
         ])
 
+    def test_sql_insert_statements_max_rows(self):
+        mapping = {
+            'db': {
+                'col1': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'items': {'dest': 'col_array', 'type': '_ARRAY', 'fk': 'id_col1'}
+                },
+                'col_array': {
+                    'pk': '_id',
+                    '_id': {'dest': '_id', 'type': 'SERIAL'},
+                    'field1': {'dest': 'field1', 'type': 'INT'},
+                    'id_col1': {'dest': 'id_col1', 'type': 'INT'},
+                    'tags': {'dest': 'col_tags', 'type': '_ARRAY_OF_SCALARS', 'fk': 'id_col_array', 'valueField': 'tag'}
+                },
+                'col_tags': {
+                    'pk': '_id',
+                    '_id': {'dest': '_id', 'type': 'SERIAL'},
+                    'id_col_array': {'dest': 'id_col_array', 'type': 'INT'},
+                    'tag': {'dest': 'tag', 'type': 'TEXT'}
+                }
+            }
+        }
+
+        doc = {'_id': 1, 'items': [{'field1': i} for i in range(25)]}
+        statements = list(sql.sql_insert_statements(mapping, 'db.col1', [doc], max_rows=10))
+
+        self.assertEqual(len(statements), 3)
+        self.assertEqual([stmt.count('INSERT INTO col_array') for _, stmt in statements], [9, 10, 6])
+
+        for querytree, stmt in statements:
+            self.assertIs(querytree['document']['raw'], doc)
+
+        # Continuation statements reference the root row by its key
+        self.assertIn('INSERT INTO col1', statements[0][1])
+
+        for (_, stmt), rows in zip(statements[1:], [10, 6]):
+            self.assertNotIn('INSERT INTO col1 ', stmt)
+            self.assertNotIn('col1_rows', stmt)
+            self.assertEqual(stmt.count(', 1::INT))'), rows)
+
+        # Linked rows referencing a generated key stay with their parent row
+        doc = {'_id': 1, 'items': [{'field1': i, 'tags': ['a', 'b', 'c']} for i in range(2)]}
+        statements = list(sql.sql_insert_statements(mapping, 'db.col1', [doc], max_rows=2))
+
+        self.assertEqual(len(statements), 3)
+        self.assertNotIn('INSERT INTO col_array', statements[0][1])
+
+        for _, stmt in statements[1:]:
+            self.assertEqual(stmt.count('INSERT INTO col_array'), 1)
+            self.assertEqual(stmt.count('INSERT INTO col_tags'), 3)
+            self.assertIn('col_array_rows_0._id AS id_col_array', stmt)
+
+    def test_sql_insert_statements_batch_transform(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'name': {'dest': 'name', 'type': 'TEXT', 'transform': '@tests.test_sql.upper', 'batchTransform': True},
+                    'size': {'dest': 'size', 'type': 'INT', 'transform': 'val * 2'}
+                }
+            }
+        }
+        docs = [{'_id': i, 'name': 'doc{0}'.format(i), 'size': i} for i in range(3)]
+        del TRANSFORMED[:]
+        statements = list(sql.sql_insert_statements(mapping, 'db.col', docs))
+
+        # The batch transform is called once for the column of the documents,
+        # the other transforms are not applied to the written rows
+        self.assertEqual(TRANSFORMED, [['doc0', 'doc1', 'doc2']])
+        self.assertIn("'DOC2'::TEXT", statements[2][1])
+        self.assertIn("2::INT", statements[2][1])
+
+        # Mapped documents given by the caller are not transformed again
+        mapped = [{'_id': 1, 'name': 'given', 'size': 1}]
+        statements = list(sql.sql_insert_statements(mapping, 'db.col', docs[1:2], mapped_documents=mapped))
+        self.assertIn("'given'::TEXT", statements[0][1])
+        self.assertEqual(len(TRANSFORMED), 1)
+
+    def test_sql_bulk_insert_native_array(self):
+        cursor = MagicMock()
+
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {
+                        'dest': '_id',
+                        'type': 'INT'
+                    },
+                    'tags': {
+                        'dest': 'tags',
+                        'type': '_ARRAY_OF_SCALARS',
+                        'valueType': 'TEXT'
+                    }
+                }
+            }
+        }
+
+        sql.sql_bulk_insert(cursor, mapping, 'db.col', [{'_id': 1, 'tags': ['a', "b'c"]}])
+        self.assertIn(
+            "(VALUES (NULL::TIMESTAMP, 1::INT, ARRAY['a', 'b''c']::TEXT[]))",
+            cursor.execute.call_args[0][0]
+        )
+        self.assertNotIn('RETURNING', cursor.execute.call_args[0][0])
+
+    def test_to_sql_value_json(self):
+        oid = ObjectId('5a0c2d7ef3b6f4f2b0a1e8d1')
+        value = {
+            'id': oid,
+            'date': datetime(2017, 1, 2, 3, 4, 5),
+            'text': u"it's\x00",
+            'list': [1, None]
+        }
+
+        got = sql.to_sql_value(value, vtype='JSONB')
+        self.assertTrue(got.endswith('::JSONB'))
+        self.assertEqual(
+            json.loads(got[1:-len("'::JSONB")].replace("''", "'")),
+            {
+                'id': '5a0c2d7ef3b6f4f2b0a1e8d1',
+                'date': '2017-01-02T03:04:05',
+                'text': "it's",
+                'list': [1, None]
+            }
+        )
+        self.assertEqual(sql.to_sql_value(None, vtype='JSONB'), 'NULL::JSONB')
+
+    def test_to_sql_value_encoders(self):
+        oid = ObjectId('5a0c2d7ef3b6f4f2b0a1e8d1')
+
+        self.assertEqual(sql.to_sql_value(12, vtype='INT'), '12::INT')
+        self.assertEqual(sql.to_sql_value(12, vtype='SERIAL'), '12::INT')
+        self.assertEqual(sql.to_sql_value(u'12', vtype='BIGINT'), "'12'::BIGINT")
+        self.assertEqual(sql.to_sql_value(1.5, vtype='DOUBLE PRECISION'), '1.5::DOUBLE PRECISION')
+        self.assertEqual(sql.to_sql_value(True, vtype='BOOLEAN'), 'TRUE::BOOLEAN')
+        self.assertEqual(sql.to_sql_value(None, vtype='TEXT'), 'NULL::TEXT')
+        self.assertEqual(sql.to_sql_value(u"it's\x00\x9f", vtype='TEXT'), u"'it''s'::TEXT")
+        self.assertEqual(sql.to_sql_value(oid, vtype='TEXT'), u"'5a0c2d7ef3b6f4f2b0a1e8d1'::TEXT")
+        self.assertEqual(
+            sql.to_sql_value(datetime(2017, 1, 2, 3, 4, 5), vtype='TIMESTAMP'),
+            u"'2017-01-02 03:04:05'::TIMESTAMP"
+        )
+        self.assertEqual(sql.to_sql_value([1, u'a'], vtype='TEXT[]'), u"ARRAY[1, 'a']::TEXT[]")
+        self.assertEqual(sql.to_sql_value(sql.ForeignKey(u'x'), vtype='INT'), u'x')
+        self.assertEqual(sql.to_sql_value(u"a'b"), u"'a''b'")
+        self.assertIs(sql.get_encoder('TEXT'), sql.get_encoder('TEXT'))
+
+    def test_get_columns(self):
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': 'id',
+                    '_id': {'dest': 'id', 'type': 'INT'},
+                    'name': {'dest': 'a_name', 'type': 'TEXT'},
+                    'items': {'type': '_ARRAY', 'dest': 'col_items', 'fk': 'id_col'}
+                }
+            }
+        }
+
+        columns = sql.get_columns(mapping, 'db', 'col')
+        self.assertEqual([(field, dest) for field, dest, _ in columns], [('name', 'a_name'), ('_id', 'id')])
+        self.assertEqual(columns[1][2](3), '3::INT')
+        self.assertIs(sql.get_columns(mapping, 'db', 'col'), columns)
+
+        # A reloaded mapping is not served from the cache
+        mapping['db']['col'] = dict(mapping['db']['col'], other={'dest': 'b_other', 'type': 'TEXT'})
+        self.assertEqual(len(sql.get_columns(mapping, 'db', 'col')), 3)
+
+    def test_sql_bulk_insert_isolate_errors(self):
+        cursor = MagicMock()
+        dead_letters = MagicMock()
+        error = psycopg2.Error('invalid input syntax')
+
+        def execute(sql):
+            if "'bad'" in sql:
+                raise error
+
+        cursor.execute.side_effect = execute
+
+        mapping = {
+            'db': {
+                'col': {
+                    'pk': '_id',
+                    '_id': {
+                        'dest': '_id',
+                        'type': 'INT'
+                    },
+                    'field1': {
+                        'dest': 'field1',
+                        'type': 'TEXT'
+                    }
+                }
+            }
+        }
+        docs = [
+            {'_id': 1, 'field1': 'good'},
+            {'_id': 2, 'field1': 'bad'},
+            {'_id': 3, 'field1': 'good'},
+            {'_id': 4, 'field1': 'good'}
+        ]
+
+        sql.sql_bulk_insert(
+            cursor, mapping, 'db.col', docs,
+            quiet=True,
+            isolate_errors=True,
+            dead_letters=dead_letters
+        )
+
+        executed = [args[0] for args, _ in cursor.execute.call_args_list]
+        inserts = [
+            stmt for stmt in executed
+            if stmt.startswith('WITH')
+        ]
+
+        # Whole batch, then both halves, then the failing half's documents
+        self.assertEqual(len(inserts), 5)
+        self.assertEqual(inserts[0].count('WITH'), 4)
+        self.assertEqual(
+            executed.count('ROLLBACK TO SAVEPOINT bulk_insert; RELEASE SAVEPOINT bulk_insert'),
+            3
+        )
+        self.assertEqual(executed.count('RELEASE SAVEPOINT bulk_insert'), 2)
+        dead_letters.write.assert_called_once_with(
+            'db.col',
+            docs[1],
+            error,
+            inserts[3]
+        )
+
+    def test_sql_bulk_insert_isolate_errors_linked_rows(self):
+        cursor = MagicMock()
+        dead_letters = MagicMock()
+        error = psycopg2.Error('invalid input syntax')
+
+        def execute(sql):
+            # The root row of the second document fails, not its linked rows
+            if "'bad'::TEXT" in sql:
+                raise error
+
+        cursor.execute.side_effect = execute
+
+        mapping = {
+            'db': {
+                'col1': {
+                    'pk': '_id',
+                    '_id': {'type': 'INT'},
+                    'name': {'dest': 'name', 'type': 'TEXT'},
+                    'items': {'dest': 'col_array', 'type': '_ARRAY', 'fk': 'id_col1'}
+                },
+                'col_array': {
+                    'pk': '_id',
+                    '_id': {'dest': '_id', 'type': 'SERIAL'},
+                    'field1': {'dest': 'field1', 'type': 'INT'},
+                    'id_col1': {'dest': 'id_col1', 'type': 'INT'}
+                }
+            }
+        }
+        docs = [
+            {'_id': i, 'name': 'bad' if i == 2 else 'good', 'items': [{'field1': j} for j in range(5)]}
+            for i in range(1, 4)
+        ]
+
+        failures = sql.sql_bulk_insert(
+            cursor, mapping, 'db.col1', docs,
+            quiet=True,
+            isolate_errors=True,
+            dead_letters=dead_letters,
+            max_rows=3
+        )
+
+        # Each document spans 2 statements, which fail together
+        self.assertEqual(failures, 2)
+        dead_letters.write.assert_called_once()
+        self.assertIs(dead_letters.write.call_args[0][1], docs[1])
+
+        released = []
+
+        for args, _ in cursor.execute.call_args_list:
+            if args[0] == 'RELEASE SAVEPOINT bulk_insert':
+                released.append(executed)
+
+            executed = args[0]
+
+        # No continuation statement of the failed document is kept
+        for stmt in released:
+            self.assertNotIn(', 2::INT))', stmt)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+import json
+import os
+import shutil
+import tempfile
+
+from mongo_connector.doc_managers import tracing
+
+
+def read_events(path):
+    with open(path) as trace_file:
+        content = trace_file.read().rstrip().rstrip(',')
+
+    return json.loads(content + ']')
+
+
+class TestTracing(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'trace.json')
+
+    def tearDown(self):
+        tracing.configure(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        self.assertIs(tracing.trace('upsert'), tracing.span('map'))
+
+        with tracing.trace('upsert', ns='db.col'):
+            with tracing.span('map'):
+                pass
+
+    def test_spans(self):
+        tracing.configure(self.path, 1)
+
+        # Spans outside of an operation are not recorded
+        with tracing.span('commit'):
+            pass
+
+        with tracing.trace('upsert', ns='db.col'):
+            with tracing.span('map', ns='db.col'):
+                pass
+
+            try:
+                with tracing.span('execute'):
+                    raise ValueError()
+
+            except ValueError:
+                pass
+
+        tracing.configure(None)
+        events = read_events(self.path)
+
+        self.assertEqual([event['name'] for event in events], ['map', 'execute', 'upsert'])
+        self.assertEqual(events[0]['args'], {'ns': 'db.col'})
+        self.assertEqual(events[1]['args'], {'error': 'ValueError'})
+        self.assertEqual(events[2]['ph'], 'X')
+        self.assertLessEqual(events[2]['ts'], events[0]['ts'])
+        self.assertEqual(len(set(event['tid'] for event in events)), 1)
+
+    def test_sampling(self):
+        tracing.configure(self.path, 0)
+
+        for _ in range(10):
+            with tracing.trace('upsert'):
+                with tracing.span('map'):
+                    pass
+
+        tracing.configure(None)
+        self.assertEqual(read_events(self.path), [])
+
+
+if __name__ == '__main__':
+    main()
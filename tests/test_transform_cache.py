@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, main
+
+from mock import MagicMock
+
+from mongo_connector.doc_managers.transform_cache import MemoizedTransform
+
+
+class TestMemoizedTransform(TestCase):
+    def test_values(self):
+        transform = MagicMock(side_effect=lambda value: value in ('true', 'yes', 1))
+        memoized = MemoizedTransform(transform, 2)
+
+        self.assertTrue(memoized('yes'))
+        self.assertTrue(memoized('yes'))
+        self.assertFalse(memoized('no'))
+        self.assertEqual(transform.call_count, 2)
+
+        # Equal values of different types are cached apart
+        self.assertTrue(memoized(1))
+        self.assertFalse(memoized(1.5))
+        self.assertEqual(transform.call_count, 4)
+
+        # Unhashable values bypass the cache
+        self.assertFalse(memoized(['yes']))
+        self.assertFalse(memoized(['yes']))
+        self.assertEqual(transform.call_count, 6)
+
+        self.assertEqual(memoized.stats(), {
+            'size': 2,
+            'hits': 1,
+            'misses': 4,
+            'bypassed': 2,
+            'hit_ratio': 0.2
+        })
+
+    def test_errors_are_not_cached(self):
+        transform = MagicMock(side_effect=[ValueError('boom'), 42])
+        memoized = MemoizedTransform(transform, 10)
+
+        with self.assertRaises(ValueError):
+            memoized('42')
+
+        self.assertEqual(memoized('42'), 42)
+        self.assertEqual(memoized('42'), 42)
+        self.assertEqual(transform.call_count, 2)
+
+    def test_batch(self):
+        transform = MagicMock(side_effect=lambda values: [value.upper() for value in values])
+        memoized = MemoizedTransform(transform, 10, batch=True)
+
+        self.assertEqual(memoized(['fr', 'us', 'fr']), ['FR', 'US', 'FR'])
+        transform.assert_called_with(['fr', 'us'])
+
+        # Only the distinct values missing from the cache are transformed
+        self.assertEqual(memoized(['us', 'de', 'it']), ['US', 'DE', 'IT'])
+        transform.assert_called_with(['de', 'it'])
+
+        self.assertEqual(memoized(['fr', 'de']), ['FR', 'DE'])
+        self.assertEqual(transform.call_count, 2)
+        self.assertEqual(memoized.stats()['misses'], 4)
+        self.assertEqual(memoized.stats()['hits'], 4)
+
+    def test_batch_length_mismatch(self):
+        memoized = MemoizedTransform(lambda values: values[:1], 10, batch=True)
+
+        with self.assertRaises(ValueError):
+            memoized(['a', 'b'])
+
+        self.assertEqual(memoized.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    main()
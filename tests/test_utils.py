@@ -5,7 +5,7 @@ from mongo_connector.doc_managers import utils
 from bson.objectid import ObjectId
 from bson.tz_util import utc
 
-from datetime import datetime
+from datetime import datetime, date
 from calendar import timegm
 
 from unittest import TestCase, main
@@ -133,6 +133,13 @@ class TestPostgreSQLUtils(TestCase):
         got = utils.get_fields_of_type(mapping, 'db', 'col', doc, 'TEXT')
         self.assertEqual(got, ['field1.field2'])
 
+        # Collection options are not fields, even when the document has such a field
+        mapping['db']['col']['bookkeepingIndexes'] = False
+        mapping['db']['col']['partition'] = {'type': 'RANGE', 'column': 'field1'}
+        doc = {'bookkeepingIndexes': 'val', 'partition': 'val'}
+        self.assertEqual(utils.get_fields_of_type(mapping, 'db', 'col', doc, 'TEXT'), [])
+        self.assertEqual(utils.get_fields_of_type(mapping, 'db', 'col', doc, 'RANGE'), [])
+
     def test_get_array_fields(self):
         mapping = {
             'db': {
@@ -163,6 +170,40 @@ class TestPostgreSQLUtils(TestCase):
         got = utils.get_array_of_scalar_fields(mapping, 'db', 'col', doc)
         self.assertEqual(got, ['field'])
 
+        mapping['db']['col']['field']['valueType'] = 'INT'
+        got = utils.get_array_of_scalar_fields(mapping, 'db', 'col', doc)
+        self.assertEqual(got, [])
+
+    def test_partition_periods(self):
+        day = date(2017, 3, 15)
+
+        self.assertEqual(utils.get_period_start('day', day), day)
+        self.assertEqual(utils.get_period_start('week', day), date(2017, 3, 13))
+        self.assertEqual(utils.get_period_start('month', day), date(2017, 3, 1))
+        self.assertEqual(utils.get_period_start('year', day), date(2017, 1, 1))
+
+        self.assertEqual(utils.shift_period('day', day, -15), date(2017, 2, 28))
+        self.assertEqual(utils.shift_period('week', date(2017, 3, 13), 1), date(2017, 3, 20))
+        self.assertEqual(utils.shift_period('month', date(2017, 3, 1), -3), date(2016, 12, 1))
+        self.assertEqual(utils.shift_period('month', date(2017, 12, 1), 1), date(2018, 1, 1))
+        self.assertEqual(utils.shift_period('year', date(2017, 1, 1), 2), date(2019, 1, 1))
+
+        self.assertEqual(
+            utils.get_partition_name('Events', date(2017, 3, 1)),
+            'events_p20170301'
+        )
+
+    def test_get_column_type(self):
+        self.assertEqual(utils.get_column_type({'type': 'TEXT'}), 'TEXT')
+        self.assertEqual(
+            utils.get_column_type({'type': '_ARRAY_OF_SCALARS', 'valueType': 'BIGINT'}),
+            'BIGINT[]'
+        )
+        self.assertTrue(utils.is_linked_table_field({'type': '_ARRAY'}))
+        self.assertFalse(utils.is_linked_table_field(
+            {'type': '_ARRAY_OF_SCALARS', 'valueType': 'BIGINT'}
+        ))
+
     def test_get_any_array_fields(self):
         mapping = {
             'db': {
@@ -256,6 +297,38 @@ class TestPostgreSQLUtils(TestCase):
         got = utils.get_foreign_key(mapping, 'db', 'col', 'field1')
         self.assertEqual(got, 'field2')
 
+    def test_flatten_query_tree_depth(self):
+        root = {'queries': []}
+        subquery = root
+
+        for _ in range(5000):
+            child = {'queries': []}
+            subquery['queries'].append(child)
+            subquery = child
+
+        got = utils.flatten_query_tree([root])
+        self.assertEqual(len(got), 5001)
+        self.assertEqual(got[-1]['parent'], 4999)
+        self.assertTrue(got[-1]['last'])
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # b is the least recently used entry
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b', 0), 0)
+        self.assertEqual(len(cache), 2)
+
+        self.assertEqual(cache.pop('a'), 1)
+        cache.put(('ns', 1), 4)
+        cache.clear(lambda key: key[0] == 'ns')
+        self.assertEqual(len(cache), 1)
+        self.assertIn('c', cache)
+
 
 if __name__ == '__main__':
     main()